@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""Compares the size and speed of the codecs in `brubeck.encoding` on
+documents shaped like the ones Brubeck apps store: a bare todo item like the
+autoapi demo's and an owned, streamed post.
+
+    python benchmarks/bench_codecs.py [iterations]
+"""
+
+import sys
+import time
+import uuid
+
+from brubeck.encoding import (TaggedCodec, TAG_JSON, TAG_MSGPACK,
+                              TAG_ZLIB_JSON, TAG_ZLIB_MSGPACK)
+from brubeck.datamosh import OwnedModelMixin, StreamedModelMixin
+
+from dictshield.document import Document
+from dictshield.fields import StringField, BooleanField, IntField
+from dictshield.fields.compound import ListField
+
+
+###
+### Model shapes
+###
+
+class Todo(Document):
+    completed = BooleanField(default=False)
+    deleted = BooleanField(default=False)
+    archived = BooleanField(default=False)
+    title = StringField(required=True)
+    class Meta:
+        id_options = {'auto_fill': True}
+
+
+class Post(Document, OwnedModelMixin, StreamedModelMixin):
+    title = StringField(max_length=120)
+    body = StringField()
+    score = IntField(default=0)
+    tags = ListField(StringField())
+
+
+def sample_documents():
+    now = int(time.time() * 1000)
+    todo = Todo(title='Watch Blade Runner')
+    post = Post(owner_id=uuid.uuid4(), owner_username='jd',
+                created_at=now, updated_at=now,
+                title='Coroutines and you',
+                body='Brubeck handles every request in a coroutine. ' * 20,
+                score=42, tags=['python', 'gevent', 'zeromq'])
+    return [('todo', todo.to_json(encode=False)),
+            ('post', post.to_json(encode=False))]
+
+
+###
+### Measurements
+###
+
+def codecs():
+    yield ('json', TaggedCodec(TAG_JSON))
+    for level in (1, 6, 9):
+        yield ('zlib%d+json' % level, TaggedCodec(TAG_ZLIB_JSON, level=level))
+    try:
+        yield ('msgpack', TaggedCodec(TAG_MSGPACK))
+        yield ('zlib1+msgpack', TaggedCodec(TAG_ZLIB_MSGPACK, level=1))
+    except EnvironmentError:
+        print 'msgpack is not installed, skipping its codecs'
+
+
+def timed(function, value, iterations):
+    start = time.time()
+    for i in xrange(iterations):
+        function(value)
+    return (time.time() - start) / iterations * 1000000
+
+
+def main(iterations):
+    print '%-6s %-14s %7s %12s %12s' % ('model', 'codec', 'bytes',
+                                       'encode (us)', 'decode (us)')
+    for (model_name, document) in sample_documents():
+        for (codec_name, codec) in codecs():
+            encoded = codec.encode(document)
+            assert codec.decode(encoded) == document
+            print '%-6s %-14s %7d %12.2f %12.2f' % (
+                model_name, codec_name, len(encoded),
+                timed(codec.encode, document, iterations),
+                timed(codec.decode, encoded, iterations))
+
+
+if __name__ == '__main__':
+    iterations = 10000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    main(iterations)
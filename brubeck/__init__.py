@@ -7,6 +7,7 @@ version_info = (0, 4, 0)
 __all__ = ['auth',
            'autoapi',
            'caching',
+           'encoding',
            'datamosh',
            'models',
            'mongrel2',
@@ -1,20 +1,133 @@
 from request_handling import JSONMessageHandler, FourOhFourException
+from datamosh import StreamedHandlerMixin
+from encoding import RawJSON, media_codec
 
 from dictshield.base import ShieldException
+from dictshield.fields.compound import EmbeddedDocumentField, ListField
 
 import ujson as json
+import base64
+import logging
 
 
-class AutoAPIBase(JSONMessageHandler):
+###
+### Serializers
+###
+
+_serializers = dict()
+
+
+def _embeds_documents(field):
+    if isinstance(field, EmbeddedDocumentField):
+        return True
+    if isinstance(field, ListField):
+        return any(_embeds_documents(f) for f in field.fields)
+    return False
+
+
+def _ownersafe_fields(model):
+    """Returns (name, field) pairs for the fields `make_json_ownersafe`
+    keeps, leaving out internal and private fields.
+    """
+    hidden = model._get_internal_fields()
+    return [(name, field) for (name, field) in model._fields.items()
+            if name not in hidden and field.uniq_field not in hidden]
+
+
+def _compile_serializer(model):
+    """Looks up the visible fields of `model`, with their defaults and
+    converters, and returns a function that turns a stored dict into the dict
+    `make_json_ownersafe` gives for it. Models with embedded documents or
+    minimized field names get None and keep going through model instances.
+    """
+    plan = list()
+    for (name, field) in _ownersafe_fields(model):
+        if field.minimized_field_name or _embeds_documents(field):
+            return None
+        plan.append((name, field.uniq_field, field.default,
+                     callable(field.default), field.for_json))
+
+    def serializer(datum):
+        data = dict()
+        for (name, key, default, call_default, for_json) in plan:
+            value = datum.get(name)
+            if value is None:
+                value = default() if call_default else default
+            if value is not None:
+                data[key] = for_json(value)
+        data['id'] = str(datum.get('_id', datum.get('id')))
+        return data
+
+    return serializer
+
+
+def serializer_for(model):
+    """Returns the compiled serializer for `model`, compiling it the first
+    time, or None if the model can't have one.
+    """
+    if model not in _serializers:
+        _serializers[model] = _compile_serializer(model)
+    return _serializers[model]
+
+
+class AutoAPIBase(JSONMessageHandler, StreamedHandlerMixin):
     """AutoAPIBase generates a JSON REST API for you. *high five!*
     I also read this link for help in propertly defining the behavior of HTTP
     PUT and POST: http://stackoverflow.com/questions/630453/put-vs-post-in-rest
+
+    Listing a collection returns everything at once unless `page_size` is set
+    or the client sends a `count` or `cursor` argument. Paged responses carry
+    an opaque `cursor` to send back for the next page, which is null after the
+    last one.
+
+    Fields named in `filter_fields` can filter listings through the query
+    string, eg. `?owner_username=jd` or `?created_at__gte=1330000000000`. The
+    filters are passed to the queryset's `read_where`, which returns at most
+    `count` matches.
+
+    `?fields=title,completed` limits the documents in a response to those
+    fields and their id. Reads by id ask the queryset for just those fields.
+
+    With `stream_listings` set, listing the whole collection streams it out
+    as it is read through the queryset's `iter_all`, a page at a time, rather
+    than building the response in memory. The response is then always a 200
+    and each item carries its own status.
+
+    POSTing `application/x-ndjson`, one document per line, imports the
+    documents as the body is read. Each line is validated on its own, valid
+    documents are written `ingest_batch_size` at a time with `create_many`,
+    and a status for every line is streamed back as the batches are written.
+
+    Reads by id use the queryset's `read_rendered`, so documents stored with
+    their public form already rendered, as `RedisQueryset(rendered=True)`
+    does, go into the response without being decoded.
+
+    If the queryset keeps a `time_field`, `?since=<milliseconds>` lists the
+    items newer than that through `read_since`, oldest first and at most
+    `count` of them.
     """
     
     model = None
     queries = None
 
+    page_size = None
+    max_page_size = 100
+    filter_fields = ()
+    stream_listings = False
+    ingest_batch_size = 500
+
     _PAYLOAD_DATA = 'data'
+    _PAYLOAD_CURSOR = 'cursor'
+    _NDJSON = 'application/x-ndjson'
+
+    _projection = None
+
+    @classmethod
+    def compile_serializer(cls):
+        """Compiles the serializer for `model` ahead of the first request.
+        `Brubeck.register_api` calls this.
+        """
+        return serializer_for(cls.model)
 
     ###
     ### Input Handling
@@ -22,20 +135,70 @@ class AutoAPIBase(JSONMessageHandler):
 
     def _get_body_as_data(self):
         """Returns the body data based on the content_type requested by the
-        client.
+        client, which may be JSON or msgpack. Other bodies are looked for as
+        JSON in the `data` argument.
         """
-        ### Locate body data by content type
-        if self.message.content_type == 'application/json':
-            body = self.message.body
-        else:
-            body = self.get_argument('data')
+        ### Decode bodies of the types responses can be sent in
+        if media_codec(self.message.content_type) is not None:
+            return self.decode_body()
 
-        ### Load found JSON into Python structure
+        ### Load JSON from the form into Python structure
+        body = self.get_argument('data')
         if body:
             body = json.loads(body)
 
         return body
 
+    def _encode_cursor(self, cursor):
+        """Wraps a queryset's cursor into a token that is safe for URLs.
+        """
+        if cursor is None:
+            return None
+        return base64.urlsafe_b64encode(json.dumps(cursor))
+
+    def _decode_cursor(self, token):
+        """Reverses `_encode_cursor`. Raises ValueError for bad tokens.
+        """
+        if not token:
+            return None
+        try:
+            return json.loads(base64.urlsafe_b64decode(str(token)))
+        except (TypeError, ValueError):
+            raise ValueError('Invalid cursor: %s' % token)
+
+    def _get_filters(self):
+        """Returns the `read_where` criteria found in the query string, with
+        values converted by the model's fields. Raises ShieldException for
+        values that don't validate and ValueError for unknown operators.
+        """
+        criteria = dict()
+        for name in self.message.arguments:
+            (field, sep, op) = name.partition('__')
+            if field in self.filter_fields:
+                if op and op not in self.queries.WHERE_OPERATORS:
+                    raise ValueError('Unknown operator: %s' % name)
+                value = self.get_argument(name)
+                criteria[name] = self.model._fields[field].validate(value)
+        return criteria
+
+    def _get_projection(self):
+        """Returns the list of fields asked for with the `fields` argument,
+        or None for whole documents. Raises ValueError for fields that aren't
+        in the model's owner-safe set, which leaves out internal and private
+        fields.
+        """
+        fields = self.get_argument('fields')
+        if not fields:
+            return None
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+        visible = set(name for (name, field) in _ownersafe_fields(self.model))
+        for field in fields:
+            if field in ('id', '_id'):
+                continue
+            if field not in visible:
+                raise ValueError('Unknown field: %s' % field)
+        return fields
+
     def _convert_to_id(self, datum):
         """`datum` in this function is an id that needs to be validated and
         converted to it's native type.
@@ -118,9 +281,22 @@ class AutoAPIBase(JSONMessageHandler):
         """This function takes either a model instance or a dictionary
         representation of some model and returns a dictionary one safe for
         transmitting as payload.
+
+        Dicts are converted by the model's compiled serializer when it has
+        one, which skips building a model instance for each item. `RawJSON`
+        is already in its public form.
         """
+        if self._projection is not None:
+            return self._make_projection(datum)
+
+        if isinstance(datum, RawJSON):
+            return datum
+
         if isinstance(datum, dict):
-            iid = str(datum.get('_id'))
+            serializer = serializer_for(self.model)
+            if serializer is not None:
+                return serializer(datum)
+            iid = str(datum.get('_id', datum.get('id')))
             instance = self.model(**datum).to_json(encode=False)
         else:
             iid = str(datum.id)
@@ -131,13 +307,32 @@ class AutoAPIBase(JSONMessageHandler):
 
         return data
 
+    def _make_projection(self, datum):
+        """Like `_make_presentable`, but only converts the fields in
+        `_projection`, skipping the model instance altogether.
+        """
+        if isinstance(datum, RawJSON):
+            datum = datum.decode()
+        elif not isinstance(datum, dict):
+            datum = datum.to_python()
+        data = dict()
+        for field in self._projection:
+            value = datum.get(field)
+            if value is not None and field in self.model._fields:
+                data[field] = self.model._fields[field].for_json(value)
+        data['id'] = str(datum.get('_id', datum.get('id')))
+        return data
+
     def _add_status(self, datum, status_code):
         """Passed a status tuples of the form (status code, processed model),
         it generates the status structure to carry info about the processing.
         """
-        datum[self._STATUS_CODE] = status_code
         status_msg = self._response_codes.get(status_code,
                                               str(status_code))
+        if isinstance(datum, RawJSON):
+            return datum.with_fields({self._STATUS_CODE: status_code,
+                                      self._STATUS_MSG: status_msg})
+        datum[self._STATUS_CODE] = status_code
         datum[self._STATUS_MSG] = status_msg
         return datum
 
@@ -229,20 +424,105 @@ class AutoAPIBase(JSONMessageHandler):
     ### For URLs we handle 0 IDs, 1 ID, and N IDs. Zero, One, Infinity.
     ### For data we handle 0 datums, 1 datum and N datums. ZOI, again.
     ###
-    ### Paging and authentication will be offered soon.
+    ### Authentication will be offered soon.
+
+    def _wants_page(self):
+        return bool(self.page_size or self.get_argument('count') or
+                    self.get_argument('cursor'))
+
+    def _get_page(self):
+        """Reads one page of the collection, as requested by the `cursor` and
+        `count` arguments.
+        """
+        default_count = self.page_size or self.max_page_size
+        (page, count, skip) = self.get_paging_arguments(
+            default_count=default_count, max_count=self.max_page_size)
+        if count < 1:
+            return self.render(status_code=self._FAILED_CODE)
+
+        try:
+            cursor = self._decode_cursor(self.get_argument('cursor'))
+        except ValueError:
+            return self.render(status_code=self._FAILED_CODE)
+
+        (cursor, statuses) = self.queries.read_page(cursor=cursor,
+                                                    limit=count)
+        self.add_to_payload(self._PAYLOAD_CURSOR, self._encode_cursor(cursor))
+        return self._generate_response(statuses)
+
+    def _get_where(self, criteria):
+        """Reads the items matching the filters in `criteria`, at most
+        `count` of them.
+        """
+        default_count = self.page_size or self.max_page_size
+        (page, count, skip) = self.get_paging_arguments(
+            default_count=default_count, max_count=self.max_page_size)
+        if count < 1:
+            return self.render(status_code=self._FAILED_CODE)
+        statuses = self.queries.read_where(limit=count, **criteria)
+        return self._generate_response(statuses)
+
+    def _get_since(self):
+        """Reads the items added to the stream after the `since` argument.
+        """
+        since = self.get_stream_offset()
+        default_count = self.page_size or self.max_page_size
+        (page, count, skip) = self.get_paging_arguments(
+            default_count=default_count, max_count=self.max_page_size)
+        if count < 1:
+            return self.render(status_code=self._FAILED_CODE)
+        statuses = self.queries.read_since(since, limit=count)
+        return self._generate_response(statuses)
+
+    def _get_stream(self):
+        """Streams every item in the collection.
+        """
+        def items():
+            for crud_datum in self.queries.iter_all(
+                    page_size=self.max_page_size):
+                yield self._parse_crud_datum(crud_datum)[1]
+
+        self.add_to_payload(self._PAYLOAD_DATA, items())
+        return self.render(status_code=self._SUCCESS_CODE)
+
+    def _read(self, ids):
+        if self._projection is None:
+            return self.queries.read_rendered(ids)
+        return self.queries.read(ids, fields=self._projection)
 
     def get(self, ids=""):
         """HTTP GET implementation.
 
         IDs:
-          * 0 IDs: produces a list of items presented. Paging will be available
-            soon.
+          * 0 IDs: produces a list of items presented, one page at a time if
+            paging is used.
           * 1 ID: This produces the corresponding document.
           * N IDs: This produces a list of corresponding documents.
 
         Data: N/A
         """
-        
+        try:
+            self._projection = self._get_projection()
+        except ValueError:
+            return self.render(status_code=self._FAILED_CODE)
+
+        if not ids and self.filter_fields:
+            try:
+                criteria = self._get_filters()
+            except (ShieldException, ValueError):
+                return self.render(status_code=self._FAILED_CODE)
+            if criteria:
+                return self._get_where(criteria)
+
+        if not ids and self.queries.time_field and self.get_argument('since'):
+            return self._get_since()
+
+        if not ids and self._wants_page():
+            return self._get_page()
+
+        if not ids and self.stream_listings:
+            return self._get_stream()
+
         try:
             ### Setup environment
             is_list = isinstance(ids, list)
@@ -261,10 +541,10 @@ class AutoAPIBase(JSONMessageHandler):
                         valid_ids.append(idd)
                     else:
                         error_ids.append(idd)
-                models = self.queries.read(valid_ids)
+                models = self._read(valid_ids)
                 response_data = models
             else:
-                datum_tuple = self.queries.read(data)
+                datum_tuple = self._read(data)
                 response_data = datum_tuple
             # Handle status update
             return self._generate_response(response_data)
@@ -272,6 +552,79 @@ class AutoAPIBase(JSONMessageHandler):
         except FourOhFourException:
             return self.render(status_code=self._NOT_FOUND)
         
+    def _ingest_status(self, line_number, status_code, shield=None,
+                       error=None):
+        data = {'line': line_number}
+        if shield is not None:
+            data['id'] = str(shield.id)
+        if error is not None:
+            data['error'] = str(error)
+        return self._add_status(data, status_code)
+
+    def _ingest(self, lines):
+        """Validates each line of NDJSON and creates the valid documents in
+        batches. Yields a status for each line, in order, once the batch it
+        belongs to is written. Blank lines are skipped, and a line the
+        queryset gives no status for is reported as a server error.
+        """
+        waiting = list()  # (line number, shield or status) since last write
+        batch = list()
+
+        def write():
+            (statuses, failure) = (iter(()), None)
+            if batch:
+                try:
+                    statuses = iter(list(self.queries.create_many(batch)))
+                except Exception, e:
+                    logging.error(e, exc_info=True)
+                    failure = e
+            for (line_number, item) in waiting:
+                if isinstance(item, dict):
+                    yield item
+                elif failure is not None:
+                    yield self._ingest_status(line_number, self._SERVER_ERROR,
+                                              item, failure)
+                else:
+                    answer = next(statuses, None)
+                    if answer is None:
+                        yield self._ingest_status(line_number,
+                                                  self._SERVER_ERROR, item,
+                                                  'No status was returned')
+                        continue
+                    (crud_status, datum) = answer
+                    yield self._ingest_status(line_number,
+                                              self._crud_to_http(crud_status),
+                                              item)
+            del waiting[:]
+            del batch[:]
+
+        for (n, line) in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                (valid, shield) = self._convert_to_model(json.loads(line))
+            except ValueError, e:
+                (valid, shield) = (False, e)
+            if valid:
+                waiting.append((n + 1, shield))
+                batch.append(shield)
+            else:
+                waiting.append((n + 1, self._ingest_status(
+                    n + 1, self._FAILED_CODE, error=shield)))
+            ### Invalid lines count towards the batch size too, and go out
+            ### straight away when no valid line is ahead of them
+            if not batch or len(waiting) >= self.ingest_batch_size:
+                for status in write():
+                    yield status
+        if waiting:
+            for status in write():
+                yield status
+
+    def _post_ndjson(self):
+        self.add_to_payload(self._PAYLOAD_DATA,
+                            self._ingest(self.message.iter_body_lines()))
+        return self.render(status_code=self._SUCCESS_CODE)
+
     def post(self, ids=""):
         """HTTP POST implementation.
 
@@ -287,7 +640,12 @@ class AutoAPIBase(JSONMessageHandler):
           * 0 Data: This case isn't useful so it throws an error.
           * 1 Data: Writes a single document to queryset.
           * N Datas: Attempts to write each document to queryset.
+          * NDJSON: Imports the documents a batch at a time.
         """
+        content_type = self.message.content_type or ''
+        if not ids and content_type.startswith(self._NDJSON):
+            return self._post_ndjson()
+
         body_data = self._get_body_as_data()
         is_list = isinstance(body_data, list)
 
@@ -353,6 +711,64 @@ class AutoAPIBase(JSONMessageHandler):
         crud_statuses = self.queries.update(data)
         return self._generate_response(crud_statuses)
 
+    def _convert_to_changes(self, body_data):
+        """Checks a dict of field changes against the model. Returns a
+        boolean and the changes, or the reason they were refused.
+        """
+        if not isinstance(body_data, dict) or not body_data:
+            return (False, ValueError('PATCH needs a dict of changes'))
+        for field in body_data:
+            if field not in self.model._fields or field in ('id', '_id'):
+                return (False, ValueError('Unknown field: %s' % field))
+        try:
+            self.model.validate_class_partial(dict(body_data))
+            return (True, body_data)
+        except Exception, e:
+            return (False, e)
+
+    def patch(self, ids=""):
+        """HTTP PATCH implementation.
+
+        PATCH changes some fields of documents that already exist. The body
+        is a dict of fields to their new values, which are validated on their
+        own and handed to the queryset's `update_fields`. Fields that aren't
+        in the body are left alone.
+
+        IDs:
+          * 0 IDs: Returns a 400 error
+          * 1 ID: Applies the changes to a single document
+          * N IDs: Applies the same changes to each document, or returns a
+            404 without changing any if one of them is missing
+
+        Data:
+          * 0 Data: Returns a 400 error
+          * 1 Data: A dict of changes
+          * N Datas: Returns a 400 error
+        """
+        body_data = self._get_body_as_data()
+        (valid, changes) = self._convert_to_changes(body_data)
+
+        if not valid or not ids:
+            return self.render(status_code=self._FAILED_CODE)
+
+        items = ids.split(self.application.MULTIPLE_ITEM_SEP)
+
+        ### Check every id first, so a missing one doesn't leave the rest
+        ### half written
+        if len(items) > 1:
+            for (crud_status, datum) in self.queries.read_many(items):
+                if crud_status == self.queries.MSG_FAILED:
+                    return self.render(status_code=self._NOT_FOUND)
+
+        crud_statuses = [self.queries.update_fields(iid, changes)
+                         for iid in items]
+        for (crud_status, datum) in crud_statuses:
+            if crud_status == self.queries.MSG_FAILED:
+                return self.render(status_code=self._NOT_FOUND)
+        if len(crud_statuses) == 1:
+            crud_statuses = crud_statuses[0]
+        return self._generate_response(crud_statuses)
+
     def delete(self, ids=""):
         """HTTP DELETE implementation.
 
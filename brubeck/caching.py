@@ -1,7 +1,17 @@
 import os
+import sys
 import time
+import math
+import heapq
+import mmap
+import fcntl
+import struct
+import hashlib
+from collections import OrderedDict
 from exceptions import NotImplementedError
 
+from encoding import PickleCodec
+
 
 ###
 ### Sessions are basically caches
@@ -13,6 +23,126 @@ def generate_session_id():
     return os.urandom(32).encode('hex')
 
 
+class Session(dict):
+    """A dictionary that remembers whether it has been changed, so it is only
+    written back to its cache store when it needs to be.
+
+    Changes made inside mutable values, eg. appending to a list stored in the
+    session, can't be seen. Call `mark_dirty()` after those.
+    """
+    def __init__(self, session_id, data=None, is_new=False):
+        super(Session, self).__init__(data or {})
+        self.session_id = session_id
+        self.is_new = is_new
+        self.dirty = False
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def __setitem__(self, key, value):
+        self.dirty = True
+        super(Session, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.dirty = True
+        super(Session, self).__delitem__(key)
+
+    def clear(self):
+        self.dirty = True
+        super(Session, self).clear()
+
+    def update(self, *args, **kwargs):
+        self.dirty = True
+        super(Session, self).update(*args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.dirty = True
+        return super(Session, self).setdefault(key, default)
+
+    def pop(self, key, *args):
+        if key in self:
+            self.dirty = True
+        return super(Session, self).pop(key, *args)
+
+    def popitem(self):
+        self.dirty = True
+        return super(Session, self).popitem()
+
+
+class SessionMixin(object):
+    """Gives a `WebMessageHandler` a `session` that is stored in a cache store
+    and found again through a cookie. Put it before the handler class when
+    subclassing, so its `render` runs first.
+
+    The session is loaded the first time `self.session` is used. When the
+    response is rendered, a changed session is saved to `session_store` and a
+    new one also sets the cookie. An unchanged session is only touched, to
+    push its expiration `session_ttl` seconds forward, and handlers that never
+    use the session don't talk to the store at all.
+
+    The cookie is signed when the application has a `cookie_secret`. Stores
+    that keep strings, like `RedisCacheStore`, need a codec for sessions.
+    """
+    session_store = None
+    session_cookie = 'session_id'
+    session_ttl = 3600
+    session_sliding = True
+
+    @property
+    def session(self):
+        if not hasattr(self, '_session'):
+            self._session = self.load_session()
+        return self._session
+
+    def load_session(self):
+        """Returns the session named by the request's cookie or a new one.
+        """
+        secret = self.application.cookie_secret
+        session_id = self.get_cookie(self.session_cookie, secret=secret)
+        if session_id:
+            data = self.session_store.load(session_id)
+            if data is not None:
+                return Session(session_id, data)
+        return Session(generate_session_id(), is_new=True)
+
+    def save_session(self):
+        """Writes the session back if it changed, or touches it otherwise.
+        """
+        if not hasattr(self, '_session'):
+            return
+
+        session = self._session
+        expire = time.time() + self.session_ttl
+        if session.dirty:
+            self.session_store.save(session.session_id, dict(session),
+                                    expire=expire)
+            if session.is_new:
+                ### A cookie deleted by `delete_session` would keep its past
+                ### expiry, so the new one starts from a fresh morsel
+                self.cookies.pop(self.session_cookie, None)
+                self.set_cookie(self.session_cookie, session.session_id,
+                                secret=self.application.cookie_secret,
+                                path='/')
+            session.dirty = False
+            session.is_new = False
+        elif self.session_sliding and not session.is_new:
+            self.session_store.touch(session.session_id, expire)
+
+    def delete_session(self):
+        """Removes the session from storage and tells the client to forget it.
+        """
+        session = self.session
+        if not session.is_new:
+            self.session_store.delete(session.session_id)
+            self.delete_cookie(self.session_cookie, path='/')
+        self._session = Session(generate_session_id(), is_new=True)
+
+    def render(self, *args, **kwargs):
+        self.save_session()
+        return super(SessionMixin, self).render(*args, **kwargs)
+
+
 ###
 ### Cache storage
 ###
@@ -20,10 +150,24 @@ def generate_session_id():
 class BaseCacheStore(object):
     """Ram based cache storage. Essentially uses a dictionary stored in
     the app to store cache id => serialized cache data
+
+    A codec from `brubeck.encoding` can be passed as `codec` to store values in
+    serialized form. Without one, values are stored as they are given.
     """
-    def __init__(self, **kwargs):
+    def __init__(self, codec=None, **kwargs):
         super(BaseCacheStore, self).__init__(**kwargs)
         self._cache_store = dict()
+        self.codec = codec
+
+    def _encode(self, data):
+        if self.codec is None or data is None:
+            return data
+        return self.codec.encode(data)
+
+    def _decode(self, data):
+        if self.codec is None or data is None:
+            return data
+        return self.codec.decode(data)
 
     def save(self, key, data, expire=None):
         """Save the cache data and metadata to the backend storage
@@ -31,11 +175,24 @@ class BaseCacheStore(object):
         save set dirty to False.
         """
         cache_item = {
-            'data': data,
+            'data': self._encode(data),
             'expire': expire,
         }
         self._cache_store[key] = cache_item
 
+    def save_many(self, mapping, expire=None):
+        """Saves every key and value in the dict `mapping` with the same
+        `expire` time.
+        """
+        for key, data in mapping.iteritems():
+            self.save(key, data, expire=expire)
+
+    def touch(self, key, expire):
+        """Moves the expire time of `key` without rewriting its data.
+        """
+        if key in self._cache_store:
+            self._cache_store[key]['expire'] = expire
+
     def load(self, key):
         """Load the stored data from storage backend or return None if the
         session was not found. Stale cookies are treated as empty.
@@ -46,26 +203,171 @@ class BaseCacheStore(object):
 
                 # It's an in memory cache, so we must manage
                 if not data.get('expire', None) or data['expire'] > time.time():
-                    return data['data']
+                    return self._decode(data['data'])
             return None
         except:
             return None
 
+    def load_many(self, keys):
+        """Returns a list with the data for each key in `keys`, in the same
+        order, using None for keys that were not found.
+        """
+        return [self.load(key) for key in keys]
+
     def delete(self, key):
         """Remove all data for the `key` from storage.
         """
         if key in self._cache_store:
             del self._cache_store[key]
 
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
     def delete_expired(self):
         """Deletes sessions with timestamps in the past from storage.
         """
+        now = time.time()
         del_keys = list()
         for key, data in self._cache_store.items():
-            if data.get('expire', None) and data['expire'] < time.time():
+            if data.get('expire', None) and data['expire'] < now:
                 del_keys.append(key)
         map(self.delete, del_keys)
 
+
+###
+### Bounded Cache Store
+###
+
+class LRUCacheStore(BaseCacheStore):
+    """Ram based cache storage with an upper bound on its size. Long running
+    processes can keep sessions and cache entries here without leaking memory.
+
+    The least recently used entries are evicted once there are more than
+    `max_entries` of them or once their approximate size exceeds `max_bytes`.
+    Either limit can be disabled with `None`.
+
+    Expiration times are kept in a heap, so expired entries are removed a few
+    at a time as the cache is used instead of with a scan over every key.
+
+    `sizeof` is called with each value to approximate its size in bytes. Strings
+    are measured by length and everything else by `sys.getsizeof`.
+    """
+    def __init__(self, max_entries=10000, max_bytes=None, sizeof=None,
+                 **kwargs):
+        super(LRUCacheStore, self).__init__(**kwargs)
+        self._cache_store = OrderedDict()
+        self._expire_heap = list()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or self._sizeof
+        self.size_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _sizeof(data):
+        if isinstance(data, basestring):
+            return len(data)
+        return sys.getsizeof(data)
+
+    def _remove(self, key):
+        cache_item = self._cache_store.pop(key)
+        self.size_bytes -= cache_item['size']
+        return cache_item
+
+    def _expire_due(self, now):
+        """Pops every heap entry that is due. Entries that were overwritten or
+        deleted since they were pushed no longer match and are skipped.
+        """
+        heap = self._expire_heap
+        while heap and heap[0][0] <= now:
+            (expire, key) = heapq.heappop(heap)
+            cache_item = self._cache_store.get(key)
+            if cache_item is not None and cache_item['expire'] == expire:
+                self._remove(key)
+                self.expirations += 1
+
+        # Overwrites leave stale entries behind. Rebuild before they pile up.
+        if len(heap) > 2 * len(self._cache_store) + 64:
+            self._expire_heap = [(item['expire'], key)
+                                 for key, item in self._cache_store.iteritems()
+                                 if item['expire']]
+            heapq.heapify(self._expire_heap)
+
+    def _evict_overflow(self):
+        while self._cache_store and (
+            (self.max_entries is not None and
+             len(self._cache_store) > self.max_entries) or
+            (self.max_bytes is not None and self.size_bytes > self.max_bytes)):
+            (key, cache_item) = self._cache_store.popitem(last=False)
+            self.size_bytes -= cache_item['size']
+            self.evictions += 1
+
+    def save(self, key, data, expire=None):
+        self._expire_due(time.time())
+
+        if key in self._cache_store:
+            self._remove(key)
+
+        data = self._encode(data)
+        cache_item = {
+            'data': data,
+            'expire': expire,
+            'size': self.sizeof(data),
+        }
+        self._cache_store[key] = cache_item
+        self.size_bytes += cache_item['size']
+        if expire:
+            heapq.heappush(self._expire_heap, (expire, key))
+
+        self._evict_overflow()
+
+    def touch(self, key, expire):
+        self._expire_due(time.time())
+        cache_item = self._cache_store.get(key)
+        if cache_item is not None:
+            cache_item['expire'] = expire
+            if expire:
+                heapq.heappush(self._expire_heap, (expire, key))
+
+    def load(self, key):
+        """Returns the data stored for `key` and marks it as recently used, or
+        None if it is missing or expired.
+        """
+        self._expire_due(time.time())
+
+        cache_item = self._cache_store.pop(key, None)
+        if cache_item is None:
+            self.misses += 1
+            return None
+
+        self._cache_store[key] = cache_item  # move to most recently used
+        self.hits += 1
+        return self._decode(cache_item['data'])
+
+    def delete(self, key):
+        if key in self._cache_store:
+            self._remove(key)
+
+    def delete_expired(self):
+        self._expire_due(time.time())
+
+    def stats(self):
+        """Returns the counters and current size of the cache as a dict.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'entries': len(self._cache_store),
+            'bytes': self.size_bytes,
+        }
+
 ###
 ### Redis Cache Store
 ###
@@ -93,17 +395,32 @@ class RedisCacheStore(BaseCacheStore):
         super(RedisCacheStore, self).__init__(**kwargs)
         self._cache_store = redis_connection
 
+    def _set(self, conn, key, data, expire):
+        """Issues a single SET, or SETEX when there is an expire time, on
+        either the connection or a pipeline.
+        """
+        data = self._encode(data)
+        if expire:
+            expire_seconds = expire - time.time()
+            assert(expire_seconds > 0)
+            ### SETEX wants whole seconds and refuses 0
+            expire_seconds = max(1, int(math.ceil(expire_seconds)))
+            conn.setex(name=key, time=expire_seconds, value=data)
+        else:
+            conn.set(key, data)
+
     def save(self, key, data, expire=None):
         """expire will be a Unix timestamp
         from time.time() + <value> which is 
         a value in seconds."""
+        self._set(self._cache_store, key, data, expire)
 
-        pipe = self._cache_store.pipeline()
-        pipe.set(key, data)
-        if expire:
-            expire_seconds = expire - time.time()
-            assert(expire_seconds > 0)
-            pipe.expire(key, int(expire_seconds))
+    def save_many(self, mapping, expire=None):
+        """Sends a SET or SETEX for every key in one pipeline.
+        """
+        pipe = self._cache_store.pipeline(transaction=False)
+        for key, data in mapping.iteritems():
+            self._set(pipe, key, data, expire)
         pipe.execute()
         
     def load(self, key):
@@ -111,10 +428,396 @@ class RedisCacheStore(BaseCacheStore):
         does not exist or has expired, `hget` will
         return None"""
 
-        return self._cache_store.get(key)
+        return self._decode(self._cache_store.get(key))
+
+    def load_many(self, keys):
+        """Reads every key with a single MGET.
+        """
+        if not keys:
+            return list()
+        return map(self._decode, self._cache_store.mget(keys))
+
+    def touch(self, key, expire):
+        """Moves the expiration with EXPIREAT, which takes the timestamp.
+        """
+        self._cache_store.expireat(key, int(expire))
     
     def delete(self, key):
         self._cache_store.delete(key)
+
+    def delete_many(self, keys):
+        if keys:
+            self._cache_store.delete(*keys)
         
     def delete_expired(self):
         raise NotImplementedError
+
+
+###
+### Shared Memory Cache Store
+###
+
+class SharedMemoryCacheStore(BaseCacheStore):
+    """Cache storage in a memory mapped file, so every worker process on a
+    host shares one cache instead of keeping its own copy of hot data.
+
+    The file holds a hash table of `num_slots` fixed size slots. A key hashes
+    to a window of `ways` neighbouring slots and a new entry replaces, in
+    order of preference, an empty slot, an expired slot or the least recently
+    used slot in that window. Entries that don't fit in `slot_size` bytes,
+    including the key and a small header, are not cached.
+
+    Reads take no locks. Each slot has a version that is odd while the slot is
+    being written, and a read is retried if the version was odd or changed
+    while it was reading. Writers serialize on an `flock` of the file.
+
+    Values are stored with `codec`, which defaults to pickle.
+    """
+    # version, key hash, expire, last used, key length, value length
+    _SLOT_HEADER = struct.Struct('<IQddHI')
+    _VERSION = struct.Struct('<I')
+    _USED = struct.Struct('<d')
+    _USED_OFFSET = 20
+    _READ_RETRIES = 8
+
+    def __init__(self, path, num_slots=4096, slot_size=1024, ways=4,
+                 codec=None, **kwargs):
+        super(SharedMemoryCacheStore, self).__init__(
+            codec=codec or PickleCodec(), **kwargs)
+        self.path = path
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self.ways = min(ways, num_slots)
+
+        size = num_slots * slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._cache_store = mmap.mmap(self._fd, size)
+
+    def close(self):
+        self._cache_store.close()
+        os.close(self._fd)
+
+    ###
+    ### Slot handling
+    ###
+
+    def _hash(self, key):
+        key_hash = struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+        return key_hash or 1  # 0 marks an empty slot
+
+    def _window(self, key_hash):
+        first = key_hash % self.num_slots
+        return [((first + i) % self.num_slots) * self.slot_size
+                for i in xrange(self.ways)]
+
+    def _read_slot(self, offset, key_hash, key):
+        """Returns (expire, value) if the slot at `offset` holds `key`, else
+        None. Never blocks on writers.
+        """
+        mm = self._cache_store
+        for attempt in xrange(self._READ_RETRIES):
+            (version, slot_hash, expire, used, key_len, value_len) = \
+                self._SLOT_HEADER.unpack_from(mm, offset)
+            if version % 2:
+                continue  # being written
+            if slot_hash != key_hash:
+                return None
+            body = offset + self._SLOT_HEADER.size
+            slot_key = mm[body:body + key_len]
+            value = mm[body + key_len:body + key_len + value_len]
+            if self._VERSION.unpack_from(mm, offset)[0] != version:
+                continue  # changed while reading
+            if slot_key != key:
+                return None
+            return (expire, value)
+        return None
+
+    def _write_slot(self, offset, key_hash, expire, key, value):
+        """Writes an entry with the version made odd for the duration. The
+        caller must hold the lock.
+        """
+        mm = self._cache_store
+        version = self._VERSION.unpack_from(mm, offset)[0]
+        writing = (version + 1) & 0xffffffff
+        self._VERSION.pack_into(mm, offset, writing)
+        self._SLOT_HEADER.pack_into(mm, offset, writing, key_hash, expire or 0,
+                                    time.time(), len(key), len(value))
+        body = offset + self._SLOT_HEADER.size
+        mm[body:body + len(key) + len(value)] = key + value
+        self._VERSION.pack_into(mm, offset, (writing + 1) & 0xffffffff)
+
+    def _find_slot(self, key_hash, key):
+        """Picks the slot for writing `key`. The caller must hold the lock.
+        """
+        now = time.time()
+        victim = None
+        victim_rank = None
+        for offset in self._window(key_hash):
+            (version, slot_hash, expire, used, key_len, value_len) = \
+                self._SLOT_HEADER.unpack_from(self._cache_store, offset)
+            if slot_hash == key_hash and \
+                   self._read_slot(offset, key_hash, key) is not None:
+                return offset
+            if slot_hash == 0:
+                rank = (0, 0)
+            elif expire and expire <= now:
+                rank = (1, expire)
+            else:
+                rank = (2, used)
+            if victim_rank is None or rank < victim_rank:
+                (victim, victim_rank) = (offset, rank)
+        return victim
+
+    def _lock(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    ###
+    ### Cache store interface
+    ###
+
+    def save(self, key, data, expire=None):
+        key = str(key)
+        value = self._encode(data)
+        if self._SLOT_HEADER.size + len(key) + len(value) > self.slot_size:
+            self.delete(key)  # don't leave an older value behind
+            return
+        key_hash = self._hash(key)
+        self._lock()
+        try:
+            offset = self._find_slot(key_hash, key)
+            self._write_slot(offset, key_hash, expire, key, value)
+        finally:
+            self._unlock()
+
+    def load(self, key):
+        key = str(key)
+        key_hash = self._hash(key)
+        for offset in self._window(key_hash):
+            found = self._read_slot(offset, key_hash, key)
+            if found is not None:
+                (expire, value) = found
+                if expire and expire <= time.time():
+                    return None
+                # Recency is a hint for eviction, so no lock is needed
+                self._USED.pack_into(self._cache_store,
+                                     offset + self._USED_OFFSET, time.time())
+                return self._decode(value)
+        return None
+
+    def touch(self, key, expire):
+        key = str(key)
+        key_hash = self._hash(key)
+        self._lock()
+        try:
+            for offset in self._window(key_hash):
+                found = self._read_slot(offset, key_hash, key)
+                if found is not None:
+                    self._write_slot(offset, key_hash, expire, key, found[1])
+                    return
+        finally:
+            self._unlock()
+
+    def _clear_slot(self, offset):
+        self._write_slot(offset, 0, 0, '', '')
+
+    def delete(self, key):
+        key = str(key)
+        key_hash = self._hash(key)
+        self._lock()
+        try:
+            for offset in self._window(key_hash):
+                if self._read_slot(offset, key_hash, key) is not None:
+                    self._clear_slot(offset)
+        finally:
+            self._unlock()
+
+    def delete_expired(self):
+        """Clears every expired slot. This scans the whole file.
+        """
+        now = time.time()
+        self._lock()
+        try:
+            for slot in xrange(self.num_slots):
+                offset = slot * self.slot_size
+                (version, slot_hash, expire, used, key_len, value_len) = \
+                    self._SLOT_HEADER.unpack_from(self._cache_store, offset)
+                if slot_hash and expire and expire <= now:
+                    self._clear_slot(offset)
+        finally:
+            self._unlock()
+
+
+###
+### Tiered Cache Store
+###
+
+_MISSING = object()  # marks negatively cached keys in the L1
+
+
+class TieredCacheStore(BaseCacheStore):
+    """Puts a small, bounded, in-process cache in front of any other cache
+    store so hot keys are read from memory instead of the network.
+
+    Entries stay in the L1 for at most `l1_ttl` seconds, or until the expire
+    time they were saved with if that comes first. Keys the backing store does
+    not have are remembered as missing for `negative_ttl` seconds, if set.
+
+    Writes from other workers are seen through an `invalidator`, either a
+    `RedisCacheInvalidator` or a `BusCacheInvalidator`. Call `start()` with the
+    application to begin listening for invalidations.
+    """
+    def __init__(self, backing_store, l1_store=None, l1_ttl=5,
+                 negative_ttl=None, invalidator=None, **kwargs):
+        super(TieredCacheStore, self).__init__(**kwargs)
+        self.backing_store = backing_store
+        self.l1_store = l1_store or LRUCacheStore(max_entries=1000)
+        self.l1_ttl = l1_ttl
+        self.negative_ttl = negative_ttl
+        self.invalidator = invalidator
+
+    def start(self, application):
+        if self.invalidator is not None:
+            self.invalidator.start(application, self.invalidate)
+
+    def _l1_expire(self, expire=None):
+        l1_expire = time.time() + self.l1_ttl
+        if expire and expire < l1_expire:
+            return expire
+        return l1_expire
+
+    def _publish(self, key):
+        if self.invalidator is not None:
+            self.invalidator.publish(key)
+
+    def invalidate(self, key):
+        """Drops `key` from the L1 only. Called for writes in other workers.
+        """
+        self.l1_store.delete(key)
+
+    def save(self, key, data, expire=None):
+        self.backing_store.save(key, data, expire=expire)
+        self._publish(key)
+        self.l1_store.save(key, data, expire=self._l1_expire(expire))
+
+    def save_many(self, mapping, expire=None):
+        self.backing_store.save_many(mapping, expire=expire)
+        l1_expire = self._l1_expire(expire)
+        for key, data in mapping.iteritems():
+            self._publish(key)
+            self.l1_store.save(key, data, expire=l1_expire)
+
+    def load(self, key):
+        data = self.l1_store.load(key)
+        if data is _MISSING:
+            return None
+        elif data is not None:
+            return data
+
+        data = self.backing_store.load(key)
+        if data is not None:
+            self.l1_store.save(key, data, expire=self._l1_expire())
+        elif self.negative_ttl:
+            expire = time.time() + self.negative_ttl
+            self.l1_store.save(key, _MISSING, expire=expire)
+        return data
+
+    def load_many(self, keys):
+        """Reads every key from the L1 first and asks the backing store for
+        the rest in a single `load_many` call.
+        """
+        found = dict()
+        missed = list()
+        for key in keys:
+            data = self.l1_store.load(key)
+            if data is None:
+                missed.append(key)
+            elif data is not _MISSING:
+                found[key] = data
+
+        if missed:
+            l1_expire = self._l1_expire()
+            negative_expire = time.time() + (self.negative_ttl or 0)
+            loaded = self.backing_store.load_many(missed)
+            for key, data in zip(missed, loaded):
+                if data is not None:
+                    found[key] = data
+                    self.l1_store.save(key, data, expire=l1_expire)
+                elif self.negative_ttl:
+                    self.l1_store.save(key, _MISSING, expire=negative_expire)
+
+        return [found.get(key) for key in keys]
+
+    def touch(self, key, expire):
+        self.backing_store.touch(key, expire)
+
+    def delete(self, key):
+        self.backing_store.delete(key)
+        self._publish(key)
+        self.l1_store.delete(key)
+
+    def delete_many(self, keys):
+        self.backing_store.delete_many(keys)
+        for key in keys:
+            self._publish(key)
+            self.l1_store.delete(key)
+
+    def delete_expired(self):
+        self.l1_store.delete_expired()
+        self.backing_store.delete_expired()
+
+
+###
+### Cache invalidation between workers
+###
+
+class RedisCacheInvalidator(object):
+    """Sends the keys written by one worker to every other worker over a Redis
+    pub/sub `channel`. Each worker ignores the keys it sent itself.
+    """
+    def __init__(self, redis_connection, channel='brubeck:invalidate'):
+        self.redis_connection = redis_connection
+        self.channel = channel
+        self.node_id = generate_session_id()
+
+    def publish(self, key):
+        message = '%s %s' % (self.node_id, key)
+        self.redis_connection.publish(self.channel, message)
+
+    def _handle(self, data, callback):
+        (origin, key) = data.split(' ', 1)
+        if origin != self.node_id:
+            callback(key)
+
+    def listen(self, callback):
+        """Blocks while calling `callback(key)` for keys from other workers.
+        """
+        pubsub = self.redis_connection.pubsub()
+        pubsub.subscribe(self.channel)
+        for message in pubsub.listen():
+            if message['type'] == 'message':
+                self._handle(message['data'], callback)
+
+    def start(self, application, callback):
+        application.pool.spawn(self.listen, callback)
+
+
+class BusCacheInvalidator(RedisCacheInvalidator):
+    """Same as `RedisCacheInvalidator` but carried by a
+    `connections.BroadcastBus`, for deployments without Redis.
+    """
+    def __init__(self, bus, channel='brubeck:invalidate'):
+        self.bus = bus
+        self.channel = channel
+        self.node_id = generate_session_id()
+
+    def publish(self, key):
+        self.bus.publish(self.channel, '%s %s' % (self.node_id, key))
+
+    def start(self, application, callback):
+        listener = lambda channel, data: self._handle(data, callback)
+        self.bus.add_listener(self.channel, listener)
@@ -6,7 +6,9 @@ import logging
 import Cookie
 
 from request import to_bytes, to_unicode, parse_netstring, Request
-from request_handling import http_response, coro_spawn
+from encoding import is_stream
+from request_handling import (http_response, http_response_head,
+                              http_chunk, buffered, coro_spawn)
 
 
 ###
@@ -98,7 +100,11 @@ def load_zmq():
     if not hasattr(load_zmq, '_zmq'):
         from request_handling import CORO_LIBRARY
         if CORO_LIBRARY == 'gevent':
-            from gevent_zeromq import zmq
+            try:
+                from gevent_zeromq import zmq
+            except ImportError:
+                # pyzmq ships gevent_zeromq's successor as zmq.green
+                from zmq import green as zmq
         elif CORO_LIBRARY == 'eventlet':
             from eventlet.green import zmq
         load_zmq._zmq = zmq
@@ -165,11 +171,37 @@ class Mongrel2Connection(Connection):
         handler = application.route_message(request)
         result = handler()
 
+        # Handlers that return nothing have parked the request, eg. a long
+        # poll waiting on a `BroadcastBus` channel, and will reply later.
+        if not result:
+            return
+
+        if is_stream(result['body']):
+            return self.reply_stream(request, result)
+
         http_content = http_response(result['body'], result['status_code'],
                                      result['status_msg'], result['headers'])
 
         application.msg_conn.reply(request, http_content)
 
+    def reply_stream(self, request, result):
+        """Sends a response whose body is an iterable of strings with chunked
+        transfer encoding, as the body is produced. If producing it fails
+        halfway, the connection is closed without the final chunk so the
+        client sees the response is incomplete.
+        """
+        self.reply(request, http_response_head(result['status_code'],
+                                               result['status_msg'],
+                                               result['headers']))
+        try:
+            for data in buffered(result['body']):
+                self.reply(request, http_chunk(data))
+        except Exception, e:
+            logging.error(e, exc_info=True)
+            self.reply(request, '')
+            return
+        self.reply(request, http_chunk(''))
+
     def recv(self):
         """Receives a raw mongrel2.handler.Request object that you from the
         zeromq socket and return whatever is found.
@@ -220,6 +252,157 @@ class Mongrel2Connection(Connection):
         self.reply_bulk(uuid, idents, "")
 
 
+###
+### Cluster broadcast
+###
+
+class BroadcastBus(object):
+    """A `BroadcastBus` carries channel messages between Brubeck processes
+    over a zeromq PUB/SUB pair, so an event published in one worker reaches
+    long-poll clients parked in any other worker. No broker is involved.
+
+    Each worker binds a PUB socket on `pub_addr` and connects its SUB socket
+    to the `pub_addr` of every peer in `peer_addrs`. It is fine for a worker's
+    own address to be in that list; a worker ignores its own messages because
+    they have already been delivered locally.
+
+    Clients are parked with `subscribe()` and receive the next message
+    published on that channel once, through the connection's `reply_bulk`.
+    Callables registered with `add_listener()` are called with the message
+    for every publish on their channel instead.
+
+    Messages should be complete HTTP responses, eg. the output of
+    `http_response()`, because they are sent to clients as-is.
+    """
+
+    def __init__(self, msg_conn, pub_addr, peer_addrs=None):
+        zmq = load_zmq()
+        ctx = load_zmq_ctx()
+
+        self.msg_conn = msg_conn
+        self.node_id = uuid4().hex
+
+        self.pub_sock = ctx.socket(zmq.PUB)
+        self.pub_sock.bind(pub_addr)
+        self.sub_sock = ctx.socket(zmq.SUB)
+        for addr in peer_addrs or []:
+            self.sub_sock.connect(addr)
+
+        self._subscribers = dict()  # channel => {sender uuid => conn ids}
+        self._listeners = dict()    # channel => [callables]
+
+    ###
+    ### Channel membership
+    ###
+
+    def _watch(self, channel):
+        """Filters for `channel` on the SUB socket the first time anything
+        local becomes interested in it.
+        """
+        if channel not in self._subscribers and channel not in self._listeners:
+            zmq = load_zmq()
+            self.sub_sock.setsockopt(zmq.SUBSCRIBE, channel)
+
+    def _unwatch(self, channel):
+        """Drops the SUB socket filter once nothing local needs `channel`.
+        """
+        if channel not in self._subscribers and channel not in self._listeners:
+            zmq = load_zmq()
+            self.sub_sock.setsockopt(zmq.UNSUBSCRIBE, channel)
+
+    def subscribe(self, channel, request):
+        """Parks the client that sent `request` on `channel`.
+        """
+        channel = to_bytes(channel)
+        self._watch(channel)
+        senders = self._subscribers.setdefault(channel, dict())
+        senders.setdefault(request.sender, set()).add(str(request.conn_id))
+
+    def unsubscribe(self, channel, request):
+        """Forgets a parked client, eg. after Mongrel2 reports a disconnect.
+        """
+        channel = to_bytes(channel)
+        senders = self._subscribers.get(channel, {})
+        conn_ids = senders.get(request.sender, set())
+        conn_ids.discard(str(request.conn_id))
+        if not conn_ids:
+            senders.pop(request.sender, None)
+        if not senders and channel in self._subscribers:
+            del self._subscribers[channel]
+            self._unwatch(channel)
+
+    def add_listener(self, channel, callback):
+        """Calls `callback(channel, data)` for every message on `channel`.
+        """
+        channel = to_bytes(channel)
+        self._watch(channel)
+        self._listeners.setdefault(channel, list()).append(callback)
+
+    def remove_listener(self, channel, callback):
+        channel = to_bytes(channel)
+        listeners = self._listeners.get(channel, [])
+        if callback in listeners:
+            listeners.remove(callback)
+        if not listeners and channel in self._listeners:
+            del self._listeners[channel]
+            self._unwatch(channel)
+
+    ###
+    ### Message flow
+    ###
+
+    def publish(self, channel, data):
+        """Delivers `data` to local subscribers and sends it to every peer.
+        """
+        channel = to_bytes(channel)
+        data = to_bytes(data)
+        self.deliver(channel, data)
+        self.pub_sock.send_multipart([channel, self.node_id, data])
+
+    def deliver(self, channel, data):
+        """Sends `data` to every client parked on `channel` in this worker,
+        using as few `reply_bulk` calls as `MAX_IDENTS` allows.
+        """
+        for callback in list(self._listeners.get(channel, [])):
+            callback(channel, data)
+
+        senders = self._subscribers.pop(channel, None)
+        if senders is None:
+            return
+        if channel not in self._listeners:
+            self._unwatch(channel)
+
+        max_idents = getattr(self.msg_conn, 'MAX_IDENTS', 100)
+        for uuid, conn_ids in senders.items():
+            conn_ids = list(conn_ids)
+            for i in xrange(0, len(conn_ids), max_idents):
+                idents = conn_ids[i:i + max_idents]
+                self.msg_conn.reply_bulk(uuid, idents, data)
+
+    def recv(self):
+        """Receives one message from a peer and delivers it locally. Returns
+        False for messages this worker published itself.
+        """
+        (channel, origin, data) = self.sub_sock.recv_multipart()
+        if origin == self.node_id:
+            return False
+        self.deliver(channel, data)
+        return True
+
+    def recv_forever_ever(self):
+        while True:
+            self.recv()
+
+    def start(self, application):
+        """Runs the receiving loop on the application's coroutine pool.
+        """
+        application.pool.spawn(self.recv_forever_ever)
+
+    def close(self):
+        self.pub_sock.close()
+        self.sub_sock.close()
+
+
 ###
 ### WSGI 
 ###
@@ -241,6 +424,9 @@ class WSGIConnection(Connection):
         headers = [(k, v) for k,v in result['headers'].items()]
         callback(str(wsgi_status), headers)
 
+        # Streamed bodies go to the server a buffer at a time
+        if is_stream(result['body']):
+            return buffered(result['body'])
         return [to_bytes(result['body'])]
 
     def recv_forever_ever(self, application):
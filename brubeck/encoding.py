@@ -0,0 +1,334 @@
+"""Codecs turn Python values into strings for storage and back again. Each
+codec offers the same two functions, `encode()` and `decode()`, so storage
+classes can be handed whichever one suits the data they keep.
+
+`TaggedCodec` prefixes each value with a byte naming the codec that wrote it,
+so values written by different codecs can be read side by side.
+"""
+
+import cPickle as pickle
+import zlib
+
+import ujson as json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+###
+### Codecs
+###
+
+class PickleCodec(object):
+    """Handles any picklable value. Only use it for data Brubeck wrote itself.
+    """
+    def encode(self, value):
+        return pickle.dumps(value, -1)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class JSONCodec(object):
+    """Handles anything JSON can represent.
+    """
+    def encode(self, value):
+        return json.dumps(value)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec(object):
+    """Like JSON, but smaller and faster. Requires the msgpack package.
+    """
+    def __init__(self):
+        if msgpack is None:
+            raise EnvironmentError('You need to install msgpack')
+
+    def encode(self, value):
+        return msgpack.packb(value)
+
+    def decode(self, data):
+        return msgpack.unpackb(data)
+
+
+class ZlibCodec(object):
+    """Compresses the output of another codec with zlib at `level`.
+    """
+    def __init__(self, codec, level=1):
+        self.codec = codec
+        self.level = level
+
+    def encode(self, value):
+        return zlib.compress(self.codec.encode(value), self.level)
+
+    def decode(self, data):
+        return self.codec.decode(zlib.decompress(data))
+
+
+###
+### Tagged Codecs
+###
+
+TAG_JSON = '\x01'
+TAG_MSGPACK = '\x02'
+TAG_ZLIB_JSON = '\x03'
+TAG_ZLIB_MSGPACK = '\x04'
+
+### Builds the codec for each tag, given the zlib level to write with. The tags
+### can't be mistaken for the first byte of JSON, msgpack, pickle or zlib data.
+TAGGED_CODECS = {
+    TAG_JSON: lambda level: JSONCodec(),
+    TAG_MSGPACK: lambda level: MsgpackCodec(),
+    TAG_ZLIB_JSON: lambda level: ZlibCodec(JSONCodec(), level),
+    TAG_ZLIB_MSGPACK: lambda level: ZlibCodec(MsgpackCodec(), level),
+}
+
+
+class LegacyJSONCodec(JSONCodec):
+    """Reads untagged JSON whether or not it was compressed with zlib, as
+    `RedisQueryset` stored it before codecs existed. zlib data always starts
+    with 'x' and JSON never does.
+    """
+    def decode(self, data):
+        if data[:1] == 'x':
+            data = zlib.decompress(data)
+        return json.loads(data)
+
+
+class TaggedCodec(object):
+    """Encodes with the codec registered for `tag` in `TAGGED_CODECS`, using
+    zlib `level` where it applies, and decodes anything that carries a known
+    tag. Untagged data is handed to the `legacy` codec, if there is one, which
+    lets a store switch codecs without rewriting what it holds.
+
+        TaggedCodec(TAG_ZLIB_MSGPACK, level=6, legacy=LegacyJSONCodec())
+    """
+    def __init__(self, tag=TAG_JSON, level=1, legacy=None):
+        if tag not in TAGGED_CODECS:
+            raise ValueError('Unknown codec tag: %r' % tag)
+        self.tag = tag
+        self.level = level
+        self.legacy = legacy
+        self._codecs = {tag: TAGGED_CODECS[tag](level)}
+
+    def _codec(self, tag):
+        if tag not in self._codecs:
+            self._codecs[tag] = TAGGED_CODECS[tag](self.level)
+        return self._codecs[tag]
+
+    def encode(self, value):
+        return self.tag + self._codecs[self.tag].encode(value)
+
+    def decode(self, data):
+        tag = data[:1]
+        if tag in TAGGED_CODECS:
+            return self._codec(tag).decode(data[1:])
+        elif self.legacy is not None:
+            return self.legacy.decode(data)
+        raise ValueError('Unknown codec tag: %r' % tag)
+
+
+###
+### Raw JSON
+###
+
+class RawJSON(object):
+    """A fragment of JSON text, like a document that was stored already
+    rendered. `encode_json` copies it into its output as it is, which saves
+    decoding and encoding it again.
+    """
+    __slots__ = ('json',)
+
+    def __init__(self, text):
+        self.json = text
+
+    def __eq__(self, other):
+        return isinstance(other, RawJSON) and self.json == other.json
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'RawJSON(%r)' % self.json
+
+    def decode(self):
+        return json.loads(self.json)
+
+    def with_fields(self, fields):
+        """Returns a fragment of this JSON object with the keys in `fields`
+        added, still without decoding it.
+        """
+        body = self.json.strip()
+        if body[:1] != '{' or body[-1:] != '}':
+            raise ValueError('Fields can only be added to a JSON object')
+        body = body[1:-1].strip()
+        extra = json.dumps(fields)[1:-1]
+        if body and extra:
+            return RawJSON('{%s,%s}' % (body, extra))
+        return RawJSON('{%s}' % (body or extra))
+
+
+def has_raw_json(value):
+    """Tells whether `value` is a `RawJSON` fragment or a list holding one.
+    """
+    if isinstance(value, RawJSON):
+        return True
+    if isinstance(value, list):
+        for item in value:
+            if isinstance(item, RawJSON):
+                return True
+    return False
+
+
+def encode_json(value):
+    """Encodes `value` like `json.dumps`, but copies `RawJSON` fragments
+    into the output as they are.
+    """
+    if isinstance(value, RawJSON):
+        return value.json
+    if isinstance(value, dict):
+        return '{%s}' % ','.join(
+            '%s:%s' % (json.dumps(key if isinstance(key, basestring)
+                                  else str(key)), encode_json(item))
+            for (key, item) in value.items())
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ','.join(encode_json(item) for item in value)
+    return json.dumps(value)
+
+
+###
+### Streamed JSON
+###
+
+def is_stream(value):
+    """Tells whether `value` is an iterator, like a generator, that
+    `iter_json` writes out as it goes.
+    """
+    return hasattr(value, 'next') and not isinstance(value, basestring)
+
+
+def iter_json(value):
+    """Encodes `value` like `encode_json`, but yields the JSON a piece at a
+    time. Iterators inside dicts become arrays whose items are encoded as
+    they are consumed, so a long list never sits in memory all at once.
+    """
+    if isinstance(value, dict):
+        yield '{'
+        separator = ''
+        for (key, item) in value.items():
+            yield '%s%s:' % (separator,
+                             json.dumps(key if isinstance(key, basestring)
+                                        else str(key)))
+            for piece in iter_json(item):
+                yield piece
+            separator = ','
+        yield '}'
+    elif is_stream(value):
+        yield '['
+        separator = ''
+        for item in value:
+            yield separator + encode_json(item)
+            separator = ','
+        yield ']'
+    else:
+        yield encode_json(value)
+
+
+###
+### Media Types
+###
+
+MEDIA_TYPE_JSON = 'application/json'
+MEDIA_TYPE_MSGPACK = 'application/x-msgpack'
+
+### Codecs for the media types requests and responses can be encoded with
+MEDIA_CODECS = {
+    MEDIA_TYPE_JSON: JSONCodec,
+    MEDIA_TYPE_MSGPACK: MsgpackCodec,
+    'application/msgpack': MsgpackCodec,
+}
+
+
+def media_codec(media_type):
+    """Returns a codec for `media_type`, ignoring parameters like `charset`,
+    or None if the type is unknown or its codec can't be used here.
+    """
+    media_type = (media_type or '').split(';')[0].strip().lower()
+    if media_type not in MEDIA_CODECS:
+        return None
+    try:
+        return MEDIA_CODECS[media_type]()
+    except EnvironmentError:
+        return None
+
+
+def parse_accept(accept):
+    """Returns a list of (value, quality) pairs from an Accept header, or
+    one like it such as Accept-Encoding.
+    """
+    ranges = list()
+    for part in accept.split(','):
+        params = part.split(';')
+        media_range = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            (name, sep, value) = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_range:
+            ranges.append((media_range, quality))
+    return ranges
+
+
+def negotiate(accept, offered):
+    """Picks the media type from `offered` that the Accept header `accept`
+    likes best, with the order of `offered` settling ties. The most specific
+    media range decides each type's quality. Returns the first offered type
+    if the header is missing or accepts none of them.
+    """
+    if not accept:
+        return offered[0]
+    ranges = parse_accept(accept)
+
+    def quality(media_type):
+        wildcard = media_type.split('/')[0] + '/*'
+        (specificity, best) = (-1, 0.0)
+        for (media_range, q) in ranges:
+            if media_range == media_type:
+                matched = 2
+            elif media_range == wildcard:
+                matched = 1
+            elif media_range == '*/*':
+                matched = 0
+            else:
+                continue
+            if matched > specificity:
+                (specificity, best) = (matched, q)
+        return best
+
+    (q, position, media_type) = max((quality(media_type), -n, media_type)
+                                    for (n, media_type) in enumerate(offered))
+    if q <= 0:
+        return offered[0]
+    return media_type
+
+
+def decode_raw_json(value):
+    """Returns `value` with any `RawJSON` fragments in it decoded, for codecs
+    that can't splice JSON.
+    """
+    if isinstance(value, RawJSON):
+        return value.decode()
+    if isinstance(value, dict):
+        return dict((key, decode_raw_json(item))
+                    for (key, item) in value.items())
+    if isinstance(value, (list, tuple)):
+        return [decode_raw_json(item) for item in value]
+    return value
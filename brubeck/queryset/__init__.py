@@ -1,4 +1,8 @@
-from brubeck.queryset.base import AbstractQueryset
+from brubeck.queryset.base import AbstractQueryset, ProxyQueryset
 from brubeck.queryset.dict import DictQueryset
-from brubeck.queryset.redis import RedisQueryset
-
+from brubeck.queryset.redis import RedisQueryset, RedisHashQueryset
+from brubeck.queryset.batching import BatchingQueryset
+from brubeck.queryset.cached import CachedQueryset
+from brubeck.queryset.sqlite import SQLiteQueryset
+from brubeck.queryset.sharded import ShardedQueryset
+from brubeck.queryset.writebehind import WriteBehindQueryset
@@ -26,16 +26,32 @@ class AbstractQueryset(object):
     MSG_NOTFOUND = 'Not Found'
     MSG_FAILED = 'Failed'
 
-    def __init__(self, db_conn=None, api_id='id'):
+    INDEX_HASH = 'hash'
+    INDEX_SORTED = 'sorted'
+
+    ### Comparisons understood by `read_where`, eg. `created_at__gte=...`
+    WHERE_OPERATORS = {
+        'eq': lambda a, b: a == b,
+        'gt': lambda a, b: a > b,
+        'gte': lambda a, b: a >= b,
+        'lt': lambda a, b: a < b,
+        'lte': lambda a, b: a <= b,
+    }
+
+    def __init__(self, db_conn=None, api_id='id', time_field=None):
+        """`time_field` names a numeric field, like the `created_at` or
+        `updated_at` of `StreamedModelMixin`, that the queryset keeps a time
+        index on for `read_since`.
+        """
         self.db_conn = db_conn
         self.api_id = api_id
+        self.time_field = time_field
 
     ###
     ### CRUD Operations
     ###
 
     ### Section TODO:
-    ### * Pagination
     ### * Hook in authentication
     ### * Key filtering (owner / public)
     ### * Make model instantiation an option
@@ -48,9 +64,12 @@ class AbstractQueryset(object):
         else:
             return self.create_one(shields)
 
-    def read(self, ids):
-        """Returns a list of items that match ids
+    def read(self, ids, fields=None):
+        """Returns a list of items that match ids. If `fields` is given, the
+        items only carry those fields and their ids.
         """
+        if fields is not None:
+            return self.read_fields(ids, fields)
         if not ids:
             return self.read_all()
         elif isinstance(ids, list):
@@ -101,6 +120,94 @@ class AbstractQueryset(object):
         """
         raise NotImplementedError
 
+    def read_fields(self, ids, fields):
+        """Reads like `read` but keeps only `fields` of each object, plus
+        its id. Querysets that can fetch fewer fields from storage override
+        this.
+        """
+        statuses = self.read(ids)
+        if isinstance(statuses, tuple):
+            return self._project(statuses, fields)
+        return [self._project(status, fields) for status in statuses]
+
+    def read_rendered(self, ids):
+        """Reads like `read`, but items may come back as `RawJSON` holding
+        the public form of the item, ready to be sent as it is. Querysets
+        that store such a form override this.
+        """
+        return self.read(ids)
+
+    def _project(self, status, fields):
+        (crud_status, datum) = status
+        if not isinstance(datum, dict):
+            return status
+        keep = set(fields) | set(['_id', 'id', self.api_id])
+        return (crud_status,
+                dict((k, v) for (k, v) in datum.items() if k in keep))
+
+    def read_where(self, limit=None, **criteria):
+        """Returns a list of objects whose fields match every criteria. A
+        criteria is either `field=value` or `field__op=value`, where `op` is
+        one of `WHERE_OPERATORS`.
+
+        With a `limit`, at most that many objects are returned. It must be
+        at least 1, like the limit of `read_page`.
+        """
+        raise NotImplementedError
+
+    def _parse_criteria(self, criteria):
+        """Splits `read_where` keywords into (field, op, value) triples.
+        """
+        parsed = list()
+        for (name, value) in criteria.items():
+            (field, sep, op) = name.partition('__')
+            op = op or 'eq'
+            if op not in self.WHERE_OPERATORS:
+                raise ValueError('Unknown operator: %s' % name)
+            parsed.append((field, op, value))
+        return parsed
+
+    def _matches(self, datum, parsed_criteria):
+        for (field, op, value) in parsed_criteria:
+            if field not in datum:
+                return False
+            if not self.WHERE_OPERATORS[op](datum[field], value):
+                return False
+        return True
+
+    def _check_limit(self, limit):
+        """Refuses page sizes that can't make progress through the db.
+        """
+        if limit <= 0:
+            raise ValueError('Page limit must be at least 1: %s' % limit)
+
+    def read_page(self, cursor=None, limit=25):
+        """Returns a two-tuple with a cursor for the next page, or None after
+        the last page, and a list of about `limit` objects from the db.
+
+        Pass None as `cursor` for the first page. Cursors are only meaningful
+        to the queryset that returned them. A `limit` below 1 raises
+        ValueError.
+        """
+        raise NotImplementedError
+
+    def iter_all(self, page_size=100):
+        """Yields every object in the db, one page of reads at a time.
+        """
+        cursor = None
+        while True:
+            (cursor, statuses) = self.read_page(cursor=cursor, limit=page_size)
+            for status in statuses:
+                yield status
+            if cursor is None:
+                break
+
+    def read_since(self, since, limit=None):
+        """Returns up to `limit` objects whose `time_field` is greater than
+        `since`, oldest first. Requires a queryset built with `time_field`.
+        """
+        raise NotImplementedError
+
     ### Update Functions
 
     def update_one(self, shield):
@@ -109,6 +216,13 @@ class AbstractQueryset(object):
     def update_many(self, shields):
         raise NotImplementedError
 
+    def update_fields(self, iid, changes):
+        """Sets the fields in the dict `changes` on the stored item, leaving
+        its other fields alone. Returns the updated item, or a failed status
+        with the id if there is no such item.
+        """
+        raise NotImplementedError
+
     ### Destroy Functions
 
     def destroy_one(self, iid):
@@ -117,3 +231,66 @@ class AbstractQueryset(object):
     def destroy_many(self, ids):
         raise NotImplementedError
 
+
+
+class ProxyQueryset(AbstractQueryset):
+    """Wraps another queryset and passes every CRUD call through to it.
+    Querysets that layer behavior on top of storage, like batching or
+    caching, subclass this and override only the calls they change.
+    """
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self.db_conn = queryset.db_conn
+        self.api_id = queryset.api_id
+        self.time_field = queryset.time_field
+
+    ### Create Functions
+
+    def create_one(self, shield):
+        return self.queryset.create_one(shield)
+
+    def create_many(self, shields):
+        return self.queryset.create_many(shields)
+
+    ### Read Functions
+
+    def read_all(self):
+        return self.queryset.read_all()
+
+    def read_one(self, iid):
+        return self.queryset.read_one(iid)
+
+    def read_many(self, ids):
+        return self.queryset.read_many(ids)
+
+    def read_fields(self, ids, fields):
+        return self.queryset.read_fields(ids, fields)
+
+    def read_where(self, **criteria):
+        return self.queryset.read_where(**criteria)
+
+    def read_page(self, cursor=None, limit=25):
+        return self.queryset.read_page(cursor=cursor, limit=limit)
+
+    def read_since(self, since, limit=None):
+        return self.queryset.read_since(since, limit=limit)
+
+    ### Update Functions
+
+    def update_one(self, shield):
+        return self.queryset.update_one(shield)
+
+    def update_many(self, shields):
+        return self.queryset.update_many(shields)
+
+    def update_fields(self, iid, changes):
+        return self.queryset.update_fields(iid, changes)
+
+    ### Destroy Functions
+
+    def destroy_one(self, iid):
+        return self.queryset.destroy_one(iid)
+
+    def destroy_many(self, ids):
+        return self.queryset.destroy_many(ids)
@@ -0,0 +1,102 @@
+from brubeck.queryset.base import ProxyQueryset
+from brubeck.request_handling import CORO_LIBRARY
+from collections import OrderedDict
+
+### Results are handed from the flushing coroutine to the waiting ones with
+### whichever event primitive the coroutine library offers.
+if CORO_LIBRARY == 'gevent':
+    import gevent
+    from gevent.event import AsyncResult as coro_event
+
+    coro_spawn_later = gevent.spawn_later
+
+    def coro_send(event, value):
+        event.set(value)
+
+    def coro_send_exception(event, e):
+        event.set_exception(e)
+
+    def coro_wait(event):
+        return event.get()
+
+elif CORO_LIBRARY == 'eventlet':
+    import eventlet
+    from eventlet.event import Event as coro_event
+
+    coro_spawn_later = eventlet.spawn_after
+
+    def coro_send(event, value):
+        event.send(value)
+
+    def coro_send_exception(event, e):
+        event.send_exception(e)
+
+    def coro_wait(event):
+        return event.wait()
+
+
+class BatchingQueryset(ProxyQueryset):
+    """Collects the `read_one` calls that concurrent coroutines make within
+    `window` seconds and sends them to the wrapped queryset as a single
+    `read_many`. Each caller blocks until the batch returns and then gets its
+    own status. An id requested twice in one batch is only read once.
+
+    With the default `window` of 0 a batch holds every read issued before the
+    event loop runs again. A batch is sent early once it holds `max_batch`
+    ids.
+
+        queries = BatchingQueryset(RedisQueryset(db_conn=redis_conn))
+    """
+
+    def __init__(self, queryset, window=0, max_batch=None):
+        super(BatchingQueryset, self).__init__(queryset)
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = OrderedDict()  # str(id) => (id, event)
+        self._timer = None
+
+    def read_one(self, iid):
+        key = str(iid)
+        if key in self._pending:
+            event = self._pending[key][1]
+        else:
+            event = coro_event()
+            self._pending[key] = (iid, event)
+            if self.max_batch and len(self._pending) >= self.max_batch:
+                self.flush()
+            elif self._timer is None:
+                self._timer = coro_spawn_later(self.window, self._on_timer)
+        return coro_wait(event)
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush()
+
+    def flush(self):
+        """Sends the pending reads to the wrapped queryset now.
+        """
+        (batch, self._pending) = (self._pending, OrderedDict())
+        if self._timer is not None:
+            self._timer.kill()
+            self._timer = None
+        if not batch:
+            return
+
+        ids = [iid for (iid, event) in batch.values()]
+        try:
+            statuses = self.queryset.read_many(ids)
+        except Exception, e:
+            for (iid, event) in batch.values():
+                coro_send_exception(event, e)
+            return
+
+        waiting = batch.values()
+        statuses = list(statuses)
+        for ((iid, event), (status, datum)) in zip(waiting, statuses):
+            if status == self.MSG_FAILED:
+                datum = iid  # match `read_one`'s answer for missing ids
+            coro_send(event, (status, datum))
+
+        ### A short answer mustn't leave callers waiting forever
+        for (iid, event) in waiting[len(statuses):]:
+            coro_send(event, (self.MSG_FAILED, iid))
@@ -0,0 +1,176 @@
+from brubeck.queryset.base import AbstractQueryset, ProxyQueryset
+import time
+
+### Stands for documents the wrapped queryset doesn't have. Cache entries
+### wrap documents in a list and store missing ones as an empty list, so no
+### document can be mistaken for it and every codec can store them.
+NOT_FOUND = object()
+
+
+def _pack(datum):
+    if datum is NOT_FOUND:
+        return []
+    return [datum]
+
+
+def _unpack(entry):
+    """Returns the cached document, `NOT_FOUND`, or None for a miss.
+    """
+    if entry is None:
+        return None
+    if not entry:
+        return NOT_FOUND
+    return entry[0]
+
+
+class CachedQueryset(ProxyQueryset):
+    """Serves `read_one` and `read_many` from a cache store from
+    `brubeck.caching`, reading through to the wrapped queryset on misses.
+
+    Cached documents live for `ttl` seconds, or forever if it is None. Ids
+    the wrapped queryset can't find are cached as missing for `negative_ttl`
+    seconds, if set.
+
+    Writes go to the wrapped queryset first. With `write_through` the written
+    documents are then read back from it in one `read_many` and replace the
+    cached ones, so cached reads look like uncached ones. Otherwise their
+    cache entries are deleted and the next read fetches them again.
+
+    Give each model its own `key_prefix` when they share a cache store.
+
+        class PostAPI(AutoAPIBase):
+            model = Post
+            queries = CachedQueryset(RedisQueryset(db_conn=redis_conn),
+                                     LRUCacheStore(), ttl=60,
+                                     key_prefix='post:')
+    """
+
+    def __init__(self, queryset, cache_store, ttl=300, negative_ttl=None,
+                 write_through=False, key_prefix=None):
+        super(CachedQueryset, self).__init__(queryset)
+        self.cache_store = cache_store
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.write_through = write_through
+        if key_prefix is None:
+            key_prefix = 'queryset:%s:' % self.api_id
+        self.key_prefix = key_prefix
+
+    def _cache_key(self, iid):
+        return '%s%s' % (self.key_prefix, iid)
+
+    def _expire(self, ttl):
+        if ttl is None:
+            return None
+        return time.time() + ttl
+
+    def _remember(self, ids, statuses):
+        """Caches the documents in `statuses` and, if negative caching is on,
+        the ids that weren't found.
+        """
+        found = dict()
+        missing = dict()
+        for (iid, (status, datum)) in zip(ids, statuses):
+            if status == self.MSG_OK and datum is not None:
+                found[self._cache_key(iid)] = _pack(datum)
+            elif status == self.MSG_FAILED and self.negative_ttl:
+                missing[self._cache_key(iid)] = _pack(NOT_FOUND)
+        if found:
+            self.cache_store.save_many(found, expire=self._expire(self.ttl))
+        if missing:
+            self.cache_store.save_many(missing,
+                                       expire=self._expire(self.negative_ttl))
+
+    def _forget(self, ids):
+        self.cache_store.delete_many([self._cache_key(iid) for iid in ids])
+
+    def _written(self, statuses):
+        """Updates the cache after `statuses` came back from a write.
+        """
+        if not isinstance(statuses, list):
+            statuses = [statuses]
+        ids = [getattr(shield, self.api_id) for (status, shield) in statuses]
+        self._forget(ids)
+        if self.write_through:
+            self._remember(ids, list(self.queryset.read_many(ids)))
+        return statuses
+
+    ### Create Functions
+
+    def create_one(self, shield):
+        return self._written(self.queryset.create_one(shield))[0]
+
+    def create_many(self, shields):
+        return self._written(list(self.queryset.create_many(shields)))
+
+    ### Read Functions
+
+    def read_one(self, iid):
+        datum = _unpack(self.cache_store.load(self._cache_key(iid)))
+        if datum is NOT_FOUND:
+            return (self.MSG_FAILED, iid)
+        elif datum is not None:
+            return (self.MSG_OK, datum)
+
+        status = self.queryset.read_one(iid)
+        self._remember([iid], [status])
+        return status
+
+    def read_fields(self, ids, fields):
+        """Cuts the fields out of cached documents.
+        """
+        return AbstractQueryset.read_fields(self, ids, fields)
+
+    def read_many(self, ids):
+        """Loads every id from the cache in one call and asks the wrapped
+        queryset for the misses with a single `read_many`.
+        """
+        cached = self.cache_store.load_many([self._cache_key(iid)
+                                             for iid in ids])
+        statuses = list()
+        missed = list()
+        for (iid, datum) in zip(ids, map(_unpack, cached)):
+            if datum is NOT_FOUND:
+                statuses.append((self.MSG_FAILED, iid))
+            elif datum is not None:
+                statuses.append((self.MSG_OK, datum))
+            else:
+                statuses.append(None)
+                missed.append(iid)
+
+        if missed:
+            loaded = list(self.queryset.read_many(missed))
+            self._remember(missed, loaded)
+            loaded = iter(loaded)
+            statuses = [status or loaded.next() for status in statuses]
+        return statuses
+
+    ### Update Functions
+
+    def update_one(self, shield):
+        return self._written(self.queryset.update_one(shield))[0]
+
+    def update_many(self, shields):
+        return self._written(list(self.queryset.update_many(shields)))
+
+    def update_fields(self, iid, changes):
+        (status, datum) = self.queryset.update_fields(iid, changes)
+        if self.write_through and status != self.MSG_FAILED:
+            self._remember([iid], [(self.MSG_OK, datum)])
+        else:
+            self._forget([iid])
+        return (status, datum)
+
+    ### Destroy Functions
+
+    def destroy_one(self, iid):
+        try:
+            return self.queryset.destroy_one(iid)
+        finally:
+            self._forget([iid])
+
+    def destroy_many(self, ids):
+        try:
+            return self.queryset.destroy_many(ids)
+        finally:
+            self._forget(ids)
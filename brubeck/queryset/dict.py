@@ -1,26 +1,117 @@
 from brubeck.queryset.base import AbstractQueryset
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
 
 class DictQueryset(AbstractQueryset):
     """This class exists as an example of how one could implement a Queryset.
     This model is an in-memory dictionary and uses the model's id as the key.
 
     The data stored is the result of calling model's `to_python()` function.
+
+    The keys are also kept in a sorted list, which gives `read_page` a stable
+    order to walk through.
+
+    Secondary indexes are declared with `indexes`, a dict that maps field names
+    to `INDEX_HASH`, for equality lookups, or `INDEX_SORTED`, for ranges too.
+    `read_where` uses them instead of scanning every document.
+
+    A `time_field` is kept in a sorted index too, which `read_since` bisects.
     """
-    def __init__(self, **kw):
+    def __init__(self, indexes=None, **kw):
         """Set the db_conn to a dictionary.
         """
         super(DictQueryset, self).__init__(db_conn=dict(), **kw)
+        self._keys = list()
+        self.indexes = dict(indexes or {})
+        if self.time_field:
+            self.indexes[self.time_field] = self.INDEX_SORTED
+        self._hash_indexes = dict()    # field => {value => set of keys}
+        self._sorted_indexes = dict()  # field => (values, keys), in step
+        for (field, kind) in self.indexes.items():
+            if kind == self.INDEX_HASH:
+                self._hash_indexes[field] = dict()
+            elif kind == self.INDEX_SORTED:
+                self._sorted_indexes[field] = (list(), list())
+            else:
+                raise ValueError('Unknown index type: %s' % kind)
+
+    ### Index maintenance
+
+    def _index(self, shield_key, datum):
+        for (field, index) in self._hash_indexes.items():
+            if field in datum:
+                index.setdefault(datum[field], set()).add(shield_key)
+        for (field, (values, keys)) in self._sorted_indexes.items():
+            if field in datum:
+                position = bisect_right(values, datum[field])
+                values.insert(position, datum[field])
+                keys.insert(position, shield_key)
+
+    def _unindex(self, shield_key, datum):
+        for (field, index) in self._hash_indexes.items():
+            if field in datum:
+                matched = index.get(datum[field], set())
+                matched.discard(shield_key)
+                if not matched:
+                    index.pop(datum[field], None)
+        for (field, (values, keys)) in self._sorted_indexes.items():
+            if field in datum:
+                position = bisect_left(values, datum[field])
+                while keys[position] != shield_key:
+                    position += 1
+                del values[position]
+                del keys[position]
+
+    def _sorted_range(self, field, op, value):
+        """Returns the keys, in field order, that satisfy `op` on a sorted
+        index.
+        """
+        (values, keys) = self._sorted_indexes[field]
+        if op == 'eq':
+            return keys[bisect_left(values, value):bisect_right(values, value)]
+        elif op == 'gt':
+            return keys[bisect_right(values, value):]
+        elif op == 'gte':
+            return keys[bisect_left(values, value):]
+        elif op == 'lt':
+            return keys[:bisect_left(values, value)]
+        elif op == 'lte':
+            return keys[:bisect_right(values, value)]
+
+    def _lookup(self, field, op, value):
+        """Returns the set of keys matching one criteria from an index, or
+        None if no index can answer it.
+        """
+        if field in self._hash_indexes and op == 'eq':
+            return set(self._hash_indexes[field].get(value, ()))
+        if field in self._sorted_indexes:
+            return set(self._sorted_range(field, op, value))
+        return None
+
+    def _store(self, shield_key, datum):
+        if shield_key not in self.db_conn:
+            insort(self._keys, shield_key)
+        else:
+            self._unindex(shield_key, self.db_conn[shield_key])
+        self.db_conn[shield_key] = datum
+        self._index(shield_key, datum)
+
+    def _unstore(self, shield_key):
+        datum = self.db_conn.pop(shield_key)
+        del self._keys[bisect_left(self._keys, shield_key)]
+        self._unindex(shield_key, datum)
+        return datum
 
     ### Create Functions
 
     def create_one(self, shield):
-        if shield.id in self.db_conn:
+        shield_key = str(getattr(shield, self.api_id))
+        if shield_key in self.db_conn:
             status = self.MSG_UPDATED
         else:
             status = self.MSG_CREATED
 
-        shield_key = str(getattr(shield, self.api_id))
-        self.db_conn[shield_key] = shield.to_python()
+        self._store(shield_key, shield.to_python())
         return (status, shield)
 
     def create_many(self, shields):
@@ -43,22 +134,87 @@ class DictQueryset(AbstractQueryset):
     def read_many(self, ids):
         return [self.read_one(iid) for iid in ids]
 
+    def read_where(self, limit=None, **criteria):
+        """Narrows the candidates with every index that applies and checks
+        the remaining criteria against those documents only. Results are in
+        key order.
+        """
+        if limit is not None:
+            self._check_limit(limit)
+        candidates = None
+        unindexed = list()
+        for (field, op, value) in self._parse_criteria(criteria):
+            keys = self._lookup(field, op, value)
+            if keys is None:
+                unindexed.append((field, op, value))
+            elif candidates is None:
+                candidates = keys
+            else:
+                candidates &= keys
+
+        if candidates is None:
+            candidates = self._keys
+        else:
+            candidates = sorted(candidates)
+
+        matches = (key for key in candidates
+                   if self._matches(self.db_conn[key], unindexed))
+        if limit is not None:
+            matches = islice(matches, limit)
+        return [(self.MSG_OK, self.db_conn[key]) for key in matches]
+
+    def read_page(self, cursor=None, limit=25):
+        """The cursor is the last key of the previous page, so items created
+        or destroyed between pages don't shift the ones that follow.
+        """
+        self._check_limit(limit)
+        start = 0
+        if cursor is not None:
+            start = bisect_right(self._keys, cursor)
+        page_keys = self._keys[start:start + limit]
+
+        next_cursor = None
+        if start + limit < len(self._keys):
+            next_cursor = page_keys[-1]
+        return (next_cursor,
+                [(self.MSG_OK, self.db_conn[key]) for key in page_keys])
+
+    def read_since(self, since, limit=None):
+        if not self.time_field:
+            raise NotImplementedError('read_since needs a time_field')
+        (values, keys) = self._sorted_indexes[self.time_field]
+        start = bisect_right(values, since)
+        if limit is None:
+            page_keys = keys[start:]
+        else:
+            page_keys = keys[start:start + limit]
+        return [(self.MSG_OK, self.db_conn[key]) for key in page_keys]
+
     ### Update Functions
     def update_one(self, shield):
         shield_key = str(getattr(shield, self.api_id))
-        self.db_conn[shield_key] = shield.to_python()
+        self._store(shield_key, shield.to_python())
         return (self.MSG_UPDATED, shield)
 
     def update_many(self, shields):
         statuses = [self.update_one(shield) for shield in shields]
         return statuses
 
+    def update_fields(self, iid, changes):
+        iid = str(iid)
+        if iid not in self.db_conn:
+            return (self.MSG_FAILED, iid)
+        datum = self.db_conn[iid]
+        self._unindex(iid, datum)
+        datum.update(changes)
+        self._index(iid, datum)
+        return (self.MSG_UPDATED, datum)
+
     ### Destroy Functions
 
     def destroy_one(self, item_id):
         try:
-            datum = self.db_conn[item_id]
-            del self.db_conn[item_id]
+            datum = self._unstore(item_id)
         except KeyError:
             raise FourOhFourException
         return (self.MSG_UPDATED, datum)
@@ -1,4 +1,7 @@
+from __future__ import absolute_import
+
 from brubeck.queryset.base import AbstractQueryset
+from brubeck.encoding import RawJSON
 from itertools import imap
 import ujson as json
 import zlib
@@ -14,35 +17,74 @@ class RedisQueryset(AbstractQueryset):
 
     Redis connection uses the redis-py api located here:
     https://github.com/andymccurdy/redis-py
+
+    Pass a codec from `brubeck.encoding` as `codec` to choose how documents
+    are stored, eg. `TaggedCodec(TAG_ZLIB_MSGPACK, legacy=LegacyJSONCodec())`
+    to move a store from JSON to compressed msgpack as items are rewritten.
+    Without one, documents are stored as JSON, compressed with zlib at
+    `compress_level` if `compress` is set.
+
+    Documents are kept in a hash named by `namespace`, which defaults to
+    `api_id`. Give each model its own namespace, or they all share one hash.
+    With `buckets`, ids are spread by CRC32 over that many hashes named
+    `<namespace>:<bucket>`. Redis stores hashes with fewer than
+    `hash-max-ziplist-entries` (128 by default) small fields in a compact
+    encoding, so aim for about 100 items per bucket. `migrate_hash` moves
+    existing documents into the new layout.
+
+    With a `time_field`, each write also scores the item's key by that field in
+    a sorted set named `<namespace>:<time_field>`, which `read_since` ranges
+    over.
+
+    With `rendered`, each write also stores the document's owner-safe JSON,
+    as `AutoAPIBase` would send it, in a hash named `<hash>:rendered` next to
+    the document's own. `read_rendered` hands it back as `RawJSON` for the
+    response to carry as it is. `update_fields` drops the rendered form, so
+    that document is read in full until it's written again.
     """
     # TODO: - catch connection exceptions?
     #       - set Redis EXPIRE and self.expires
     #       - confirm that the correct status is being returned in 
     #         each circumstance
-    def __init__(self, compress=False, compress_level=1, **kw):
+    def __init__(self, compress=False, compress_level=1, codec=None,
+                 namespace=None, buckets=None, rendered=False, **kw):
         """The Redis connection wiil be passed in **kw and is used below
         as self.db_conn.
         """
         super(RedisQueryset, self).__init__(**kw)
         self.compress = compress
         self.compress_level = compress_level
+        self.codec = codec
+        self.namespace = namespace or self.api_id
+        self.buckets = buckets
+        self.rendered = rendered
         
     def _setvalue(self, shield):
+        if self.codec is not None:
+            return self.codec.encode(shield.to_json(encode=False))
         if self.compress:
             return zlib.compress(shield.to_json(), self.compress_level)
         return shield.to_json()
 
+    def _encode_datum(self, datum):
+        """Encodes a document that is already a dict, like `_setvalue`.
+        """
+        if self.codec is not None:
+            return self.codec.encode(datum)
+        value = json.dumps(datum)
+        if self.compress:
+            return zlib.compress(value, self.compress_level)
+        return value
+
     def _readvalue(self, value):
+        if not value:
+            # value is 0 or None from a Redis return value
+            return None
+        if self.codec is not None:
+            return self.codec.decode(value)
         if self.compress:
-            try:
-                compressed_value = zlib.decompress(value)
-                return json.loads(zlib.decompress(value))
-            except Exception as e:
-                # value is 0 or None from a Redis return value
-                return value
-        if value:
-            return json.loads(value)
-        return None
+            value = zlib.decompress(value)
+        return json.loads(value)
 
     def _message_factory(self, fail_status, success_status):
         """A Redis command often returns some value or 0 after the
@@ -50,12 +92,93 @@ class RedisQueryset(AbstractQueryset):
         """
         return lambda x: success_status if x else fail_status
 
+    def _hash_name(self, shield_key):
+        """Returns the name of the hash that holds `shield_key`.
+        """
+        if not self.buckets:
+            return self.namespace
+        bucket = (zlib.crc32(str(shield_key)) & 0xffffffff) % self.buckets
+        return '%s:%d' % (self.namespace, bucket)
+
+    def _hash_names(self):
+        if not self.buckets:
+            return [self.namespace]
+        return ['%s:%d' % (self.namespace, bucket)
+                for bucket in xrange(self.buckets)]
+
+    def _time_key(self):
+        return '%s:%s' % (self.namespace, self.time_field)
+
+    def _index_times(self, pipe, shields):
+        """Queues the time index updates for `shields` on `pipe`.
+        """
+        if not self.time_field:
+            return
+        scores = dict((str(getattr(shield, self.api_id)),
+                       getattr(shield, self.time_field) or 0)
+                      for shield in shields)
+        if scores:
+            pipe.zadd(self._time_key(), scores)
+
+    def _rendered_name(self, shield_key):
+        return '%s:rendered' % self._hash_name(shield_key)
+
+    def _render(self, shield):
+        """Returns the public form of `shield` as JSON.
+        """
+        data = shield.make_json_ownersafe(shield.to_json(encode=False),
+                                          encode=False)
+        data['id'] = str(shield.id)
+        return json.dumps(data)
+
+    def _store_rendered(self, pipe, shields):
+        """Queues writes of the public forms of `shields` on `pipe`.
+        """
+        if not self.rendered:
+            return
+        for shield in shields:
+            shield_key = str(getattr(shield, self.api_id))
+            pipe.hset(self._rendered_name(shield_key), shield_key,
+                      self._render(shield))
+
+    def _drop_rendered(self, pipe, ids):
+        if not self.rendered:
+            return
+        for shield_id in ids:
+            pipe.hdel(self._rendered_name(shield_id), shield_id)
+
+    def _execute(self, pipe, count):
+        """Executes `pipe`, leaving out the results of time index and
+        rendered form updates.
+        """
+        if self.time_field or self.rendered:
+            return pipe.execute()[:count]
+        return pipe.execute()
+
+    def _hset_indexed(self, shield):
+        """Writes one shield along with its time index entry and rendered
+        form.
+        """
+        pipe = self.db_conn.pipeline()
+        shield_key = str(getattr(shield, self.api_id))
+        pipe.hset(self._hash_name(shield_key), shield_key,
+                  self._setvalue(shield))
+        self._store_rendered(pipe, [shield])
+        self._index_times(pipe, [shield])
+        result = pipe.execute()[0]
+        pipe.reset()
+        return result
+
     ### Create Functions
 
     def create_one(self, shield):
         shield_value = self._setvalue(shield)
         shield_key = str(getattr(shield, self.api_id))        
-        result = self.db_conn.hset(self.api_id, shield_key, shield_value)
+        if self.time_field or self.rendered:
+            result = self._hset_indexed(shield)
+        else:
+            result = self.db_conn.hset(self._hash_name(shield_key), shield_key,
+                                       shield_value)
         if result:
             return (self.MSG_CREATED, shield)
         return (self.MSG_UPDATED, shield)
@@ -64,18 +187,60 @@ class RedisQueryset(AbstractQueryset):
         message_handler = self._message_factory(self.MSG_UPDATED, self.MSG_CREATED)
         pipe = self.db_conn.pipeline()
         for shield in shields:
-            pipe.hset(self.api_id, str(getattr(shield, self.api_id)), self._setvalue(shield))
-        results = zip(imap(message_handler, pipe.execute()), shields)
+            shield_key = str(getattr(shield, self.api_id))
+            pipe.hset(self._hash_name(shield_key), shield_key, self._setvalue(shield))
+        self._store_rendered(pipe, shields)
+        self._index_times(pipe, shields)
+        results = zip(imap(message_handler, self._execute(pipe, len(shields))), shields)
         pipe.reset()
         return results
         
     ### Read Functions
 
     def read_all(self):
-        return [(self.MSG_OK, self._readvalue(datum)) for datum in self.db_conn.hvals(self.api_id)]
+        if not self.buckets:
+            return [(self.MSG_OK, self._readvalue(datum)) for datum in self.db_conn.hvals(self.namespace)]
+        pipe = self.db_conn.pipeline()
+        for hash_name in self._hash_names():
+            pipe.hvals(hash_name)
+        results = pipe.execute()
+        pipe.reset()
+        return [(self.MSG_OK, self._readvalue(datum))
+                for bucket in results for datum in bucket]
+
+    def read_page(self, cursor=None, limit=25):
+        """Walks the hash with HSCAN. Redis treats `limit` as a hint, so a
+        page may hold a few more or fewer items.
+
+        With `buckets`, the cursor is a list of the bucket and the HSCAN cursor
+        within it, and the buckets are walked in order.
+        """
+        self._check_limit(limit)
+        if not self.buckets:
+            (cursor, page) = self.db_conn.hscan(self.namespace,
+                                                cursor=cursor or 0,
+                                                count=limit)
+            statuses = [(self.MSG_OK, self._readvalue(datum))
+                        for datum in page.values()]
+            return (cursor or None, statuses)
+
+        (bucket, scan_cursor) = cursor or (0, 0)
+        statuses = list()
+        while len(statuses) < limit:
+            hash_name = '%s:%d' % (self.namespace, bucket)
+            (scan_cursor, page) = self.db_conn.hscan(hash_name,
+                                                     cursor=scan_cursor,
+                                                     count=limit)
+            statuses.extend((self.MSG_OK, self._readvalue(datum))
+                            for datum in page.values())
+            if not scan_cursor:
+                bucket += 1
+                if bucket >= self.buckets:
+                    return (None, statuses)
+        return ([bucket, scan_cursor], statuses)
 
     def read_one(self, shield_id):
-        result = self.db_conn.hget(self.api_id, shield_id)
+        result = self.db_conn.hget(self._hash_name(shield_id), shield_id)
         if result:
             return (self.MSG_OK, self._readvalue(result))
         return (self.MSG_FAILED, shield_id)
@@ -84,34 +249,126 @@ class RedisQueryset(AbstractQueryset):
         message_handler = self._message_factory(self.MSG_FAILED, self.MSG_OK)
         pipe = self.db_conn.pipeline()
         for shield_id in shield_ids:
-            pipe.hget(self.api_id, str(shield_id))
+            pipe.hget(self._hash_name(shield_id), str(shield_id))
         results = pipe.execute()
         pipe.reset()
         return zip(imap(message_handler, results), map(self._readvalue, results))
 
+    def read_since(self, since, limit=None):
+        """Ranges over the time index with ZRANGEBYSCORE and fetches the
+        matching items with HMGET.
+        """
+        if not self.time_field:
+            raise NotImplementedError('read_since needs a time_field')
+        if limit is None:
+            ids = self.db_conn.zrangebyscore(self._time_key(), '(%s' % since,
+                                             '+inf')
+        else:
+            ids = self.db_conn.zrangebyscore(self._time_key(), '(%s' % since,
+                                             '+inf', start=0, num=limit)
+        if not ids:
+            return []
+        if not self.buckets:
+            results = self.db_conn.hmget(self.namespace, ids)
+        else:
+            pipe = self.db_conn.pipeline()
+            for shield_id in ids:
+                pipe.hget(self._hash_name(shield_id), shield_id)
+            results = pipe.execute()
+            pipe.reset()
+        return [(self.MSG_OK, self._readvalue(datum))
+                for datum in results if datum is not None]
+
+    def read_rendered(self, ids):
+        """Reads the rendered forms of the documents in `ids` as `RawJSON`,
+        falling back to the documents themselves where there isn't one.
+        Listings are read in full.
+        """
+        if not self.rendered or not ids:
+            return self.read(ids)
+        is_list = isinstance(ids, list)
+        shield_ids = [str(shield_id) for shield_id in ids] if is_list \
+                     else [str(ids)]
+
+        pipe = self.db_conn.pipeline()
+        for shield_id in shield_ids:
+            pipe.hget(self._rendered_name(shield_id), shield_id)
+        results = pipe.execute()
+        pipe.reset()
+
+        missing = [shield_id for (shield_id, text) in zip(shield_ids, results)
+                   if text is None]
+        found = dict(zip(missing, self.read_many(missing))) if missing else {}
+        statuses = [(self.MSG_OK, RawJSON(text)) if text is not None
+                    else found[shield_id]
+                    for (shield_id, text) in zip(shield_ids, results)]
+        if is_list:
+            return statuses
+        return statuses[0]
+
     ### Update Functions
 
     def update_one(self, shield):
         shield_key = str(getattr(shield, self.api_id))
         message_handler = self._message_factory(self.MSG_UPDATED, self.MSG_CREATED)
-        status = message_handler(self.db_conn.hset(self.api_id, shield_key, self._setvalue(shield)))
+        if self.time_field or self.rendered:
+            result = self._hset_indexed(shield)
+        else:
+            result = self.db_conn.hset(self._hash_name(shield_key), shield_key,
+                                       self._setvalue(shield))
+        status = message_handler(result)
         return (status, shield)
 
     def update_many(self, shields):
         message_handler = self._message_factory(self.MSG_UPDATED, self.MSG_CREATED)
         pipe = self.db_conn.pipeline()
         for shield in shields:
-            pipe.hset(self.api_id, str(getattr(shield, self.api_id)), self._setvalue(shield))
-        results = pipe.execute()
+            shield_key = str(getattr(shield, self.api_id))
+            pipe.hset(self._hash_name(shield_key), shield_key, self._setvalue(shield))
+        self._store_rendered(pipe, shields)
+        self._index_times(pipe, shields)
+        results = self._execute(pipe, len(shields))
         pipe.reset()
         return zip(imap(message_handler, results), shields)
 
+    def update_fields(self, iid, changes):
+        """Documents are stored whole, so this reads the document, changes
+        it and writes it back. WATCH makes the write fail if the hash changes
+        in between, in which case it starts over.
+        """
+        shield_key = str(iid)
+        hash_name = self._hash_name(shield_key)
+        pipe = self.db_conn.pipeline()
+        try:
+            while True:
+                try:
+                    pipe.watch(hash_name)
+                    datum = self._readvalue(pipe.hget(hash_name, shield_key))
+                    if datum is None:
+                        return (self.MSG_FAILED, iid)
+                    datum.update(changes)
+                    pipe.multi()
+                    pipe.hset(hash_name, shield_key, self._encode_datum(datum))
+                    self._drop_rendered(pipe, [shield_key])
+                    if self.time_field in changes:
+                        pipe.zadd(self._time_key(),
+                                  {shield_key: changes[self.time_field] or 0})
+                    pipe.execute()
+                    return (self.MSG_UPDATED, datum)
+                except redis.WatchError:
+                    continue
+        finally:
+            pipe.reset()
+
     ### Destroy Functions
 
     def destroy_one(self, shield_id):
         pipe = self.db_conn.pipeline()
-        pipe.hget(self.api_id, shield_id)
-        pipe.hdel(self.api_id, shield_id)
+        pipe.hget(self._hash_name(shield_id), shield_id)
+        pipe.hdel(self._hash_name(shield_id), shield_id)
+        self._drop_rendered(pipe, [shield_id])
+        if self.time_field:
+            pipe.zrem(self._time_key(), shield_id)
         result = pipe.execute()
         pipe.reset()
         if result[1]:
@@ -123,11 +380,257 @@ class RedisQueryset(AbstractQueryset):
         message_handler = self._message_factory(self.MSG_FAILED, self.MSG_UPDATED)
         pipe = self.db_conn.pipeline()
         for _id in ids:
-            pipe.hget(self.api_id, _id)
+            pipe.hget(self._hash_name(_id), _id)
         values_results = pipe.execute()
         for _id in ids:
-            pipe.hdel(self.api_id, _id)
-        delete_results = pipe.execute()
+            pipe.hdel(self._hash_name(_id), _id)
+        self._drop_rendered(pipe, ids)
+        if self.time_field and ids:
+            pipe.zrem(self._time_key(), *ids)
+        delete_results = self._execute(pipe, len(ids))
         pipe.reset()
         return zip(imap(message_handler, delete_results), map(self._readvalue, values_results))
 
+
+
+class RedisHashQueryset(RedisQueryset):
+    """Stores each document as a Redis hash of its own, named
+    `<namespace>:<id>`, with one JSON encoded value per field. The ids are
+    kept in a set named `namespace`.
+
+    Because fields are stored separately, `update_fields` writes only the
+    fields that change with a single HMSET. Rendered forms aren't kept.
+    """
+
+    def _document_key(self, shield_key):
+        return '%s:%s' % (self.namespace, shield_key)
+
+    def _hash_names(self):
+        return [self.namespace]
+
+    def _encode_fields(self, datum):
+        return dict((field, json.dumps(value))
+                    for (field, value) in datum.items())
+
+    def _decode_fields(self, fields):
+        if not fields:
+            return None
+        return dict((field, json.loads(value))
+                    for (field, value) in fields.items())
+
+    def _write(self, shields):
+        """Replaces each document and reports whether its id is new.
+        """
+        message_handler = self._message_factory(self.MSG_UPDATED, self.MSG_CREATED)
+        pipe = self.db_conn.pipeline()
+        for shield in shields:
+            shield_key = str(getattr(shield, self.api_id))
+            document_key = self._document_key(shield_key)
+            pipe.delete(document_key)
+            pipe.hset(document_key, mapping=self._encode_fields(
+                shield.to_json(encode=False)))
+            pipe.sadd(self.namespace, shield_key)
+        self._index_times(pipe, shields)
+        results = pipe.execute()
+        pipe.reset()
+        return [(message_handler(results[n * 3 + 2]), shield)
+                for (n, shield) in enumerate(shields)]
+
+    def _read(self, ids):
+        pipe = self.db_conn.pipeline()
+        for shield_id in ids:
+            pipe.hgetall(self._document_key(shield_id))
+        results = pipe.execute()
+        pipe.reset()
+        return [self._decode_fields(fields) for fields in results]
+
+    ### Create Functions
+
+    def create_one(self, shield):
+        return self._write([shield])[0]
+
+    def create_many(self, shields):
+        return self._write(shields)
+
+    ### Read Functions
+
+    def read_all(self):
+        return [(self.MSG_OK, datum) for datum in
+                self._read(self.db_conn.smembers(self.namespace))
+                if datum is not None]
+
+    def read_page(self, cursor=None, limit=25):
+        """Walks the id set with SSCAN.
+        """
+        self._check_limit(limit)
+        (cursor, ids) = self.db_conn.sscan(self.namespace, cursor=cursor or 0,
+                                           count=limit)
+        statuses = [(self.MSG_OK, datum) for datum in self._read(ids)
+                    if datum is not None]
+        return (cursor or None, statuses)
+
+    def read_one(self, shield_id):
+        datum = self._decode_fields(
+            self.db_conn.hgetall(self._document_key(shield_id)))
+        if datum is None:
+            return (self.MSG_FAILED, shield_id)
+        return (self.MSG_OK, datum)
+
+    def read_many(self, shield_ids):
+        return [(self.MSG_OK, datum) if datum is not None
+                else (self.MSG_FAILED, shield_id)
+                for (shield_id, datum) in zip(shield_ids,
+                                              self._read(shield_ids))]
+
+    def read_since(self, since, limit=None):
+        if not self.time_field:
+            raise NotImplementedError('read_since needs a time_field')
+        if limit is None:
+            ids = self.db_conn.zrangebyscore(self._time_key(), '(%s' % since,
+                                             '+inf')
+        else:
+            ids = self.db_conn.zrangebyscore(self._time_key(), '(%s' % since,
+                                             '+inf', start=0, num=limit)
+        return [(self.MSG_OK, datum) for datum in self._read(ids)
+                if datum is not None]
+
+    def read_rendered(self, ids):
+        return self.read(ids)
+
+    def read_fields(self, ids, fields):
+        """Fetches only the ids and `fields` of each document with HMGET.
+        """
+        names = ['_id', 'id'] + [f for f in fields if f not in ('_id', 'id')]
+        if not ids:
+            shield_ids = list(self.db_conn.smembers(self.namespace))
+        elif isinstance(ids, list):
+            shield_ids = ids
+        else:
+            shield_ids = [ids]
+
+        pipe = self.db_conn.pipeline()
+        for shield_id in shield_ids:
+            pipe.hmget(self._document_key(shield_id), names)
+        results = pipe.execute()
+        pipe.reset()
+
+        statuses = list()
+        for (shield_id, values) in zip(shield_ids, results):
+            datum = dict((name, json.loads(value)) for (name, value)
+                         in zip(names, values) if value is not None)
+            if datum:
+                statuses.append((self.MSG_OK, datum))
+            elif ids:
+                # documents destroyed during a full read are just skipped
+                statuses.append((self.MSG_FAILED, shield_id))
+
+        if ids and not isinstance(ids, list):
+            return statuses[0]
+        return statuses
+
+    ### Update Functions
+
+    def update_one(self, shield):
+        return self._write([shield])[0]
+
+    def update_many(self, shields):
+        return self._write(shields)
+
+    def update_fields(self, iid, changes):
+        """Sets the changed fields with HMSET, under WATCH so a document
+        destroyed meanwhile isn't brought back in part.
+        """
+        shield_key = str(iid)
+        document_key = self._document_key(shield_key)
+        pipe = self.db_conn.pipeline()
+        try:
+            while True:
+                try:
+                    pipe.watch(document_key)
+                    if not pipe.exists(document_key):
+                        return (self.MSG_FAILED, iid)
+                    pipe.multi()
+                    if changes:
+                        pipe.hset(document_key,
+                                  mapping=self._encode_fields(changes))
+                    if self.time_field in changes:
+                        pipe.zadd(self._time_key(),
+                                  {shield_key: changes[self.time_field] or 0})
+                    pipe.hgetall(document_key)
+                    results = pipe.execute()
+                    return (self.MSG_UPDATED, self._decode_fields(results[-1]))
+                except redis.WatchError:
+                    continue
+        finally:
+            pipe.reset()
+
+    ### Destroy Functions
+
+    def destroy_one(self, shield_id):
+        (datum, deleted) = self._destroy([shield_id])[0]
+        if deleted:
+            return (self.MSG_UPDATED, datum)
+        return self.MSG_NOTFOUND
+
+    def destroy_many(self, ids):
+        return [(self.MSG_UPDATED if deleted else self.MSG_FAILED, datum)
+                for (datum, deleted) in self._destroy(ids)]
+
+    def _destroy(self, ids):
+        """Deletes the documents and returns what each one held and whether
+        it existed.
+        """
+        pipe = self.db_conn.pipeline()
+        for shield_id in ids:
+            pipe.hgetall(self._document_key(shield_id))
+            pipe.delete(self._document_key(shield_id))
+            pipe.srem(self.namespace, shield_id)
+        if self.time_field and ids:
+            pipe.zrem(self._time_key(), *ids)
+        results = pipe.execute()
+        pipe.reset()
+        return [(self._decode_fields(results[n * 3]), results[n * 3 + 1])
+                for n in range(len(ids))]
+
+
+###
+### Migration
+###
+
+def migrate_hash(queryset, source=None, model=None, batch_size=500,
+                 delete=False):
+    """Copies documents from the hash named `source`, by default the
+    queryset's `api_id`, into the hashes `queryset` uses now and rebuilds its
+    time index. Values are copied as they are, so `queryset` must be able to
+    read what `source` holds.
+
+    Pass a `model` to copy only documents of that class out of a hash shared
+    by several models. With `delete`, copied documents are removed from
+    `source`. Returns the number of documents copied.
+    """
+    source = source or queryset.api_id
+    if source in queryset._hash_names():
+        raise ValueError('%s is already used by the queryset' % source)
+
+    db_conn = queryset.db_conn
+    copied = 0
+    cursor = 0
+    while True:
+        (cursor, page) = db_conn.hscan(source, cursor=cursor, count=batch_size)
+        pipe = db_conn.pipeline()
+        for (shield_key, value) in page.items():
+            if model is not None or queryset.time_field:
+                datum = queryset._readvalue(value)
+                if model is not None and datum.get('_cls') != model._class_name:
+                    continue
+                if queryset.time_field:
+                    score = datum.get(queryset.time_field) or 0
+                    pipe.zadd(queryset._time_key(), {shield_key: score})
+            pipe.hset(queryset._hash_name(shield_key), shield_key, value)
+            if delete:
+                pipe.hdel(source, shield_key)
+            copied += 1
+        pipe.execute()
+        pipe.reset()
+        if not cursor:
+            return copied
@@ -0,0 +1,180 @@
+from brubeck.queryset.base import AbstractQueryset
+from brubeck.request_handling import coro_pool
+from bisect import bisect
+from collections import OrderedDict
+import hashlib
+import struct
+
+
+class ShardedQueryset(AbstractQueryset):
+    """Spreads documents over several querysets, called shards, by placing
+    their ids on a consistent-hash ring. Each shard gets `replicas` points on
+    the ring and an id belongs to the first point after its own hash, so
+    adding a shard only moves the ids that land on the new shard's points.
+
+    `shards` is a dict of names to querysets, or a list of querysets that are
+    named by position. Ring positions come from the names, so keep them stable
+    and only ever append to a list.
+
+    Calls for many ids are split per shard and run at the same time on a
+    coroutine pool, and the statuses come back in the order of the ids. Pass
+    the application's pool as `pool` to share its bound, or a callable that
+    makes one, as `Brubeck` takes.
+
+        queries = ShardedQueryset([RedisQueryset(db_conn=redis_a),
+                                   RedisQueryset(db_conn=redis_b)],
+                                  pool=app.pool)
+    """
+
+    def __init__(self, shards, replicas=100, pool=None, **kw):
+        super(ShardedQueryset, self).__init__(**kw)
+        if not isinstance(shards, dict):
+            shards = OrderedDict((str(n), shard)
+                                 for (n, shard) in enumerate(shards))
+        self.shards = shards.values()
+        self.replicas = replicas
+        ### An empty pool is falsy, so test for None rather than truth
+        if pool is None:
+            self.pool = coro_pool()
+        elif callable(pool):
+            self.pool = pool()
+        else:
+            self.pool = pool
+
+        ring = list()
+        for (n, name) in enumerate(shards.keys()):
+            for replica in xrange(replicas):
+                ring.append((self._hash('%s-%d' % (name, replica)), n))
+        ring.sort()
+        self._points = [point for (point, n) in ring]
+        self._owners = [n for (point, n) in ring]
+
+    def _hash(self, key):
+        return struct.unpack('>I', hashlib.md5(key).digest()[:4])[0]
+
+    def _shard_index(self, iid):
+        position = bisect(self._points, self._hash(str(iid)))
+        return self._owners[position % len(self._points)]
+
+    def shard_for(self, iid):
+        """Returns the queryset that holds `iid`.
+        """
+        return self.shards[self._shard_index(iid)]
+
+    def _shield_id(self, shield):
+        return getattr(shield, self.api_id)
+
+    def _scatter(self, method_name, items, key_fun):
+        """Calls `method_name` on each shard with its share of `items`, all
+        at once, and merges the statuses back into the order of `items`.
+        """
+        groups = OrderedDict()
+        for (position, item) in enumerate(items):
+            n = self._shard_index(key_fun(item))
+            groups.setdefault(n, list()).append((position, item))
+
+        def call(group):
+            (n, members) = group
+            method = getattr(self.shards[n], method_name)
+            return list(method([item for (position, item) in members]))
+
+        merged = [None] * len(items)
+        results = self.pool.imap(call, groups.items())
+        for ((n, members), statuses) in zip(groups.items(), results):
+            for ((position, item), status) in zip(members, statuses):
+                merged[position] = status
+        return merged
+
+    def _gather(self, call):
+        """Calls `call` with every shard at once and joins the lists it
+        returns.
+        """
+        statuses = list()
+        for shard_statuses in self.pool.imap(call, self.shards):
+            statuses.extend(shard_statuses)
+        return statuses
+
+    def _by_key(self, statuses):
+        """Sorts the statuses by the string form of their ids, the order
+        DictQueryset keeps.
+        """
+        return sorted(statuses,
+                      key=lambda status: str(status[1][self.api_id]))
+
+    ### Create Functions
+
+    def create_one(self, shield):
+        return self.shard_for(self._shield_id(shield)).create_one(shield)
+
+    def create_many(self, shields):
+        return self._scatter('create_many', shields, self._shield_id)
+
+    ### Read Functions
+
+    def read_all(self):
+        return self._gather(lambda shard: shard.read_all())
+
+    def read_one(self, iid):
+        return self.shard_for(iid).read_one(iid)
+
+    def read_many(self, ids):
+        return self._scatter('read_many', ids, lambda iid: iid)
+
+    def read_where(self, limit=None, **criteria):
+        """Asks every shard for `limit` items and keeps the first `limit` in
+        key order.
+        """
+        if limit is not None:
+            self._check_limit(limit)
+        statuses = self._by_key(self._gather(
+            lambda shard: shard.read_where(limit=limit, **criteria)))
+        if limit is not None:
+            statuses = statuses[:limit]
+        return statuses
+
+    def read_page(self, cursor=None, limit=25):
+        """Walks the shards one after another. The cursor is a list of the
+        shard's position and that shard's own cursor.
+
+        Each page is in key order. Shard cursors are opaque, and a Redis
+        shard scans in no order at all, so pages can't be merged across
+        shards.
+        """
+        self._check_limit(limit)
+        (n, shard_cursor) = cursor or (0, None)
+        (shard_cursor, statuses) = self.shards[n].read_page(
+            cursor=shard_cursor, limit=limit)
+        statuses = self._by_key(statuses)
+        if shard_cursor is not None:
+            return ([n, shard_cursor], statuses)
+        elif n + 1 < len(self.shards):
+            return ([n + 1, None], statuses)
+        return (None, statuses)
+
+    def read_since(self, since, limit=None):
+        """Asks every shard for `limit` items and keeps the oldest `limit`.
+        """
+        statuses = self._gather(lambda shard: shard.read_since(since, limit))
+        statuses.sort(key=lambda status: status[1].get(self.time_field))
+        if limit is not None:
+            statuses = statuses[:limit]
+        return statuses
+
+    ### Update Functions
+
+    def update_one(self, shield):
+        return self.shard_for(self._shield_id(shield)).update_one(shield)
+
+    def update_many(self, shields):
+        return self._scatter('update_many', shields, self._shield_id)
+
+    def update_fields(self, iid, changes):
+        return self.shard_for(iid).update_fields(iid, changes)
+
+    ### Destroy Functions
+
+    def destroy_one(self, iid):
+        return self.shard_for(iid).destroy_one(iid)
+
+    def destroy_many(self, ids):
+        return self._scatter('destroy_many', ids, lambda iid: iid)
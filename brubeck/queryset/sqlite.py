@@ -0,0 +1,307 @@
+from brubeck.queryset.base import AbstractQueryset
+from brubeck.request_handling import FourOhFourException
+from contextlib import contextmanager
+import threading
+import re
+import ujson as json
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+### Field names are put into SQL, so only plain identifiers are allowed
+FIELD_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+### SQLite allows 999 parameters per statement in older builds
+MAX_PARAMETERS = 500
+
+
+class SQLiteQueryset(AbstractQueryset):
+    """Stores documents as JSON in a table of the SQLite database at `path`,
+    keyed by `api_id`.
+
+    Fields named in `indexes` get a generated column over the JSON document
+    with an index on it, which `read_where` uses for equality and range
+    lookups. The `time_field`, if there is one, is indexed the same way for
+    `read_since`. Indexes declared later are added to existing tables.
+
+    Each thread, or each greenlet once gevent has patched `threading`, opens
+    its own connection, so `path` must be a file rather than `:memory:`.
+    Connections use write-ahead logging, which lets readers carry on while
+    one writer commits. Writes take the write lock before reading anything,
+    so the created or updated status they report holds.
+
+    Generated columns need SQLite 3.31 or later.
+    """
+
+    OPERATORS = {
+        'eq': '=',
+        'gt': '>',
+        'gte': '>=',
+        'lt': '<',
+        'lte': '<=',
+    }
+
+    def __init__(self, path, table, indexes=None, **kw):
+        if sqlite3 is None:
+            raise EnvironmentError('You need Python built with sqlite3')
+        super(SQLiteQueryset, self).__init__(**kw)
+        self.path = path
+        self.table = self._check_name(table)
+        self.indexes = [self._check_name(field) for field in indexes or ()]
+        if self.time_field and self.time_field not in self.indexes:
+            self.indexes.append(self._check_name(self.time_field))
+        self._local = threading.local()
+        self._create_table()
+
+    def _check_name(self, name):
+        if not FIELD_NAME.match(name):
+            raise ValueError('Invalid field name: %s' % name)
+        return name
+
+    def _connection(self):
+        """Returns this thread's connection, opening it on first use.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            ### Transactions are begun by `_transaction`, not the module
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.text_factory = str
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Runs the block in a transaction that holds the write lock from
+        the start. Python's sqlite3 only begins one at the first write, which
+        would leave earlier reads outside it.
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _create_table(self):
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS %s '
+                         '(id TEXT PRIMARY KEY, document TEXT NOT NULL)'
+                         % self.table)
+            columns = [row[1] for row in
+                       conn.execute('PRAGMA table_xinfo(%s)' % self.table)]
+            for field in self.indexes:
+                if field not in columns:
+                    conn.execute("ALTER TABLE %s ADD COLUMN %s GENERATED "
+                                 "ALWAYS AS (json_extract(document, '$.%s')) "
+                                 "VIRTUAL" % (self.table, field, field))
+                conn.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)'
+                             % (self.table, field, self.table, field))
+
+    def _column(self, field):
+        """Returns the SQL for a field of the document, using its generated
+        column when it has one.
+        """
+        if field in self.indexes:
+            return field
+        return "json_extract(document, '$.%s')" % self._check_name(field)
+
+    def _chunks(self, ids):
+        for start in xrange(0, len(ids), MAX_PARAMETERS):
+            yield ids[start:start + MAX_PARAMETERS]
+
+    def _select_in(self, conn, ids):
+        """Returns a dict of id => document for the `ids` that exist.
+        """
+        found = dict()
+        for chunk in self._chunks(ids):
+            query = 'SELECT id, document FROM %s WHERE id IN (%s)' % (
+                self.table, ', '.join('?' * len(chunk)))
+            found.update(conn.execute(query, chunk))
+        return found
+
+    def _write(self, shields):
+        """Upserts `shields` in one transaction. New documents are reported as
+        created, existing ones as updated.
+        """
+        rows = [(str(getattr(shield, self.api_id)),
+                 json.dumps(shield.to_json(encode=False)))
+                for shield in shields]
+        with self._transaction() as conn:
+            existing = self._select_in(conn, [iid for (iid, doc) in rows])
+            conn.executemany('INSERT OR REPLACE INTO %s (id, document) '
+                             'VALUES (?, ?)' % self.table, rows)
+        return [(self.MSG_UPDATED if iid in existing else self.MSG_CREATED,
+                 shield) for ((iid, doc), shield) in zip(rows, shields)]
+
+    def _statuses(self, rows):
+        return [(self.MSG_OK, json.loads(document)) for (document,) in rows]
+
+    ### Create Functions
+
+    def create_one(self, shield):
+        return self._write([shield])[0]
+
+    def create_many(self, shields):
+        return self._write(shields)
+
+    ### Read Functions
+
+    def read_all(self):
+        rows = self._connection().execute(
+            'SELECT document FROM %s ORDER BY id' % self.table)
+        return self._statuses(rows)
+
+    def read_one(self, iid):
+        iid = str(iid)
+        row = self._connection().execute(
+            'SELECT document FROM %s WHERE id = ?' % self.table,
+            (iid,)).fetchone()
+        if row is None:
+            return (self.MSG_FAILED, iid)
+        return (self.MSG_OK, json.loads(row[0]))
+
+    def read_many(self, ids):
+        ids = [str(iid) for iid in ids]
+        found = self._select_in(self._connection(), ids)
+        return [(self.MSG_OK, json.loads(found[iid])) if iid in found
+                else (self.MSG_FAILED, iid) for iid in ids]
+
+    def read_fields(self, ids, fields):
+        """Extracts only the ids and `fields` from the stored JSON.
+        """
+        names = ['_id', 'id'] + [self._check_name(f) for f in fields
+                                 if f not in ('_id', 'id')]
+        paths = ', '.join("'$.%s'" % name for name in names)
+        query = 'SELECT id, json_extract(document, %s) FROM %s' % (paths,
+                                                                    self.table)
+        conn = self._connection()
+
+        def project(values):
+            return dict((name, value) for (name, value)
+                        in zip(names, json.loads(values)) if value is not None)
+
+        if not ids:
+            rows = conn.execute(query + ' ORDER BY id')
+            return [(self.MSG_OK, project(values)) for (iid, values) in rows]
+
+        is_list = isinstance(ids, list)
+        if not is_list:
+            ids = [ids]
+        ids = [str(iid) for iid in ids]
+        found = dict()
+        for chunk in self._chunks(ids):
+            found.update(conn.execute(query + ' WHERE id IN (%s)'
+                                      % ', '.join('?' * len(chunk)), chunk))
+        statuses = [(self.MSG_OK, project(found[iid])) if iid in found
+                    else (self.MSG_FAILED, iid) for iid in ids]
+        if is_list:
+            return statuses
+        return statuses[0]
+
+    def read_where(self, limit=None, **criteria):
+        """Translates the criteria into a WHERE clause. Results are in id
+        order.
+        """
+        if limit is not None:
+            self._check_limit(limit)
+        clauses = list()
+        values = list()
+        for (field, op, value) in self._parse_criteria(criteria):
+            clauses.append('%s %s ?' % (self._column(field),
+                                        self.OPERATORS[op]))
+            values.append(value)
+
+        query = 'SELECT document FROM %s' % self.table
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY id'
+        if limit is not None:
+            query += ' LIMIT ?'
+            values.append(limit)
+        rows = self._connection().execute(query, values)
+        return self._statuses(rows)
+
+    def read_page(self, cursor=None, limit=25):
+        """The cursor is the last id of the previous page.
+        """
+        self._check_limit(limit)
+        query = 'SELECT id, document FROM %s' % self.table
+        values = list()
+        if cursor is not None:
+            query += ' WHERE id > ?'
+            values.append(cursor)
+        values.append(limit + 1)
+        rows = self._connection().execute(query + ' ORDER BY id LIMIT ?',
+                                          values).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+        return (next_cursor, self._statuses([(doc,) for (iid, doc) in rows]))
+
+    def read_since(self, since, limit=None):
+        if not self.time_field:
+            raise NotImplementedError('read_since needs a time_field')
+        if limit is None:
+            limit = -1
+        rows = self._connection().execute(
+            'SELECT document FROM %s WHERE %s > ? ORDER BY %s, id LIMIT ?'
+            % (self.table, self.time_field, self.time_field), (since, limit))
+        return self._statuses(rows)
+
+    ### Update Functions
+
+    def update_one(self, shield):
+        return self._write([shield])[0]
+
+    def update_many(self, shields):
+        return self._write(shields)
+
+    def update_fields(self, iid, changes):
+        """Sets the fields inside the stored JSON with `json_set`.
+        """
+        iid = str(iid)
+        if not changes:
+            return self.read_one(iid)
+        assignments = list()
+        values = list()
+        for (field, value) in changes.items():
+            assignments.append("'$.%s', json(?)" % self._check_name(field))
+            values.append(json.dumps(value))
+        with self._transaction() as conn:
+            updated = conn.execute(
+                'UPDATE %s SET document = json_set(document, %s) WHERE id = ?'
+                % (self.table, ', '.join(assignments)), values + [iid])
+            if not updated.rowcount:
+                return (self.MSG_FAILED, iid)
+            row = conn.execute('SELECT document FROM %s WHERE id = ?'
+                               % self.table, (iid,)).fetchone()
+        return (self.MSG_UPDATED, json.loads(row[0]))
+
+    ### Destroy Functions
+
+    def destroy_one(self, iid):
+        iid = str(iid)
+        with self._transaction() as conn:
+            row = conn.execute('SELECT document FROM %s WHERE id = ?'
+                               % self.table, (iid,)).fetchone()
+            if row is None:
+                raise FourOhFourException
+            conn.execute('DELETE FROM %s WHERE id = ?' % self.table, (iid,))
+        return (self.MSG_UPDATED, json.loads(row[0]))
+
+    def destroy_many(self, ids):
+        ids = [str(iid) for iid in ids]
+        with self._transaction() as conn:
+            found = self._select_in(conn, ids)
+            for chunk in self._chunks(ids):
+                conn.execute('DELETE FROM %s WHERE id IN (%s)' % (
+                    self.table, ', '.join('?' * len(chunk))), chunk)
+        return [(self.MSG_UPDATED, json.loads(found[iid])) if iid in found
+                else (self.MSG_FAILED, iid) for iid in ids]
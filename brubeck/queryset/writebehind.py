@@ -0,0 +1,205 @@
+from brubeck.queryset.base import ProxyQueryset
+from brubeck.queryset.batching import (coro_event, coro_spawn_later,
+                                       coro_send, coro_send_exception,
+                                       coro_wait)
+from collections import OrderedDict
+import atexit
+import logging
+import weakref
+
+
+def _flush_at_exit(ref):
+    """Flushes the queryset behind `ref` if it is still around.
+    """
+    queryset = ref()
+    if queryset is not None:
+        queryset.flush()
+
+
+class WriteBehindQueryset(ProxyQueryset):
+    """Buffers `create_*` and `update_*` calls and hands them to the wrapped
+    queryset as one `create_many` and one `update_many`, at most `interval`
+    seconds later or as soon as `max_batch` documents are waiting. Writing
+    the same id twice before a flush only sends the last version.
+
+    With `wait` set, writers block until their batch is written and get the
+    wrapped queryset's statuses. Otherwise they return right away, reporting
+    the write as created or updated, and failed batches are only logged. Pass
+    `wait` to a single call to override it.
+
+    Reads and destroys flush pending writes first when they touch them, and
+    wait for batches another coroutine is still writing, so callers always
+    see their own writes. Anything still buffered is flushed when the
+    interpreter exits.
+    """
+
+    def __init__(self, queryset, max_batch=100, interval=0.05, wait=False,
+                 flush_at_exit=True):
+        super(WriteBehindQueryset, self).__init__(queryset)
+        self.max_batch = max_batch
+        self.interval = interval
+        self.wait = wait
+        self._creates = OrderedDict()  # str(id) => shield
+        self._updates = OrderedDict()
+        self._waiters = dict()         # str(id) => list of events
+        self._inflight = list()        # (set of str(id), event) per flush
+        self._timer = None
+        if flush_at_exit:
+            atexit.register(_flush_at_exit, weakref.ref(self))
+
+    def _pending(self):
+        return len(self._creates) + len(self._updates)
+
+    def _buffer(self, buffered, shields, status, wait):
+        """Queues `shields` for writing and returns their statuses, waiting
+        for the flush if asked to.
+        """
+        if wait is None:
+            wait = self.wait
+        events = list()
+        for shield in shields:
+            key = str(getattr(shield, self.api_id))
+            if key in self._creates:
+                # still unwritten, so it stays a create
+                self._creates[key] = shield
+            else:
+                self._updates.pop(key, None)
+                buffered[key] = shield
+            if wait:
+                event = coro_event()
+                self._waiters.setdefault(key, list()).append(event)
+                events.append(event)
+
+        if self._pending() >= self.max_batch:
+            self.flush()
+        elif self._timer is None and self._pending():
+            self._timer = coro_spawn_later(self.interval, self._on_timer)
+
+        if wait:
+            return [coro_wait(event) for event in events]
+        return [(status, shield) for shield in shields]
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush()
+
+    def _wait_inflight(self, keys=None):
+        """Waits for the batches being written that hold any of `keys`, or
+        for all of them.
+        """
+        for (batch_keys, event) in list(self._inflight):
+            if keys is None or not keys.isdisjoint(batch_keys):
+                coro_wait(event)
+
+    def _flush_for(self, ids):
+        """Flushes if any of `ids` has a pending write, and waits for any
+        batch holding them that is already being written.
+        """
+        keys = set(str(iid) for iid in ids)
+        if any(key in self._creates or key in self._updates for key in keys):
+            self.flush()
+        self._wait_inflight(keys)
+
+    def _flush_all(self):
+        self.flush()
+        self._wait_inflight()
+
+    def flush(self):
+        """Writes everything buffered to the wrapped queryset now.
+        """
+        if self._timer is not None:
+            self._timer.kill()
+            self._timer = None
+        (creates, self._creates) = (self._creates, OrderedDict())
+        (updates, self._updates) = (self._updates, OrderedDict())
+        (waiters, self._waiters) = (self._waiters, dict())
+        if not creates and not updates:
+            return
+
+        ### Reads wait on this until the batch is in the wrapped queryset
+        batch = (set(creates) | set(updates), coro_event())
+        self._inflight.append(batch)
+        try:
+            for (buffered, method) in [(creates, self.queryset.create_many),
+                                       (updates, self.queryset.update_many)]:
+                if not buffered:
+                    continue
+                try:
+                    statuses = method(buffered.values())
+                except Exception, e:
+                    logging.error(e, exc_info=True)
+                    for key in buffered:
+                        for event in waiters.get(key, ()):
+                            coro_send_exception(event, e)
+                    continue
+                for (key, status) in zip(buffered.keys(), statuses):
+                    for event in waiters.get(key, ()):
+                        coro_send(event, status)
+        finally:
+            self._inflight.remove(batch)
+            coro_send(batch[1], None)
+
+    ### Create Functions
+
+    def create_one(self, shield, wait=None):
+        return self._buffer(self._creates, [shield], self.MSG_CREATED, wait)[0]
+
+    def create_many(self, shields, wait=None):
+        return self._buffer(self._creates, shields, self.MSG_CREATED, wait)
+
+    ### Read Functions
+
+    def read_all(self):
+        self._flush_all()
+        return self.queryset.read_all()
+
+    def read_one(self, iid):
+        self._flush_for([iid])
+        return self.queryset.read_one(iid)
+
+    def read_many(self, ids):
+        self._flush_for(ids)
+        return self.queryset.read_many(ids)
+
+    def read_fields(self, ids, fields):
+        if not ids:
+            self._flush_all()
+        elif isinstance(ids, list):
+            self._flush_for(ids)
+        else:
+            self._flush_for([ids])
+        return self.queryset.read_fields(ids, fields)
+
+    def read_where(self, **criteria):
+        self._flush_all()
+        return self.queryset.read_where(**criteria)
+
+    def read_page(self, cursor=None, limit=25):
+        self._flush_all()
+        return self.queryset.read_page(cursor=cursor, limit=limit)
+
+    def read_since(self, since, limit=None):
+        self._flush_all()
+        return self.queryset.read_since(since, limit=limit)
+
+    ### Update Functions
+
+    def update_one(self, shield, wait=None):
+        return self._buffer(self._updates, [shield], self.MSG_UPDATED, wait)[0]
+
+    def update_many(self, shields, wait=None):
+        return self._buffer(self._updates, shields, self.MSG_UPDATED, wait)
+
+    def update_fields(self, iid, changes):
+        self._flush_for([iid])
+        return self.queryset.update_fields(iid, changes)
+
+    ### Destroy Functions
+
+    def destroy_one(self, iid):
+        self._flush_for([iid])
+        return self.queryset.destroy_one(iid)
+
+    def destroy_many(self, ids):
+        self._flush_for(ids)
+        return self.queryset.destroy_many(ids)
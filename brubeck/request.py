@@ -4,6 +4,11 @@ import Cookie
 import logging
 import urlparse
 import re
+from cStringIO import StringIO
+
+### Bodies of these content types are read from WSGI servers line by line,
+### as the handler asks for them, instead of all at once
+STREAMED_CONTENT_TYPES = ('application/x-ndjson',)
 
 def parse_netstring(ns):
     length, rest = ns.split(':', 1)
@@ -32,6 +37,7 @@ class Request(object):
         self.conn_id = conn_id
         self.headers = headers
         self.body = body
+        self.body_file = None
         self.url_parts = urlparse.urlsplit(url) if isinstance(url, basestring) else url
 
         if self.method == 'JSON':
@@ -50,7 +56,7 @@ class Request(object):
                     self.arguments[name] = values
 
         ### handle data, multipart or not
-        if self.method in ("POST", "PUT") and self.content_type:
+        if self.method in ("POST", "PUT", "PATCH") and self.content_type:
             form_encoding = "application/x-www-form-urlencoded"
             if self.content_type.startswith(form_encoding):
                 arguments = cgi.parse_qs(self.body)
@@ -157,7 +163,7 @@ class Request(object):
 
     @property
     def content_type(self):
-        return self.headers.get("content-type")
+        return self.get_header('Content-Type')
 
     @property
     def version(self):
@@ -212,8 +218,12 @@ class Request(object):
         sender = "WSGI_server"
         path = environ['PATH_INFO']
         body = ""
+        body_file = None
         if "CONTENT_LENGTH" in environ and environ["CONTENT_LENGTH"]:
-            body = environ["wsgi.input"].read(int(environ['CONTENT_LENGTH']))
+            if environ.get('CONTENT_TYPE', '').startswith(STREAMED_CONTENT_TYPES):
+                body_file = environ["wsgi.input"]
+            else:
+                body = environ["wsgi.input"].read(int(environ['CONTENT_LENGTH']))
             del environ["CONTENT_LENGTH"]
             del environ["wsgi.input"]
         #setting headers to environ dict with no manipulation
@@ -244,9 +254,34 @@ class Request(object):
         query = headers.get('QUERY_STRING', None)
         url = urlparse.SplitResult(scheme, netloc, path, query, None)
         r = Request(sender, conn_id, path, headers, body, url)
+        r.body_file = body_file
         r.is_wsgi = True
         return r
 
+    def iter_body_lines(self):
+        """Yields the lines of the body, without their line endings. Streamed
+        bodies, see `STREAMED_CONTENT_TYPES`, are read as this goes.
+        """
+        body_file = self.body_file
+        if body_file is None:
+            body_file = StringIO(self.body)
+        for line in iter(body_file.readline, ''):
+            yield line.rstrip('\r\n')
+
+    def get_header(self, name, default=None):
+        """Returns the value of the request header `name`, eg. 'Accept'.
+        Mongrel2 sends header names in lowercase, while WSGI servers name
+        them like `HTTP_ACCEPT`, except for `CONTENT_TYPE` and
+        `CONTENT_LENGTH`.
+        """
+        key = name.lower()
+        if key in self.headers:
+            return self.headers[key]
+        key = name.upper().replace('-', '_')
+        if key in ('CONTENT_TYPE', 'CONTENT_LENGTH') and key in self.headers:
+            return self.headers[key]
+        return self.headers.get('HTTP_' + key, default)
+
     def is_disconnect(self):
         if self.headers.get('METHOD') == 'JSON':
             logging.error('DISCONNECT')
@@ -50,11 +50,16 @@ import inspect
 import Cookie
 import base64
 import hmac
+import hashlib
+import zlib
 import cPickle as pickle
 from itertools import chain
 import os, sys
 from dictshield.base import ShieldException
 from request import Request, to_bytes, to_unicode
+from encoding import RawJSON, encode_json, has_raw_json, is_stream, iter_json
+from encoding import (MEDIA_TYPE_JSON, MEDIA_TYPE_MSGPACK, media_codec,
+                      negotiate, decode_raw_json, parse_accept)
 
 import ujson as json
 
@@ -62,11 +67,18 @@ import ujson as json
 ### Common helpers
 ###
 
-HTTP_METHODS = ['get', 'post', 'put', 'delete',
+HTTP_METHODS = ['get', 'post', 'put', 'patch', 'delete',
                 'head', 'options', 'trace', 'connect']
 
 HTTP_FORMAT = "HTTP/1.1 %(code)s %(status)s\r\n%(headers)s\r\n\r\n%(body)s"
 
+### Streamed bodies are sent in pieces of about this many bytes
+STREAM_BUFFER_SIZE = 64 * 1024
+
+### Each handler class remembers the media types it chose for this many
+### distinct Accept headers
+MAX_NEGOTIATIONS = 256
+
 
 class FourOhFourException(Exception):
     pass
@@ -100,6 +112,45 @@ def http_response(body, code, status, headers):
 
     return HTTP_FORMAT % payload
 
+
+def http_response_head(code, status, headers):
+    """Renders the status line and headers of a response whose body follows
+    in chunks made by `http_chunk`.
+    """
+    headers.pop('Content-Length', None)
+    headers['Transfer-Encoding'] = 'chunked'
+    payload = {'code': code, 'status': status, 'body': ''}
+    payload['headers'] = "\r\n".join('%s: %s' % (k, v)
+                                     for k, v in headers.items())
+    return HTTP_FORMAT % payload
+
+
+def http_chunk(data):
+    """Renders one chunk of a chunked response body. An empty chunk ends
+    the body.
+    """
+    data = to_bytes(data)
+    return '%x\r\n%s\r\n' % (len(data), data)
+
+
+def buffered(pieces, size=STREAM_BUFFER_SIZE):
+    """Joins the strings from the iterable `pieces` into strings of about
+    `size` bytes, so a streamed body isn't sent in lots of tiny writes. At
+    most one of them is held at a time.
+    """
+    buffer = list()
+    buffered_size = 0
+    for piece in pieces:
+        piece = to_bytes(piece)
+        buffer.append(piece)
+        buffered_size += len(piece)
+        if buffered_size >= size:
+            yield ''.join(buffer)
+            buffer = list()
+            buffered_size = 0
+    if buffer:
+        yield ''.join(buffer)
+
 def _lscmp(a, b):
     """Compares two strings in a cryptographically safe way
     """
@@ -177,6 +228,10 @@ class MessageHandler(object):
         -5: 'Server error',
     }
 
+    ### Set once the payload holds `RawJSON` fragments or iterators
+    _raw_payload = False
+    _streamed_payload = False
+
     def __init__(self, application, message, *args, **kwargs):
         """A MessageHandler is called at two major points, with regard to the
         eventlet scheduler. __init__ is the first point, which is responsible
@@ -234,9 +289,16 @@ class MessageHandler(object):
     def error(self, err):
         return self.unsupported()
 
-    def add_to_payload(self, key, value):
-        """Upserts key-value pair into payload.
+    def add_to_payload(self, key, value, raw=False):
+        """Upserts key-value pair into payload. The value may be a
+        `RawJSON` fragment, or a list of them, to be sent as it is. Pass
+        `raw=True` when fragments are nested deeper than that. JSON
+        handlers stream iterators out as arrays, one item at a time.
         """
+        if raw or has_raw_json(value):
+            self._raw_payload = True
+        if is_stream(value):
+            self._streamed_payload = True
         self._payload[key] = value
 
     def clear_payload(self):
@@ -244,6 +306,8 @@ class MessageHandler(object):
         """
         status_code = self.status_code
         self._payload = dict()
+        self._raw_payload = False
+        self._streamed_payload = False
         self.set_status(status_code)
         self.initialize()
 
@@ -285,9 +349,17 @@ class MessageHandler(object):
         if not status_code:
             status_code = self.status_code
         self.set_status(status_code)
-        rendered = json.dumps(self._payload)
+        rendered = self.encode_payload(self._payload)
         return rendered
 
+    def encode_payload(self, value):
+        """Encodes `value`, taken from the payload, as JSON. `RawJSON`
+        fragments are spliced in rather than encoded again.
+        """
+        if self._raw_payload:
+            return encode_json(value)
+        return json.dumps(value)
+
     def render_error(self, status_code, error_handler=None, **kwargs):
         """Clears the payload before rendering the error status.
         Takes a callable to perform customization before rendering the output.
@@ -362,6 +434,7 @@ class WebMessageHandler(MessageHandler):
     _UPDATED_CODE = 200
     _CREATED_CODE = 201
     _MULTI_CODE = 207
+    _NOT_MODIFIED = 304
     _FAILED_CODE = 400
     _AUTH_FAILURE = 401
     _FORBIDDEN = 403
@@ -371,6 +444,7 @@ class WebMessageHandler(MessageHandler):
 
     _response_codes = {
         200: 'OK',
+        304: 'Not modified',
         400: 'Bad request',
         401: 'Authentication failed',
         403: 'Forbidden',
@@ -562,19 +636,84 @@ class JSONMessageHandler(WebMessageHandler):
     representing JSON transmissions.
 
     The `hide_status` flag is used to reduce the payload down to just the data.
+
+    If the payload holds an iterator, the body is a generator of JSON pieces
+    that the connection sends as it is consumed.
+
+    The response is encoded in whichever of `media_types` the request's
+    Accept header prefers, eg. msgpack for other services that ask for
+    `application/x-msgpack`. Streamed payloads are always JSON. Request
+    bodies are decoded according to their Content-Type by `decode_body`.
     """
+    ### Media types responses can be sent in, most preferred first. Types
+    ### whose codec can't be used here, eg. for lack of msgpack, are skipped.
+    media_types = (MEDIA_TYPE_JSON, MEDIA_TYPE_MSGPACK)
+
+    @classmethod
+    def offered_media_types(cls):
+        """Returns the `media_types` that have a usable codec, worked out
+        once for each handler class.
+        """
+        offered = cls.__dict__.get('_offered')
+        if offered is None:
+            offered = cls._offered = [media_type for media_type
+                                      in cls.media_types
+                                      if media_codec(media_type) is not None]
+        return offered
+
+    @classmethod
+    def negotiate_media_type(cls, accept):
+        """Returns the media type, and a codec for it, to answer a request
+        with the Accept header `accept`. The choices are cached on each
+        handler class.
+        """
+        cache = cls.__dict__.get('_negotiated')
+        if cache is None:
+            cache = cls._negotiated = dict()
+        if accept not in cache:
+            media_type = negotiate(accept, cls.offered_media_types())
+            if len(cache) >= MAX_NEGOTIATIONS:
+                cache.clear()
+            cache[accept] = (media_type, media_codec(media_type))
+        return cache[accept]
+
+    def decode_body(self):
+        """Decodes the request body with the codec for its Content-Type.
+        Returns None if there is no body or no codec for its type.
+        """
+        codec = media_codec(self.message.content_type)
+        if codec is None or not self.message.body:
+            return None
+        return codec.decode(self.message.body)
+
     def render(self, status_code=None, hide_status=False, **kwargs):
         if status_code:
             self.set_status(status_code)
 
         self.convert_cookies()
 
-        self.headers['Content-Type'] = 'application/json'
-
         if hide_status and 'data' in self._payload:
-            body = json.dumps(self._payload['data'])
+            value = self._payload['data']
         else:
-            body = json.dumps(self._payload)
+            value = self._payload
+
+        (media_type, codec) = self.negotiate_media_type(
+            self.message.get_header('Accept'))
+
+        if self._streamed_payload:
+            media_type = MEDIA_TYPE_JSON
+            body = iter_json(value)
+        elif media_type == MEDIA_TYPE_JSON:
+            body = self.encode_payload(value)
+        else:
+            if self._raw_payload:
+                value = decode_raw_json(value)
+            body = codec.encode(value)
+
+        ### Caches must key on Accept whenever it could change the answer
+        if len(self.offered_media_types()) > 1:
+            self.headers['Vary'] = 'Accept'
+        self.headers['Content-Type'] = media_type
 
         response = render(body, self.status_code, self.status_msg,
                           self.headers)
@@ -585,15 +724,84 @@ class JSONMessageHandler(WebMessageHandler):
         return response
 
 
+def gzip_compress(data, level=9):
+    """Compresses `data` into the gzip format used by Content-Encoding.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
 class JsonSchemaMessageHandler(WebMessageHandler):
+    """Serves the JSON schema of every model added with `add_model`. The
+    manifest only changes then, so that's when it is encoded, gzipped and
+    given ETags, one for each copy. Requests just pick which copy to send,
+    or answer 304 if the client's copy is current.
+    """
     manifest = {}
 
+    _manifest_body = None
+    _manifest_gzip = None
+    _manifest_etag = None
+    _manifest_gzip_etag = None
+
     @classmethod
     def add_model(self, model):
         self.manifest[model.__name__.lower()] = model.for_jsonschema()
+        self._build_manifest()
+
+    @classmethod
+    def _build_manifest(cls):
+        body = json.dumps(cls.manifest.values())
+        cls._manifest_body = body
+        cls._manifest_gzip = gzip_compress(body)
+        digest = hashlib.sha1(body).hexdigest()
+        cls._manifest_etag = '"%s"' % digest
+        cls._manifest_gzip_etag = '"%s-gzip"' % digest
+
+    def _accepts_gzip(self):
+        """Tells whether Accept-Encoding allows gzip. An entry for gzip
+        itself wins over `*`.
+        """
+        accept = self.message.get_header('Accept-Encoding')
+        if not accept:
+            return False
+        qualities = dict(parse_accept(accept))
+        if 'gzip' in qualities:
+            return qualities['gzip'] > 0
+        return qualities.get('*', 0) > 0
+
+    def _is_current(self, etag):
+        """Tells whether the client's If-None-Match names `etag`, the tag of
+        the variant this request would get.
+        """
+        if_none_match = self.message.get_header('If-None-Match')
+        if not if_none_match:
+            return False
+        tags = set(tag.strip() for tag in if_none_match.split(','))
+        if '*' in tags:
+            return True
+        return etag in tags or 'W/' + etag in tags
 
     def get(self):
-        self.set_body(json.dumps(self.manifest.values()))
+        if self._manifest_body is None:
+            self._build_manifest()
+        gzipped = self._accepts_gzip()
+        if gzipped:
+            etag = self._manifest_gzip_etag
+        else:
+            etag = self._manifest_etag
+        self.headers['ETag'] = etag
+        self.headers['Vary'] = 'Accept-Encoding'
+
+        if self._is_current(etag):
+            self.set_body('', status_code=self._NOT_MODIFIED)
+            return self.render(status_code=self._NOT_MODIFIED)
+
+        if gzipped:
+            self.headers['Content-Encoding'] = 'gzip'
+            self.set_body(self._manifest_gzip)
+        else:
+            self.set_body(self._manifest_body)
         return self.render(status_code=200)
 
     def render(self, status_code=None, **kwargs):
@@ -608,6 +816,88 @@ class JsonSchemaMessageHandler(WebMessageHandler):
 
         return response
 
+
+class BatchMessageHandler(JSONMessageHandler):
+    """Runs several requests against the APIs added with `register_api` in
+    one round trip. The body is a JSON list of operations like
+
+        {"method": "GET", "path": "/todo/?count=10"}
+        {"method": "POST", "path": "/todo/", "body": {"text": "..."}}
+
+    The operations run at the same time, each through the API's own handler,
+    and the response lists their status codes and bodies in the same order.
+    Their JSON bodies are copied in as they are.
+
+    They get a pool of their own rather than the application's, which the
+    batch itself is holding a slot of. With a bounded pool, batches waiting
+    on their operations could otherwise take every slot and never finish.
+    """
+    max_operations = 50
+
+    def _operation_message(self, operation):
+        """Builds the request for one operation, carrying over the headers,
+        like cookies, of the batch request.
+        """
+        (path, sep, query) = operation['path'].partition('?')
+        body = operation.get('body')
+        if body is None:
+            body = ''
+        elif not isinstance(body, basestring):
+            body = json.dumps(body)
+        headers = dict(self.message.headers)
+        headers.update({'METHOD': operation.get('method', 'GET').upper(),
+                        'PATH': path, 'QUERY': query,
+                        'content-type': MEDIA_TYPE_JSON,
+                        'accept': MEDIA_TYPE_JSON})
+        return Request(self.message.sender, self.message.conn_id, path,
+                       headers, body, operation['path'])
+
+    def _failed_operation(self, status_code):
+        return {self._STATUS_CODE: status_code,
+                self._STATUS_MSG: self._response_codes[status_code],
+                'body': None}
+
+    def _run(self, operation):
+        message = self._operation_message(operation)
+        for (regex, APIClass) in self.application._api_routes:
+            url_check = regex.match(message.path)
+            if url_check:
+                handler = APIClass(self.application, message)
+                handler._url_args = url_check.groupdict()
+                result = handler()
+                break
+        else:
+            return self._failed_operation(self._NOT_FOUND)
+        if not result:
+            return self._failed_operation(self._SERVER_ERROR)
+
+        body = result['body']
+        if is_stream(body):
+            body = ''.join(body)
+        if body and result['headers'].get('Content-Type') == MEDIA_TYPE_JSON:
+            body = RawJSON(body)
+        return {self._STATUS_CODE: result['status_code'],
+                self._STATUS_MSG: result['status_msg'],
+                'body': body or None}
+
+    def post(self):
+        operations = self.decode_body()
+        if not isinstance(operations, list) or \
+               len(operations) > self.max_operations:
+            return self.render(status_code=self._FAILED_CODE)
+        for operation in operations:
+            if not isinstance(operation, dict) or \
+                   not isinstance(operation.get('path'), basestring):
+                return self.render(status_code=self._FAILED_CODE)
+            method = operation.get('method', 'GET')
+            if not isinstance(method, basestring) or \
+                   method.lower() not in HTTP_METHODS:
+                return self.render(status_code=self._FAILED_CODE)
+
+        results = list(coro_pool().imap(self._run, operations))
+        self.add_to_payload('data', results, raw=True)
+        return self.render(status_code=self._SUCCESS_CODE)
+
 ###
 ### Application logic
 ###
@@ -685,6 +975,9 @@ class Brubeck(object):
         # A database connection is optional. The var name is now in place
         self.db_conn = db_conn
 
+        # Routes added by `register_api`, which batch requests may call
+        self._api_routes = list()
+
         # Login url is optional
         self.login_url = login_url
 
@@ -823,9 +1116,11 @@ class Brubeck(object):
     def register_api(self, APIClass, prefix=None):
         model, model_name = APIClass.model, APIClass.model.__name__.lower()
 
-        if not JsonSchemaMessageHandler.manifest:
+        ### The first API registered on this app adds the shared routes
+        if not self._api_routes:
             manifest_pattern = "/manifest.json"
             self.add_route_rule(manifest_pattern, JsonSchemaMessageHandler)
+            self.add_route_rule("/batch.json", BatchMessageHandler)
 
         if prefix is None:
             url_prefix = self.api_base_url + model_name
@@ -837,8 +1132,13 @@ class Brubeck(object):
         api_url = ''.join([url_prefix, pattern])
 
         self.add_route_rule(api_url, APIClass)
+        self._api_routes.append((re.compile(api_url, re.UNICODE), APIClass))
         JsonSchemaMessageHandler.add_model(model)
 
+        ### Compile the model's serializer now rather than on a request
+        if hasattr(APIClass, 'compile_serializer'):
+            APIClass.compile_serializer()
+
 
     ###
     ### Application running functions
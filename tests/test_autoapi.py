@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+
+import unittest
+
+import ujson as json
+from gevent.pool import Pool
+
+from brubeck.request_handling import Brubeck
+from brubeck.connections import Request, WSGIConnection
+from brubeck.autoapi import AutoAPIBase, serializer_for
+from brubeck.queryset import DictQueryset
+from brubeck.encoding import RawJSON
+
+from dictshield.document import Document
+from dictshield.fields import StringField, IntField, BooleanField
+from dictshield.fields.compound import ListField, EmbeddedDocumentField
+from dictshield.document import EmbeddedDocument
+
+
+##TestDocument
+class TestDoc(Document):
+    data = StringField()
+    rank = IntField()
+    class Meta:
+        id_field = StringField
+
+
+class TestDocAPI(AutoAPIBase):
+    model = TestDoc
+    queries = DictQueryset()
+
+
+class RenderedQueryset(DictQueryset):
+    """Hands out documents as rendered JSON, marked so tests can tell."""
+    def read_rendered(self, ids):
+        def render(status):
+            datum = dict(status[1], rendered=True)
+            return (status[0], RawJSON(json.dumps(datum)))
+        statuses = self.read(ids)
+        if isinstance(statuses, list):
+            return [render(status) for status in statuses]
+        return render(statuses)
+
+
+class BatchRecordingQueryset(DictQueryset):
+    """Records the ids of each `create_many` call. With `answers`, only
+    that many statuses come back for a batch.
+    """
+    def __init__(self, answers=None, **kw):
+        super(BatchRecordingQueryset, self).__init__(**kw)
+        self.answers = answers
+        self.batches = list()
+
+    def create_many(self, shields):
+        self.batches.append([s.id for s in shields])
+        statuses = super(BatchRecordingQueryset, self).create_many(shields)
+        if self.answers is not None:
+            statuses = statuses[:self.answers]
+        return statuses
+
+
+class Extras(Document):
+    _private_fields = ['secret']
+    title = StringField(default='untitled')
+    done = BooleanField(default=False)
+    tags = ListField(StringField())
+    secret = StringField()
+
+
+class ExtrasAPI(AutoAPIBase):
+    model = Extras
+    queries = DictQueryset()
+
+
+class Part(EmbeddedDocument):
+    name = StringField()
+
+
+class Assembly(Document):
+    parts = ListField(EmbeddedDocumentField(Part))
+
+
+###
+### Tests for ensuring that the autoapi returns good data
+###
+class TestAutoAPI(unittest.TestCase):
+    """
+    a test class for brubeck's autoapi handlers
+    """
+
+    def setUp(self):
+        self.app = Brubeck(msg_conn=WSGIConnection())
+        self.app.register_api(TestDocAPI)
+        TestDocAPI.queries = DictQueryset()
+        TestDocAPI.page_size = None
+        TestDocAPI.filter_fields = ()
+        TestDocAPI.stream_listings = False
+        self.seed()
+
+    def seed(self):
+        shields = [TestDoc(id=iid, data=iid, rank=rank)
+                   for (rank, iid) in enumerate(['d', 'c', 'b', 'a'])]
+        TestDocAPI.queries.create_many(shields)
+
+    def request(self, method, path, query='', body='', headers=None):
+        """Runs a request through the application and returns the status code
+        and the decoded payload.
+        """
+        msg_headers = {'METHOD': method, 'QUERY': query,
+                       'content-type': 'application/json'}
+        msg_headers.update(headers or {})
+        message = Request('sender', 1, path, msg_headers, body,
+                          '%s?%s' % (path, query))
+        handler = self.app.route_message(message)
+        result = handler()
+        return (result['status_code'], json.loads(result['body']))
+
+    def test_get_all(self):
+        (status_code, payload) = self.request('GET', '/testdoc/')
+        self.assertEqual(200, status_code)
+        self.assertEqual(['a', 'b', 'c', 'd'],
+                         sorted([datum['id'] for datum in payload['data']]))
+        self.assertFalse('cursor' in payload)
+
+    def test_get_pages(self):
+        seen = list()
+        query = 'count=3'
+        while True:
+            (status_code, payload) = self.request('GET', '/testdoc/', query)
+            self.assertEqual(200, status_code)
+            self.assertTrue(len(payload['data']) <= 3)
+            seen.extend([datum['id'] for datum in payload['data']])
+            if payload['cursor'] is None:
+                break
+            query = 'count=3&cursor=%s' % payload['cursor']
+        self.assertEqual(['a', 'b', 'c', 'd'], seen)
+
+    def test_page_size(self):
+        TestDocAPI.page_size = 2
+        (status_code, payload) = self.request('GET', '/testdoc/')
+        self.assertEqual(['a', 'b'], [d['id'] for d in payload['data']])
+        self.assertTrue(payload['cursor'])
+
+    def test_filters(self):
+        TestDocAPI.filter_fields = ('data',)
+        TestDocAPI.queries = DictQueryset(indexes={'data': 'hash'})
+        self.seed()
+        (status_code, payload) = self.request('GET', '/testdoc/', 'data=c')
+        self.assertEqual(['c'], [d['id'] for d in payload['data']])
+        (status_code, payload) = self.request('GET', '/testdoc/', 'data__gt=b')
+        self.assertEqual(['c', 'd'], [d['id'] for d in payload['data']])
+        (status_code, payload) = self.request('GET', '/testdoc/', 'data__x=b')
+        self.assertEqual(400, status_code)
+        (status_code, payload) = self.request('GET', '/testdoc/',
+                                              'data__gt=a&count=1')
+        self.assertEqual(['b'], [d['id'] for d in payload['data']])
+        for query in ['data=c&count=0', 'data=c&count=-1']:
+            (status_code, payload) = self.request('GET', '/testdoc/', query)
+            self.assertEqual(400, status_code)
+
+    def test_since(self):
+        TestDocAPI.queries = DictQueryset(time_field='rank')
+        self.seed()
+        (status_code, payload) = self.request('GET', '/testdoc/', 'since=1')
+        self.assertEqual(200, status_code)
+        self.assertEqual(['b', 'a'], [d['id'] for d in payload['data']])
+        (status_code, payload) = self.request('GET', '/testdoc/',
+                                              'since=0&count=1')
+        self.assertEqual(['c'], [d['id'] for d in payload['data']])
+        for query in ['since=0&count=0', 'since=0&count=-1']:
+            (status_code, payload) = self.request('GET', '/testdoc/', query)
+            self.assertEqual(400, status_code)
+
+    def test_patch(self):
+        (status_code, payload) = self.request('PATCH', '/testdoc/b',
+                                              body='{"data": "new"}')
+        self.assertEqual(200, status_code)
+        self.assertEqual('new', payload['data']['data'])
+        self.assertEqual('new', TestDocAPI.queries.read_one('b')[1]['data'])
+        self.assertEqual(2, TestDocAPI.queries.read_one('b')[1]['rank'])
+
+        (status_code, payload) = self.request('PATCH', '/testdoc/a,c',
+                                              body='{"rank": 9}')
+        self.assertEqual([9, 9], [d['rank'] for d in payload['data']])
+
+    def test_patch_errors(self):
+        for (path, body, expected) in [('/testdoc/b', '{"data": 5}', 400),
+                                       ('/testdoc/b', '{"nope": 1}', 400),
+                                       ('/testdoc/b', '{"id": "z"}', 400),
+                                       ('/testdoc/', '{"data": "x"}', 400),
+                                       ('/testdoc/zz', '{"data": "x"}', 404),
+                                       ('/testdoc/a,zz', '{"data": "x"}', 404)]:
+            (status_code, payload) = self.request('PATCH', path, body=body)
+            self.assertEqual(expected, status_code)
+        self.assertEqual('a', TestDocAPI.queries.read_one('a')[1]['data'])
+
+    def test_fields(self):
+        (status_code, payload) = self.request('GET', '/testdoc/', 'fields=rank')
+        self.assertEqual(200, status_code)
+        rows = sorted(payload['data'], key=lambda d: d['id'])
+        self.assertEqual([3, 2, 1, 0], [d['rank'] for d in rows])
+        self.assertFalse(any('data' in d for d in rows))
+        (status_code, payload) = self.request('GET', '/testdoc/c',
+                                              'fields=data')
+        self.assertEqual('c', payload['data']['data'])
+        self.assertFalse('rank' in payload['data'])
+
+        for fields in ['nope', '_cls', 'data,nope']:
+            (status_code, payload) = self.request('GET', '/testdoc/',
+                                                  'fields=%s' % fields)
+            self.assertEqual(400, status_code)
+
+        self.app.register_api(ExtrasAPI)
+        (status_code, payload) = self.request('GET', '/extras/', 'fields=secret')
+        self.assertEqual(400, status_code)
+        (status_code, payload) = self.request('GET', '/extras/', 'fields=title')
+        self.assertEqual(200, status_code)
+
+    def test_rendered(self):
+        TestDocAPI.queries = RenderedQueryset()
+        self.seed()
+        (status_code, payload) = self.request('GET', '/testdoc/b')
+        self.assertEqual(200, status_code)
+        self.assertEqual({'id': 'b', 'data': 'b', 'rank': 2, 'rendered': True,
+                          'status_code': 200, 'status_msg': 'OK'},
+                         dict((k, v) for (k, v) in payload['data'].items()
+                              if k not in ('_cls', '_types')))
+        (status_code, payload) = self.request('GET', '/testdoc/', 'fields=rank')
+        self.assertFalse(any('rendered' in d for d in payload['data']))
+
+    def test_stream_listings(self):
+        TestDocAPI.stream_listings = True
+        TestDocAPI.max_page_size = 3
+        try:
+            message = Request('sender', 1, '/testdoc/',
+                              {'METHOD': 'GET', 'QUERY': 'fields=rank'}, '',
+                              '/testdoc/?fields=rank')
+            result = self.app.route_message(message)()
+        finally:
+            del TestDocAPI.max_page_size
+        self.assertFalse(isinstance(result['body'], basestring))
+        payload = json.loads(''.join(result['body']))
+        self.assertEqual(200, result['status_code'])
+        self.assertEqual([('a', 3), ('b', 2), ('c', 1), ('d', 0)],
+                         [(d['id'], d['rank']) for d in payload['data']])
+        self.assertEqual(200, payload['data'][0]['status_code'])
+
+    def post_ndjson(self, lines):
+        TestDocAPI.ingest_batch_size = 2
+        try:
+            message = Request('sender', 1, '/testdoc/',
+                              {'METHOD': 'POST', 'QUERY': '',
+                               'content-type': 'application/x-ndjson'},
+                              '\n'.join(lines) + '\n', '/testdoc/')
+            result = self.app.route_message(message)()
+            return json.loads(''.join(result['body']))
+        finally:
+            del TestDocAPI.ingest_batch_size
+
+    def test_ndjson_ingest(self):
+        payload = self.post_ndjson(['{"id": "e", "data": "e"}', '', 'not json',
+                                    '{"id": "f", "data": 5}', '{"id": "g"}',
+                                    '{"id": "h"}'])
+        self.assertEqual([(1, 201), (3, 400), (4, 400), (5, 201), (6, 201)],
+                         [(d['line'], d['status_code']) for d in payload['data']])
+        self.assertEqual('h', payload['data'][-1]['id'])
+        self.assertEqual(['a', 'b', 'c', 'd', 'e', 'g', 'h'],
+                         sorted(d['id'] for (s, d) in
+                                TestDocAPI.queries.read_all()))
+
+    def test_ndjson_ingest_short_answer(self):
+        TestDocAPI.queries = BatchRecordingQueryset(answers=1)
+        payload = self.post_ndjson(['{"id": "e"}', '{"id": "f"}',
+                                    '{"id": "g"}'])
+        self.assertEqual([(1, 201), (2, 500), (3, 201)],
+                         [(d['line'], d['status_code']) for d in payload['data']])
+        self.assertEqual('f', payload['data'][1]['id'])
+
+    def test_ndjson_ingest_flushes_invalid_lines(self):
+        TestDocAPI.queries = BatchRecordingQueryset()
+        payload = self.post_ndjson(['{"id": "e"}', 'not json', 'not json',
+                                    'not json', '{"id": "f"}'])
+        self.assertEqual([(1, 201), (2, 400), (3, 400), (4, 400), (5, 201)],
+                         [(d['line'], d['status_code']) for d in payload['data']])
+        self.assertEqual([['e'], ['f']], TestDocAPI.queries.batches)
+
+    def test_msgpack(self):
+        try:
+            import msgpack
+        except ImportError:
+            return
+        message = Request('sender', 1, '/testdoc/',
+                          {'METHOD': 'POST', 'QUERY': '',
+                           'content-type': 'application/x-msgpack',
+                           'accept': 'application/x-msgpack'},
+                          msgpack.packb({'id': 'e', 'data': 'e'}), '/testdoc/')
+        result = self.app.route_message(message)()
+        self.assertEqual(201, result['status_code'])
+        self.assertEqual('application/x-msgpack',
+                         result['headers']['Content-Type'])
+        self.assertEqual('e', msgpack.unpackb(result['body'])['data']['id'])
+        self.assertEqual('e', TestDocAPI.queries.read_one('e')[1]['data'])
+
+    def test_batch(self):
+        operations = [{'method': 'GET', 'path': '/testdoc/b?fields=rank'},
+                      {'method': 'PATCH', 'path': '/testdoc/a',
+                       'body': {'data': 'new'}},
+                      {'method': 'GET', 'path': '/manifest.json'},
+                      {'path': '/testdoc/', 'method': 'GET'}]
+        (status_code, payload) = self.request('POST', '/batch.json',
+                                              body=json.dumps(operations))
+        self.assertEqual(200, status_code)
+        results = payload['data']
+        self.assertEqual([200, 200, 404, 200],
+                         [r['status_code'] for r in results])
+        self.assertEqual({'id': 'b', 'rank': 2, 'status_code': 200,
+                          'status_msg': 'OK'}, results[0]['body']['data'])
+        self.assertEqual('new', results[1]['body']['data']['data'])
+        self.assertEqual(None, results[2]['body'])
+        self.assertEqual(4, len(results[3]['body']['data']))
+
+        for body in ['{}', '[{"method": "GET"}]', '[1]',
+                     '[{"path": "/testdoc/", "method": 5}]',
+                     '[{"path": "/testdoc/", "method": "FETCH"}]']:
+            (status_code, payload) = self.request('POST', '/batch.json',
+                                                  body=body)
+            self.assertEqual(400, status_code)
+
+    def test_batch_with_bounded_pool(self):
+        app = Brubeck(msg_conn=WSGIConnection(), pool=lambda: Pool(1))
+        app.register_api(TestDocAPI)
+        body = json.dumps([{'method': 'GET', 'path': '/testdoc/b'}])
+        message = Request('sender', 1, '/batch.json',
+                          {'METHOD': 'POST', 'QUERY': '',
+                           'content-type': 'application/json'},
+                          body, '/batch.json')
+        batch = app.pool.spawn(app.route_message(message))
+        batch.join(timeout=2)
+        self.assertTrue(batch.ready())
+        payload = json.loads(batch.value['body'])
+        self.assertEqual(200, payload['data'][0]['status_code'])
+
+    def test_manifest(self):
+        def get(headers):
+            msg_headers = {'METHOD': 'GET', 'QUERY': ''}
+            msg_headers.update(headers)
+            message = Request('sender', 1, '/manifest.json', msg_headers, '',
+                              '/manifest.json')
+            return self.app.route_message(message)()
+
+        result = get({})
+        self.assertEqual(200, result['status_code'])
+        self.assertTrue('TestDoc' in [schema['title'] for schema
+                                    in json.loads(result['body'])])
+        etag = result['headers']['ETag']
+
+        result = get({'accept-encoding': 'gzip, deflate'})
+        self.assertEqual('gzip', result['headers']['Content-Encoding'])
+        gzip_etag = result['headers']['ETag']
+        self.assertNotEqual(etag, gzip_etag)
+        import zlib
+        self.assertEqual(get({})['body'],
+                         zlib.decompress(result['body'], 16 + zlib.MAX_WBITS))
+
+        for accept_encoding in ['gzip;q=0, *', 'identity', '*;q=0']:
+            result = get({'accept-encoding': accept_encoding})
+            self.assertFalse('Content-Encoding' in result['headers'])
+            self.assertEqual(etag, result['headers']['ETag'])
+        result = get({'accept-encoding': '*'})
+        self.assertEqual('gzip', result['headers']['Content-Encoding'])
+
+        for if_none_match in [etag, '"other", %s' % etag, 'W/' + etag, '*']:
+            result = get({'if-none-match': if_none_match})
+            self.assertEqual(304, result['status_code'])
+            self.assertEqual('', result['body'])
+        self.assertEqual(200, get({'if-none-match': '"other"'})['status_code'])
+
+        # only the tag of the variant being sent counts
+        self.assertEqual(200, get({'if-none-match': gzip_etag})['status_code'])
+        result = get({'if-none-match': etag, 'accept-encoding': 'gzip'})
+        self.assertEqual(200, result['status_code'])
+        result = get({'if-none-match': gzip_etag, 'accept-encoding': 'gzip'})
+        self.assertEqual(304, result['status_code'])
+
+    def test_serializer(self):
+        def presentable(model, datum):
+            data = model.make_json_ownersafe(
+                model(**datum).to_json(encode=False), encode=False)
+            data['id'] = str(datum.get('_id', datum.get('id')))
+            return data
+
+        cases = [(TestDoc, TestDoc(id='x', data='y').to_python()),
+                 (TestDoc, {'id': 'x', 'rank': 0, 'nope': 1}),
+                 (Extras, Extras(title='t', secret='s').to_python()),
+                 (Extras, Extras(tags=['a', 'b'], done=True).to_python())]
+        for (model, datum) in cases:
+            self.assertEqual(presentable(model, datum),
+                             serializer_for(model)(datum))
+        self.assertEqual(None, serializer_for(Assembly))
+
+    def test_bad_cursor(self):
+        (status_code, payload) = self.request('GET', '/testdoc/', 'cursor=!!')
+        self.assertEqual(400, status_code)
+
+    def test_bad_count(self):
+        for query in ['count=0', 'count=-1']:
+            (status_code, payload) = self.request('GET', '/testdoc/', query)
+            self.assertEqual(400, status_code)
+
+
+##
+## This will run our tests
+##
+if __name__ == '__main__':
+    unittest.main()
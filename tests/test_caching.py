@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import time
+import os
+
+import mock
+
+from brubeck.request_handling import Brubeck, WebMessageHandler
+from brubeck.connections import Request, WSGIConnection
+from brubeck.caching import (BaseCacheStore, LRUCacheStore, RedisCacheStore,
+                             TieredCacheStore, RedisCacheInvalidator,
+                             SessionMixin, SharedMemoryCacheStore)
+from brubeck.encoding import PickleCodec, JSONCodec, MsgpackCodec, ZlibCodec
+from brubeck.encoding import (TaggedCodec, LegacyJSONCodec, TAG_JSON,
+                              TAG_ZLIB_JSON)
+
+
+class MockRedis(object):
+    """Just enough of redis-py's pub/sub to stand in for a local Redis."""
+    def __init__(self):
+        self.published = list()
+
+    def publish(self, channel, message):
+        self.published.append({'type': 'message', 'channel': channel,
+                               'data': message})
+
+    def pubsub(self):
+        return self
+
+    def subscribe(self, channel):
+        pass
+
+    def listen(self):
+        return iter([{'type': 'subscribe'}] + self.published)
+
+
+class CountingCacheStore(BaseCacheStore):
+    """Counts the writes a session makes."""
+    def __init__(self, **kwargs):
+        super(CountingCacheStore, self).__init__(**kwargs)
+        self.writes = list()
+
+    def save(self, key, data, expire=None):
+        self.writes.append('save')
+        super(CountingCacheStore, self).save(key, data, expire=expire)
+
+    def touch(self, key, expire):
+        self.writes.append('touch')
+        super(CountingCacheStore, self).touch(key, expire)
+
+
+class SessionHandler(SessionMixin, WebMessageHandler):
+    session_store = CountingCacheStore()
+
+    def get(self):
+        if self.get_argument('logout'):
+            self.delete_session()
+        name = self.get_argument('name')
+        if name:
+            self.session['name'] = name
+        if self.get_argument('peek'):
+            self.set_body(self.session.get('name', ''))
+        return self.render()
+
+
+class TestBaseCacheStore(unittest.TestCase):
+    """
+    a test class for brubeck's in-memory cache store
+    """
+
+    def setUp(self):
+        self.store = BaseCacheStore()
+
+    def test_save_load_delete(self):
+        self.store.save('foo', 'bar')
+        self.assertEqual('bar', self.store.load('foo'))
+        self.store.delete('foo')
+        self.assertEqual(None, self.store.load('foo'))
+
+    def test_delete_expired(self):
+        self.store.save('old', 'data', expire=time.time() - 1)
+        self.store.save('new', 'data', expire=time.time() + 60)
+        self.store.delete_expired()
+        self.assertEqual(['new'], self.store._cache_store.keys())
+
+    def test_many(self):
+        self.store.save_many({'a': 1, 'b': 2})
+        self.assertEqual([1, None, 2], self.store.load_many(['a', 'c', 'b']))
+        self.store.delete_many(['a', 'b'])
+        self.assertEqual([None, None], self.store.load_many(['a', 'b']))
+
+    def test_codecs(self):
+        value = {'list': [1, 2], 'text': 'take five'}
+        codecs = [PickleCodec(), JSONCodec(), ZlibCodec(JSONCodec(), 9)]
+        try:
+            codecs.append(MsgpackCodec())
+        except EnvironmentError:
+            pass
+        for codec in codecs:
+            store = BaseCacheStore(codec=codec)
+            store.save('key', value)
+            self.assertTrue(isinstance(store._cache_store['key']['data'], str))
+            self.assertEqual(value, store.load('key'))
+
+    def test_tagged_codecs(self):
+        value = {'list': [1, 2], 'text': 'take five'}
+        old = TaggedCodec(TAG_JSON)
+        new = TaggedCodec(TAG_ZLIB_JSON, level=9, legacy=LegacyJSONCodec())
+        self.assertEqual(TAG_ZLIB_JSON, new.encode(value)[0])
+
+        # both read values from either, plus untagged legacy values
+        for data in [old.encode(value), new.encode(value),
+                     JSONCodec().encode(value),
+                     ZlibCodec(JSONCodec()).encode(value)]:
+            self.assertEqual(value, new.decode(data))
+        self.assertEqual(value, old.decode(new.encode(value)))
+        self.assertRaises(ValueError, old.decode, JSONCodec().encode(value))
+        self.assertRaises(ValueError, TaggedCodec, 'j')
+
+    def test_raw_json(self):
+        from brubeck.encoding import RawJSON, encode_json
+        import ujson as json
+        raw = RawJSON('{"id": "a", "n": [1, 2]}')
+        payload = {'data': [raw.with_fields({'status_code': 200}),
+                            {'id': 'b'}], 'count': 2}
+        self.assertEqual({'data': [{'id': 'a', 'n': [1, 2], 'status_code': 200},
+                                   {'id': 'b'}], 'count': 2},
+                         json.loads(encode_json(payload)))
+        self.assertEqual('{"x":1}', RawJSON(' {} ').with_fields({'x': 1}).json)
+        self.assertRaises(ValueError, RawJSON('[1]').with_fields, {'x': 1})
+
+
+class TestLRUCacheStore(unittest.TestCase):
+    """
+    a test class for brubeck's bounded LRU cache store
+    """
+
+    def test_evicts_least_recently_used(self):
+        store = LRUCacheStore(max_entries=2)
+        store.save('a', 1)
+        store.save('b', 2)
+        store.load('a')
+        store.save('c', 3)
+
+        self.assertEqual(None, store.load('b'))
+        self.assertEqual(1, store.load('a'))
+        self.assertEqual(3, store.load('c'))
+        self.assertEqual(1, store.stats()['evictions'])
+
+    def test_evicts_by_bytes(self):
+        store = LRUCacheStore(max_entries=None, max_bytes=10)
+        store.save('a', 'x' * 6)
+        store.save('b', 'y' * 6)
+        self.assertEqual(None, store.load('a'))
+        self.assertEqual(6, store.stats()['bytes'])
+
+        store.save('b', 'z')
+        self.assertEqual(1, store.stats()['bytes'])
+
+    def test_expiry(self):
+        store = LRUCacheStore()
+        store.save('old', 'data', expire=time.time() - 1)
+        store.save('new', 'data', expire=time.time() + 60)
+        self.assertEqual(None, store.load('old'))
+        self.assertEqual('data', store.load('new'))
+        self.assertEqual(1, store.stats()['expirations'])
+
+    def test_overwrite_keeps_new_expiry(self):
+        store = LRUCacheStore()
+        store.save('key', 'old', expire=time.time() - 1)
+        store.save('key', 'new', expire=time.time() + 60)
+        self.assertEqual('new', store.load('key'))
+
+    def test_stale_heap_entries_are_compacted(self):
+        store = LRUCacheStore()
+        for i in range(500):
+            store.save('key', i, expire=time.time() + 60)
+        self.assertTrue(len(store._expire_heap) < 100)
+
+    def test_counters(self):
+        store = LRUCacheStore()
+        store.save('foo', 'bar')
+        store.load('foo')
+        store.load('missing')
+        stats = store.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['entries'])
+
+
+class TestSessionMixin(unittest.TestCase):
+    """
+    a test class for brubeck's cache backed sessions
+    """
+
+    def setUp(self):
+        self.app = Brubeck(msg_conn=WSGIConnection(), cookie_secret='secret')
+        self.store = SessionHandler.session_store = CountingCacheStore()
+
+    def request(self, query, cookie=None):
+        headers = {'METHOD': 'GET', 'QUERY': query}
+        if cookie:
+            headers['cookie'] = cookie
+        message = Request('sender', 1, '/', headers, '', '/?' + query)
+        handler = SessionHandler(self.app, message)
+        return (handler, handler())
+
+    def test_untouched_session_makes_no_writes(self):
+        (handler, result) = self.request('')
+        self.assertEqual([], self.store.writes)
+        self.assertFalse('Set-Cookie' in result['headers'])
+
+    def test_new_session_is_not_saved_until_changed(self):
+        (handler, result) = self.request('peek=1')
+        self.assertEqual([], self.store.writes)
+        self.assertFalse('Set-Cookie' in result['headers'])
+
+    def test_changed_session_is_saved_once(self):
+        (handler, result) = self.request('name=dude')
+        self.assertEqual(['save'], self.store.writes)
+        cookie = result['headers']['Set-Cookie'].split(';')[0]
+
+        (handler, result) = self.request('peek=1', cookie=cookie)
+        self.assertEqual('dude', result['body'])
+        self.assertEqual(['save', 'touch'], self.store.writes)
+        self.assertFalse('Set-Cookie' in result['headers'])
+
+        (handler, result) = self.request('name=other', cookie=cookie)
+        self.assertEqual(['save', 'touch', 'save'], self.store.writes)
+        self.assertEqual({'name': 'other'},
+                         self.store.load(handler.session.session_id))
+
+    def test_write_after_delete_keeps_new_cookie(self):
+        (handler, result) = self.request('name=dude')
+        cookie = result['headers']['Set-Cookie'].split(';')[0]
+
+        (handler, result) = self.request('logout=1&name=other', cookie=cookie)
+        set_cookie = result['headers']['Set-Cookie'].lower()
+        self.assertFalse('expires' in set_cookie or 'max-age' in set_cookie)
+        self.assertNotEqual(cookie.lower(), set_cookie.split(';')[0])
+        self.assertEqual({'name': 'other'},
+                         self.store.load(handler.session.session_id))
+
+    def test_bad_cookie_starts_new_session(self):
+        (handler, result) = self.request('peek=1', cookie='session_id=forged')
+        self.assertTrue(handler.session.is_new)
+
+
+class TestRedisCacheStore(unittest.TestCase):
+    """
+    a test class for brubeck's redis cache store
+    """
+
+    def test_save_uses_setex(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            redis_connection = patchedRedis()
+            store = RedisCacheStore(redis_connection=redis_connection)
+            store.save('foo', 'bar', expire=time.time() + 60)
+            store.save('baz', 'bar')
+
+            (name, args, kwargs) = redis_connection.mock_calls[0]
+            self.assertEqual('setex', name)
+            self.assertEqual('foo', kwargs['name'])
+            self.assertTrue(kwargs['time'] in (59, 60))
+            self.assertEqual(('set', ('baz', 'bar'), {}),
+                             redis_connection.mock_calls[1])
+
+    def test_subsecond_expiry_rounds_up(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            redis_connection = patchedRedis()
+            store = RedisCacheStore(redis_connection=redis_connection)
+            store.save('foo', 'bar', expire=time.time() + 0.3)
+
+            (name, args, kwargs) = redis_connection.mock_calls[0]
+            self.assertEqual('setex', name)
+            self.assertEqual(1, kwargs['time'])
+
+    def test_many(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            redis_connection = patchedRedis()
+            redis_connection.mget.return_value = ['{"a":1}', None]
+            store = RedisCacheStore(redis_connection=redis_connection,
+                                    codec=JSONCodec())
+
+            self.assertEqual([{'a': 1}, None], store.load_many(['a', 'b']))
+            store.save_many({'a': {'a': 1}})
+            store.delete_many(['a', 'b'])
+
+            expected = [
+                ('mget', (['a', 'b'],), {}),
+                ('pipeline', (), {'transaction': False}),
+                ('pipeline().set', ('a', '{"a":1}'), {}),
+                ('pipeline().execute', (), {}),
+                ('delete', ('a', 'b'), {}),
+            ]
+            self.assertEqual(expected, redis_connection.mock_calls)
+
+
+class TestSharedMemoryCacheStore(unittest.TestCase):
+    """
+    a test class for brubeck's mmap backed cache store
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.tmp_dir, 'cache')
+        self.worker_a = SharedMemoryCacheStore(path, num_slots=8, slot_size=128)
+        self.worker_b = SharedMemoryCacheStore(path, num_slots=8, slot_size=128)
+
+    def tearDown(self):
+        self.worker_a.close()
+        self.worker_b.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_workers_share_entries(self):
+        self.worker_a.save('key', {'take': 5})
+        self.assertEqual({'take': 5}, self.worker_b.load('key'))
+        self.worker_b.save('key', 'changed')
+        self.assertEqual('changed', self.worker_a.load('key'))
+        self.worker_b.delete('key')
+        self.assertEqual(None, self.worker_a.load('key'))
+
+    def test_expiry(self):
+        self.worker_a.save('old', 'data', expire=time.time() - 1)
+        self.worker_a.save('new', 'data', expire=time.time() + 60)
+        self.assertEqual(None, self.worker_b.load('old'))
+        self.assertEqual('data', self.worker_b.load('new'))
+
+        self.worker_a.touch('new', time.time() - 1)
+        self.worker_a.delete_expired()
+        self.assertEqual(None, self.worker_b.load('new'))
+
+    def test_oversized_values_are_not_cached(self):
+        self.worker_a.save('key', 'small')
+        self.worker_a.save('key', 'x' * 200)
+        self.assertEqual(None, self.worker_b.load('key'))
+
+    def test_eviction_keeps_table_bounded(self):
+        for i in range(50):
+            self.worker_a.save('key-%d' % i, i)
+        found = [self.worker_b.load('key-%d' % i) for i in range(50)]
+        self.assertEqual(8, len([v for v in found if v is not None]))
+        self.assertEqual(49, self.worker_b.load('key-49'))
+
+
+class TestTieredCacheStore(unittest.TestCase):
+    """
+    a test class for brubeck's two-tier cache store
+    """
+
+    def setUp(self):
+        self.backing = BaseCacheStore()
+        self.redis = MockRedis()
+        self.worker_a = TieredCacheStore(
+            self.backing, negative_ttl=60,
+            invalidator=RedisCacheInvalidator(self.redis))
+        self.worker_b = TieredCacheStore(
+            self.backing, invalidator=RedisCacheInvalidator(self.redis))
+
+    def test_reads_are_served_from_l1(self):
+        self.backing.save('key', 'value')
+        self.assertEqual('value', self.worker_a.load('key'))
+        self.backing.delete('key')
+        self.assertEqual('value', self.worker_a.load('key'))
+
+    def test_negative_caching(self):
+        self.assertEqual(None, self.worker_a.load('key'))
+        self.backing.save('key', 'value')
+        self.assertEqual(None, self.worker_a.load('key'))
+        self.assertEqual('value', self.worker_b.load('key'))
+
+    def test_load_many(self):
+        self.backing.save_many({'a': 1, 'b': 2})
+        self.assertEqual(1, self.worker_a.load('a'))
+        self.backing.delete('a')
+        self.assertEqual([1, 2, None],
+                         self.worker_a.load_many(['a', 'b', 'c']))
+        self.backing.save('c', 3)
+        self.assertEqual([None], self.worker_a.load_many(['c']))
+
+    def test_l1_respects_key_expiry(self):
+        self.worker_a.save('key', 'value', expire=time.time() - 1)
+        self.assertEqual(None, self.worker_a.l1_store.load('key'))
+
+    def test_invalidation_across_workers(self):
+        self.worker_a.save('key', 'old')
+        self.worker_b.save('key', 'new')
+        self.assertEqual('old', self.worker_a.load('key'))
+
+        invalidated = list()
+        def invalidate(key):
+            invalidated.append(key)
+            self.worker_a.invalidate(key)
+        self.worker_a.invalidator.listen(invalidate)
+
+        self.assertEqual(['key'], invalidated)  # its own write is ignored
+        self.assertEqual('new', self.worker_a.load('key'))
+
+
+##
+## This will run our tests
+##
+if __name__ == '__main__':
+    unittest.main()
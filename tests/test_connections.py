@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import unittest
+
+import brubeck
+from brubeck.request_handling import Brubeck
+from brubeck.connections import BroadcastBus, WSGIConnection
+from brubeck.connections import Mongrel2Connection
+from brubeck.request_handling import buffered, http_chunk
+
+import gevent
+
+
+class MockConnection(object):
+    """Records `reply_bulk` calls instead of talking to Mongrel2."""
+    MAX_IDENTS = 2
+
+    def __init__(self):
+        self.sent = list()
+
+    def reply_bulk(self, uuid, idents, data):
+        self.sent.append((uuid, sorted(idents), data))
+
+
+class MockRequest(object):
+    def __init__(self, sender, conn_id):
+        self.sender = sender
+        self.conn_id = conn_id
+
+
+class TestStreamedResponses(unittest.TestCase):
+    """
+    a test class for sending bodies that are produced as they're sent
+    """
+
+    def test_buffered(self):
+        pieces = ['ab', 'cd', 'e', 'fgh', 'i']
+        self.assertEqual(['abcd', 'efgh', 'i'], list(buffered(pieces, 4)))
+        self.assertEqual([], list(buffered([], 4)))
+
+    def test_mongrel2_chunked_reply(self):
+        connection = Mongrel2Connection.__new__(Mongrel2Connection)
+        sent = list()
+        connection.reply = lambda request, msg: sent.append(msg)
+        result = {'status_code': 200, 'status_msg': 'OK',
+                  'headers': {'Content-Length': 3},
+                  'body': (piece for piece in ['[1', ',2', ']'])}
+        connection.reply_stream(MockRequest('sender', 1), result)
+
+        self.assertTrue(sent[0].startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertTrue('Transfer-Encoding: chunked' in sent[0])
+        self.assertFalse('Content-Length' in sent[0])
+        self.assertEqual([http_chunk('[1,2]'), '0\r\n\r\n'], sent[1:])
+
+    def test_failed_stream_closes(self):
+        def body():
+            yield '[1'
+            raise ValueError('gone')
+        connection = Mongrel2Connection.__new__(Mongrel2Connection)
+        sent = list()
+        connection.reply = lambda request, msg: sent.append(msg)
+        connection.reply_stream(MockRequest('sender', 1),
+                                {'status_code': 200, 'status_msg': 'OK',
+                                 'headers': {}, 'body': body()})
+        self.assertEqual('', sent[-1])
+
+
+class TestBroadcastBus(unittest.TestCase):
+    """
+    a test class for brubeck's cross-worker broadcast bus
+    """
+
+    def setUp(self):
+        self.conn_a = MockConnection()
+        self.conn_b = MockConnection()
+        addr_a = 'inproc://broadcast-a-%s' % id(self)
+        addr_b = 'inproc://broadcast-b-%s' % id(self)
+        self.bus_a = BroadcastBus(self.conn_a, addr_a, [addr_a, addr_b])
+        self.bus_b = BroadcastBus(self.conn_b, addr_b, [addr_a, addr_b])
+
+    def tearDown(self):
+        self.bus_a.close()
+        self.bus_b.close()
+
+    def test_local_delivery_chunks_idents(self):
+        for conn_id in range(3):
+            self.bus_a.subscribe('feed', MockRequest('m2', conn_id))
+        self.bus_a.deliver('feed', 'hello')
+
+        self.assertEqual(2, len(self.conn_a.sent))
+        delivered = sum([idents for (_, idents, _) in self.conn_a.sent], [])
+        self.assertEqual(['0', '1', '2'], sorted(delivered))
+
+        # long poll clients are only answered once
+        self.bus_a.deliver('feed', 'again')
+        self.assertEqual(2, len(self.conn_a.sent))
+
+    def test_publish_reaches_other_worker(self):
+        self.bus_b.subscribe('feed', MockRequest('m2', 7))
+        self.bus_b.subscribe('other', MockRequest('m2', 8))
+        gevent.sleep(0.05)  # let the SUB filters reach the publisher
+
+        self.bus_a.publish('feed', 'hello')
+        self.assertEqual(True, self.bus_b.recv())
+        self.assertEqual([('m2', ['7'], 'hello')], self.conn_b.sent)
+        self.assertEqual([], self.conn_a.sent)
+
+    def test_own_messages_are_ignored(self):
+        self.bus_a.subscribe('feed', MockRequest('m2', 1))
+        self.bus_a.add_listener('feed', lambda channel, data: None)
+        gevent.sleep(0.05)
+
+        self.bus_a.publish('feed', 'hello')
+        self.assertEqual(False, self.bus_a.recv())
+        self.assertEqual(1, len(self.conn_a.sent))
+
+    def test_listeners(self):
+        received = list()
+        self.bus_b.add_listener('cache', lambda c, d: received.append(d))
+        gevent.sleep(0.05)
+
+        self.bus_a.publish('cache', 'key')
+        self.bus_b.recv()
+        self.assertEqual(['key'], received)
+
+    def test_start_on_application_pool(self):
+        app = Brubeck(msg_conn=WSGIConnection())
+        self.bus_b.start(app)
+        self.bus_b.subscribe('feed', MockRequest('m2', 3))
+        gevent.sleep(0.05)
+
+        self.bus_a.publish('feed', 'hello')
+        gevent.sleep(0.05)
+        self.assertEqual([('m2', ['3'], 'hello')], self.conn_b.sent)
+        app.pool.kill()
+
+
+##
+## This will run our tests
+##
+if __name__ == '__main__':
+    unittest.main()
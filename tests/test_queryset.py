@@ -3,6 +3,12 @@
 import unittest
 
 import mock
+import os
+import shutil
+import tempfile
+import weakref
+import gc
+import gevent
 
 import brubeck
 from handlers.method_handlers import simple_handler_method
@@ -10,7 +16,7 @@ from brubeck.request_handling import Brubeck, WebMessageHandler, JSONMessageHand
 from brubeck.connections import to_bytes, Request
 from brubeck.request_handling import(
     cookie_encode, cookie_decode,
-    cookie_is_encoded, http_response
+    cookie_is_encoded, http_response, coro_pool
 )
 from handlers.object_handlers import(
     SimpleWebHandlerObject, CookieWebHandlerObject,
@@ -21,9 +27,13 @@ from fixtures import request_handler_fixtures as FIXTURES
 
 from brubeck.autoapi import AutoAPIBase
 from brubeck.queryset import DictQueryset, AbstractQueryset, RedisQueryset
+from brubeck.queryset import RedisHashQueryset
+from brubeck.queryset import BatchingQueryset, CachedQueryset, SQLiteQueryset
+from brubeck.queryset import ShardedQueryset, WriteBehindQueryset
+from brubeck.caching import LRUCacheStore
 
 from dictshield.document import Document
-from dictshield.fields import StringField
+from dictshield.fields import StringField, IntField
 from brubeck.request_handling import FourOhFourException
 
 ##TestDocument
@@ -32,6 +42,12 @@ class TestDoc(Document):
     class Meta:
         id_field = StringField
 
+class RankedDoc(Document):
+    data = StringField()
+    rank = IntField()
+    class Meta:
+        id_field = StringField
+
 ###
 ### Tests for ensuring that the autoapi returns good data
 ###
@@ -183,6 +199,706 @@ class TestDictQueryset(unittest.TestCase):
         self.assertEqual(self.queryset.MSG_OK, status)
         self.assertEqual(shield_to_keep.to_python(), datum)
 
+    def test_read_page(self):
+        self.seed_reads()
+        cursor, statuses = self.queryset.read_page(limit=2)
+        self.assertEqual(['bar', 'baz'], [d['id'] for trash, d in statuses])
+
+        self.queryset.create_one(TestDoc(id="bat"))  # sorts before the cursor
+        cursor, statuses = self.queryset.read_page(cursor=cursor, limit=2)
+        self.assertEqual(['foo'], [d['id'] for trash, d in statuses])
+        self.assertEqual(None, cursor)
+
+        for limit in [0, -1]:
+            self.assertRaises(ValueError, self.queryset.read_page, limit=limit)
+
+    def test_iter_all(self):
+        self.seed_reads()
+        self.queryset.destroy_one('bar')
+        statuses = list(self.queryset.iter_all(page_size=1))
+        self.assertEqual(['baz', 'foo'], [d['id'] for trash, d in statuses])
+
+
+class TestDictQuerysetIndexes(unittest.TestCase):
+    """
+    a test class for dictqueryset's secondary indexes.
+    """
+
+    def setUp(self):
+        self.queryset = DictQueryset(indexes={'data': DictQueryset.INDEX_HASH,
+                                              'rank': DictQueryset.INDEX_SORTED})
+        self.queryset.create_many([RankedDoc(id="foo", data="a", rank=3),
+                                   RankedDoc(id="bar", data="b", rank=1),
+                                   RankedDoc(id="baz", data="a", rank=2),
+                                   RankedDoc(id="bat", data="b", rank=2)])
+
+    def ids(self, statuses):
+        return [datum['id'] for status, datum in statuses]
+
+    def test_hash_index(self):
+        self.assertEqual(['baz', 'foo'], self.ids(self.queryset.read_where(data="a")))
+        self.assertEqual([], self.queryset.read_where(data="nope"))
+
+    def test_sorted_index(self):
+        self.assertEqual(['bat', 'baz', 'foo'],
+                         self.ids(self.queryset.read_where(rank__gte=2)))
+        self.assertEqual(['bar'], self.ids(self.queryset.read_where(rank__lt=2)))
+        self.assertEqual(['bat', 'baz'],
+                         self.ids(self.queryset.read_where(rank=2)))
+
+    def test_combined_and_unindexed(self):
+        self.assertEqual(['baz'],
+                         self.ids(self.queryset.read_where(data="a", rank__lte=2)))
+        self.assertEqual(['foo'], self.ids(self.queryset.read_where(id="foo")))
+
+    def test_limit(self):
+        self.assertEqual(['bat', 'baz'],
+                         self.ids(self.queryset.read_where(rank__gte=2,
+                                                           limit=2)))
+        self.assertRaises(ValueError, self.queryset.read_where, data="a",
+                          limit=0)
+
+    def test_indexes_follow_writes(self):
+        self.queryset.update_one(RankedDoc(id="foo", data="b", rank=0))
+        self.queryset.destroy_one("baz")
+        self.assertEqual([], self.queryset.read_where(data="a"))
+        self.assertEqual(['foo', 'bar'],
+                         [d['id'] for d in sorted(
+                             [d for s, d in self.queryset.read_where(rank__lt=2)],
+                             key=lambda d: d['rank'])])
+
+    def test_bad_operator(self):
+        self.assertRaises(ValueError, self.queryset.read_where, rank__near=2)
+
+    def test_read_since(self):
+        queryset = DictQueryset(time_field='rank')
+        queryset.create_many([RankedDoc(id="foo", rank=30),
+                              RankedDoc(id="bar", rank=10),
+                              RankedDoc(id="baz", rank=20)])
+        self.assertEqual(['baz', 'foo'], self.ids(queryset.read_since(10)))
+        self.assertEqual(['bar'], self.ids(queryset.read_since(0, limit=1)))
+        queryset.update_one(RankedDoc(id="bar", rank=40))
+        self.assertEqual(['foo', 'bar'], self.ids(queryset.read_since(20)))
+        self.assertEqual([], queryset.read_since(40))
+
+    def test_update_fields(self):
+        (status, datum) = self.queryset.update_fields('foo', {'data': 'b'})
+        self.assertEqual(DictQueryset.MSG_UPDATED, status)
+        self.assertEqual(3, datum['rank'])
+        self.assertEqual(['bar', 'bat', 'foo'],
+                         self.ids(self.queryset.read_where(data='b')))
+        self.assertEqual((DictQueryset.MSG_FAILED, 'nope'),
+                         self.queryset.update_fields('nope', {'data': 'b'}))
+
+    def test_read_fields(self):
+        self.assertEqual((DictQueryset.MSG_OK, {'id': 'foo', 'rank': 3}),
+                         self.queryset.read('foo', fields=['rank']))
+        statuses = self.queryset.read(['bar', 'nope'], fields=['data'])
+        self.assertEqual([(DictQueryset.MSG_OK, {'id': 'bar', 'data': 'b'}),
+                          (DictQueryset.MSG_FAILED, 'nope')], statuses)
+
+    def test_read_since_needs_time_field(self):
+        self.assertRaises(NotImplementedError, self.queryset.read_since, 0)
+
+
+class CountingQueryset(DictQueryset):
+    """Records the ids of each `read_many` call."""
+    def __init__(self, **kw):
+        super(CountingQueryset, self).__init__(**kw)
+        self.batches = list()
+
+    def read_many(self, ids):
+        self.batches.append(list(ids))
+        return super(CountingQueryset, self).read_many(ids)
+
+
+class TestBatchingQueryset(unittest.TestCase):
+    """
+    a test class for batching concurrent point reads.
+    """
+
+    def setUp(self):
+        self.backing = CountingQueryset()
+        self.backing.create_many([TestDoc(id="foo"), TestDoc(id="bar")])
+
+    def read_concurrently(self, queryset, ids):
+        greenlets = [gevent.spawn(queryset.read_one, iid) for iid in ids]
+        gevent.joinall(greenlets)
+        return [greenlet.get() for greenlet in greenlets]
+
+    def test_reads_in_one_tick_share_a_batch(self):
+        queryset = BatchingQueryset(self.backing)
+        results = self.read_concurrently(queryset, ['foo', 'bar', 'foo', 'nope'])
+        self.assertEqual([['foo', 'bar', 'nope']], self.backing.batches)
+        self.assertEqual(['foo', 'bar', 'foo'],
+                         [datum['id'] for (status, datum) in results[:3]])
+        self.assertEqual((queryset.MSG_FAILED, 'nope'), results[3])
+
+    def test_max_batch(self):
+        queryset = BatchingQueryset(self.backing, window=0.01, max_batch=2)
+        self.read_concurrently(queryset, ['foo', 'bar', 'nope'])
+        self.assertEqual([['foo', 'bar']], self.backing.batches[:1])
+        self.assertEqual(2, len(self.backing.batches))
+
+    def test_errors_reach_every_caller(self):
+        def broken(ids):
+            raise IOError('down')
+        self.backing.read_many = broken
+        queryset = BatchingQueryset(self.backing)
+
+        def read_one(iid):
+            # caught here so gevent's hub doesn't print the traceback
+            try:
+                return queryset.read_one(iid)
+            except IOError, e:
+                return e
+
+        greenlets = [gevent.spawn(read_one, iid) for iid in ['a', 'b']]
+        gevent.joinall(greenlets)
+        self.assertTrue(all(isinstance(g.value, IOError) for g in greenlets))
+
+    def test_short_answers_fail_the_rest(self):
+        read_many = self.backing.read_many
+        self.backing.read_many = lambda ids: read_many(ids)[:1]
+        queryset = BatchingQueryset(self.backing)
+        results = self.read_concurrently(queryset, ['foo', 'bar'])
+        self.assertEqual(queryset.MSG_OK, results[0][0])
+        self.assertEqual((queryset.MSG_FAILED, 'bar'), results[1])
+
+    def test_passes_writes_through(self):
+        queryset = BatchingQueryset(self.backing)
+        queryset.create_one(TestDoc(id="baz"))
+        self.assertEqual(3, len(self.backing.read_all()))
+
+
+class TestCachedQueryset(unittest.TestCase):
+    """
+    a test class for the read-through caching queryset.
+    """
+
+    def setUp(self):
+        self.backing = CountingQueryset()
+        self.backing.create_many([TestDoc(id="foo", data="1"),
+                                  TestDoc(id="bar", data="2")])
+        self.cache = LRUCacheStore()
+        self.queryset = CachedQueryset(self.backing, self.cache, ttl=60,
+                                       negative_ttl=60, key_prefix='doc:')
+
+    def test_read_one_reads_through(self):
+        self.backing.read_one = mock.Mock(wraps=self.backing.read_one)
+        self.assertEqual('1', self.queryset.read_one('foo')[1]['data'])
+        self.assertEqual('1', self.queryset.read_one('foo')[1]['data'])
+        self.assertEqual(1, self.backing.read_one.call_count)
+        self.assertEqual('1', self.cache.load('doc:foo')[0]['data'])
+
+    def test_read_many_only_asks_for_misses(self):
+        self.queryset.read_one('foo')
+        statuses = self.queryset.read_many(['foo', 'bar', 'nope'])
+        self.assertEqual([['bar', 'nope']], self.backing.batches)
+        self.assertEqual(['1', '2'], [d['data'] for (s, d) in statuses[:2]])
+        self.assertEqual((self.queryset.MSG_FAILED, 'nope'), statuses[2])
+
+        # the missing id is cached too
+        self.assertEqual((self.queryset.MSG_FAILED, 'nope'),
+                         self.queryset.read_many(['nope'])[0])
+        self.assertEqual(1, len(self.backing.batches))
+
+    def test_writes_invalidate(self):
+        self.queryset.read_many(['foo', 'nope'])
+        self.queryset.update_one(TestDoc(id="foo", data="3"))
+        self.queryset.create_one(TestDoc(id="nope", data="4"))
+        self.assertEqual(['3', '4'], [d['data'] for (s, d)
+                                      in self.queryset.read_many(['foo', 'nope'])])
+        self.queryset.destroy_one('foo')
+        self.assertEqual(None, self.cache.load('doc:foo'))
+
+    def test_write_through(self):
+        self.queryset.write_through = True
+        self.queryset.update_many([TestDoc(id="foo", data="3")])
+        self.assertEqual([['foo']], self.backing.batches)
+        self.assertEqual([self.backing.read_one('foo')[1]],
+                         self.cache.load('doc:foo'))
+
+    def test_documents_are_not_mistaken_for_missing(self):
+        self.cache.save('doc:odd', ['<not found>'])
+        self.assertEqual((self.queryset.MSG_OK, '<not found>'),
+                         self.queryset.read_one('odd'))
+        self.queryset.read_one('nope')
+        self.assertEqual([], self.cache.load('doc:nope'))
+
+
+class TestSQLiteQueryset(unittest.TestCase):
+    """
+    a test class for the sqlite queryset.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'docs.db')
+        self.queryset = SQLiteQueryset(self.path, 'ranked', indexes=['data'],
+                                       time_field='rank')
+        self.queryset.create_many([RankedDoc(id="foo", data="a", rank=3),
+                                   RankedDoc(id="bar", data="b", rank=1),
+                                   RankedDoc(id="baz", data="a", rank=2)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def ids(self, statuses):
+        return [datum['id'] for status, datum in statuses]
+
+    def test_create_and_update_statuses(self):
+        statuses = self.queryset.update_many([RankedDoc(id="foo", rank=4),
+                                              RankedDoc(id="new", rank=5)])
+        self.assertEqual([SQLiteQueryset.MSG_UPDATED, SQLiteQueryset.MSG_CREATED],
+                         [status for (status, shield) in statuses])
+        self.assertEqual(4, self.queryset.read_one('foo')[1]['rank'])
+
+    def test_reads(self):
+        self.assertEqual(['bar', 'baz', 'foo'], self.ids(self.queryset.read_all()))
+        self.assertEqual((SQLiteQueryset.MSG_FAILED, 'nope'),
+                         self.queryset.read_one('nope'))
+        statuses = self.queryset.read_many(['foo', 'nope', 'bar'])
+        self.assertEqual(['foo', 'bar'], [d['id'] for (s, d) in statuses
+                                          if s == SQLiteQueryset.MSG_OK])
+        self.assertEqual('nope', statuses[1][1])
+
+    def test_read_where(self):
+        self.assertEqual(['baz', 'foo'], self.ids(self.queryset.read_where(data='a')))
+        self.assertEqual(['foo'],
+                         self.ids(self.queryset.read_where(data='a', rank__gt=2)))
+        self.assertRaises(ValueError, self.queryset.read_where, **{'x; --': 1})
+
+    def test_read_where_limit(self):
+        self.assertEqual(['baz'],
+                         self.ids(self.queryset.read_where(data='a', limit=1)))
+        self.assertRaises(ValueError, self.queryset.read_where, data='a',
+                          limit=0)
+
+    def test_read_page_and_since(self):
+        self.assertEqual(['bar', 'baz', 'foo'],
+                         self.ids(self.queryset.iter_all(page_size=2)))
+        self.assertEqual(['baz', 'foo'], self.ids(self.queryset.read_since(1)))
+        self.assertEqual(['bar'], self.ids(self.queryset.read_since(0, limit=1)))
+        self.assertRaises(ValueError, self.queryset.read_page, limit=0)
+
+    def test_destroy(self):
+        statuses = self.queryset.destroy_many(['foo', 'nope'])
+        self.assertEqual([SQLiteQueryset.MSG_UPDATED, SQLiteQueryset.MSG_FAILED],
+                         [status for (status, datum) in statuses])
+        self.assertRaises(FourOhFourException, self.queryset.destroy_one, 'foo')
+        self.assertEqual(['bar', 'baz'], self.ids(self.queryset.read_all()))
+
+    def test_update_fields(self):
+        (status, datum) = self.queryset.update_fields('foo', {'rank': 0})
+        self.assertEqual(SQLiteQueryset.MSG_UPDATED, status)
+        self.assertEqual(('a', 0), (datum['data'], datum['rank']))
+        self.assertEqual(['foo', 'bar', 'baz'], self.ids(self.queryset.read_since(-1)))
+        self.assertEqual((SQLiteQueryset.MSG_FAILED, 'nope'),
+                         self.queryset.update_fields('nope', {'rank': 0}))
+
+    def test_read_fields(self):
+        self.assertEqual((SQLiteQueryset.MSG_OK, {'id': 'foo', 'rank': 3}),
+                         self.queryset.read('foo', fields=['rank']))
+        self.assertEqual([(SQLiteQueryset.MSG_OK, {'id': 'bar', 'data': 'b'}),
+                          (SQLiteQueryset.MSG_FAILED, 'nope')],
+                         self.queryset.read(['bar', 'nope'], fields=['data']))
+        self.assertEqual(['bar', 'baz', 'foo'],
+                         self.ids(self.queryset.read([], fields=['rank'])))
+
+    def test_reopen_adds_indexes(self):
+        queryset = SQLiteQueryset(self.path, 'ranked', indexes=['data', 'rank'])
+        self.assertEqual(['bar'], self.ids(queryset.read_where(rank__lt=2)))
+        plan = queryset._connection().execute(
+            'EXPLAIN QUERY PLAN SELECT document FROM ranked WHERE rank < 2')
+        self.assertTrue('ranked_rank' in str(plan.fetchall()))
+
+
+class TestShardedQueryset(unittest.TestCase):
+    """
+    a test class for spreading documents over several querysets.
+    """
+
+    def setUp(self):
+        self.shards = [CountingQueryset(time_field='rank') for n in range(3)]
+        self.queryset = ShardedQueryset(self.shards, time_field='rank')
+        self.ids = ['id%02d' % i for i in range(30)]
+        self.queryset.create_many([RankedDoc(id=iid, rank=i)
+                                   for (i, iid) in enumerate(self.ids)])
+
+    def test_spreads_ids(self):
+        sizes = [len(shard.db_conn) for shard in self.shards]
+        self.assertEqual(30, sum(sizes))
+        self.assertTrue(all(sizes))
+        for iid in self.ids:
+            self.assertTrue(iid in self.queryset.shard_for(iid).db_conn)
+
+    def test_read_many_keeps_order(self):
+        ids = list(reversed(self.ids)) + ['nope']
+        statuses = self.queryset.read_many(ids)
+        self.assertEqual(list(reversed(self.ids)),
+                         [datum['id'] for (status, datum) in statuses[:-1]])
+        self.assertEqual((ShardedQueryset.MSG_FAILED, 'nope'), statuses[-1])
+        # one read_many per shard
+        self.assertEqual(3, sum(len(shard.batches) for shard in self.shards))
+
+    def test_destroy_many(self):
+        self.queryset.destroy_many(self.ids[:10])
+        self.assertEqual(sorted(self.ids[10:]),
+                         sorted(d['id'] for (s, d) in self.queryset.read_all()))
+
+    def test_paging_and_since(self):
+        seen = [d['id'] for (s, d) in self.queryset.iter_all(page_size=4)]
+        self.assertEqual(sorted(self.ids), sorted(seen))
+        self.assertEqual(['id26', 'id27'],
+                         [d['id'] for (s, d) in self.queryset.read_since(25, limit=2)])
+
+    def test_read_where_in_key_order(self):
+        where = [d['id'] for (s, d) in self.queryset.read_where(rank__gte=10)]
+        self.assertEqual(self.ids[10:], where)
+        limited = self.queryset.read_where(rank__gte=10, limit=3)
+        self.assertEqual(self.ids[10:13], [d['id'] for (s, d) in limited])
+        self.assertRaises(ValueError, self.queryset.read_where, limit=0)
+        (cursor, page) = self.queryset.read_page(limit=30)
+        self.assertEqual(sorted(d['id'] for (s, d) in page),
+                         [d['id'] for (s, d) in page])
+
+    def test_shares_the_given_pool(self):
+        pool = coro_pool(2)
+        self.assertTrue(ShardedQueryset(self.shards, pool=pool).pool is pool)
+        queryset = ShardedQueryset(self.shards, pool=lambda: pool)
+        self.assertTrue(queryset.pool is pool)
+
+    def test_adding_a_shard_moves_few_ids(self):
+        bigger = ShardedQueryset(self.shards + [DictQueryset()])
+        moved = [iid for iid in self.ids
+                 if bigger.shard_for(iid) is not self.queryset.shard_for(iid)]
+        self.assertTrue(len(moved) < 15)
+        for iid in moved:
+            self.assertTrue(bigger.shard_for(iid) is bigger.shards[3])
+
+
+class RecordingQueryset(DictQueryset):
+    """Records the ids of each `create_many` and `update_many` call."""
+    def __init__(self, **kw):
+        super(RecordingQueryset, self).__init__(**kw)
+        self.writes = list()
+
+    def create_many(self, shields):
+        self.writes.append(('create', [s.id for s in shields]))
+        return super(RecordingQueryset, self).create_many(shields)
+
+    def update_many(self, shields):
+        self.writes.append(('update', [s.id for s in shields]))
+        return super(RecordingQueryset, self).update_many(shields)
+
+
+class TestWriteBehindQueryset(unittest.TestCase):
+    """
+    a test class for buffering writes.
+    """
+
+    def setUp(self):
+        self.backing = RecordingQueryset()
+        self.queryset = WriteBehindQueryset(self.backing, max_batch=10,
+                                            interval=0.01,
+                                            flush_at_exit=False)
+
+    def test_writes_are_batched(self):
+        for iid in ['a', 'b', 'c']:
+            status = self.queryset.create_one(TestDoc(id=iid))
+            self.assertEqual(WriteBehindQueryset.MSG_CREATED, status[0])
+        self.queryset.update_one(TestDoc(id="b", data="new"))
+        self.queryset.update_one(TestDoc(id="z", data="up"))
+        self.assertEqual([], self.backing.writes)
+
+        gevent.sleep(0.05)
+        self.assertEqual([('create', ['a', 'b', 'c']), ('update', ['z'])],
+                         self.backing.writes)
+        self.assertEqual('new', self.backing.read_one('b')[1]['data'])
+
+    def test_max_batch_flushes(self):
+        self.queryset.create_many([TestDoc(id=str(i)) for i in range(10)])
+        self.assertEqual(1, len(self.backing.writes))
+
+    def test_wait(self):
+        greenlets = [gevent.spawn(self.queryset.create_one, TestDoc(id=iid),
+                                  wait=True) for iid in ['a', 'b']]
+        gevent.joinall(greenlets)
+        self.assertEqual([('create', ['a', 'b'])], self.backing.writes)
+        self.assertEqual([WriteBehindQueryset.MSG_CREATED] * 2,
+                         [g.get()[0] for g in greenlets])
+
+    def test_reads_wait_for_writes_in_flight(self):
+        backing = self.backing
+
+        def slow_create_many(shields):
+            gevent.sleep(0.01)
+            return RecordingQueryset.create_many(backing, shields)
+        backing.create_many = slow_create_many
+
+        self.queryset.create_one(TestDoc(id='a'))
+        flushing = gevent.spawn(self.queryset.flush)
+        gevent.sleep(0)  # the buffer is swapped out, the write isn't done
+        self.assertEqual(WriteBehindQueryset.MSG_OK,
+                         self.queryset.read_one('a')[0])
+        self.queryset.create_one(TestDoc(id='b'))
+        flushing = gevent.spawn(self.queryset.flush)
+        gevent.sleep(0)
+        self.assertEqual(['a', 'b'],
+                         [d['id'] for (s, d) in self.queryset.read_all()])
+        flushing.join()
+
+    def test_flush_at_exit_holds_a_weak_reference(self):
+        queryset = WriteBehindQueryset(self.backing)
+        ref = weakref.ref(queryset)
+        del queryset
+        gc.collect()
+        self.assertEqual(None, ref())
+
+    def test_reads_see_pending_writes(self):
+        self.queryset.create_one(TestDoc(id="a", data="x"))
+        self.assertEqual('x', self.queryset.read_one('a')[1]['data'])
+        self.assertEqual(1, len(self.backing.writes))
+
+
+class FakeRedis(object):
+    """Just enough of redis-py's hash commands, kept in dicts."""
+    def __init__(self):
+        self.hashes = dict()
+        self.sets = dict()
+        self.zsets = dict()
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        existing = self.hashes.setdefault(name, {})
+        added = len([k for k in items if k not in existing])
+        existing.update(items)
+        return added
+
+    def hget(self, name, key):
+        return self.hashes.get(name, {}).get(key)
+
+    def hdel(self, name, key):
+        return int(self.hashes.get(name, {}).pop(key, None) is not None)
+
+    def hvals(self, name):
+        return self.hashes.get(name, {}).values()
+
+    def hscan(self, name, cursor=0, count=None):
+        return (0, dict(self.hashes.get(name, {})))
+
+    def hmget(self, name, keys):
+        return [self.hashes.get(name, {}).get(key) for key in keys]
+
+    def hgetall(self, name):
+        return dict(self.hashes.get(name, {}))
+
+    def exists(self, name):
+        return int(name in self.hashes or name in self.sets)
+
+    def delete(self, *names):
+        return sum(int(self.hashes.pop(name, self.sets.pop(name, None))
+                       is not None) for name in names)
+
+    def sadd(self, name, member):
+        is_new = member not in self.sets.setdefault(name, set())
+        self.sets[name].add(member)
+        return int(is_new)
+
+    def srem(self, name, member):
+        if member not in self.sets.get(name, ()):
+            return 0
+        self.sets[name].remove(member)
+        return 1
+
+    def smembers(self, name):
+        return set(self.sets.get(name, ()))
+
+    def sscan(self, name, cursor=0, count=None):
+        return (0, list(self.sets.get(name, ())))
+
+    def zadd(self, name, mapping):
+        self.zsets.setdefault(name, {}).update(mapping)
+
+    def zrem(self, name, *members):
+        for member in members:
+            self.zsets.get(name, {}).pop(member, None)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    """Queues commands until `execute`, except between `watch` and `multi`
+    when they run at once, as in redis-py."""
+    def __init__(self, redis_connection):
+        self.redis_connection = redis_connection
+        self.queued = list()
+        self.immediate = False
+
+    def watch(self, *names):
+        self.immediate = True
+
+    def multi(self):
+        self.immediate = False
+
+    def __getattr__(self, name):
+        command = getattr(self.redis_connection, name)
+        if self.immediate:
+            return command
+        return lambda *args, **kwargs: self.queued.append((command, args,
+                                                            kwargs))
+
+    def execute(self):
+        (queued, self.queued) = (self.queued, list())
+        return [command(*args, **kwargs)
+                for (command, args, kwargs) in queued]
+
+    def reset(self):
+        self.queued = list()
+        self.immediate = False
+
+
+class TestRedisQuerysetBuckets(unittest.TestCase):
+    """
+    a test class for namespaced and bucketed redis querysets.
+    """
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.queryset = RedisQueryset(db_conn=self.redis, namespace='doc',
+                                      buckets=4)
+        self.ids = ['id%d' % i for i in range(20)]
+        self.queryset.create_many([TestDoc(id=iid) for iid in self.ids])
+
+    def test_ids_spread_over_buckets(self):
+        self.assertEqual(['doc:0', 'doc:1', 'doc:2', 'doc:3'],
+                         sorted(self.redis.hashes.keys()))
+        self.assertEqual(20, sum(len(h) for h in self.redis.hashes.values()))
+        self.assertEqual('id3', self.queryset.read_one('id3')[1]['id'])
+        self.assertEqual(sorted(self.ids),
+                         sorted(d['id'] for (s, d) in self.queryset.read_all()))
+
+    def test_read_page_walks_buckets(self):
+        seen = [d['id'] for (s, d) in self.queryset.iter_all(page_size=3)]
+        self.assertEqual(sorted(self.ids), sorted(seen))
+        self.assertRaises(ValueError, self.queryset.read_page, limit=0)
+
+    def test_destroy(self):
+        self.queryset.destroy_one('id3')
+        self.assertEqual(RedisQueryset.MSG_FAILED,
+                         self.queryset.read_one('id3')[0])
+
+    def test_migrate_hash(self):
+        from brubeck.queryset.redis import migrate_hash
+        legacy = RedisQueryset(db_conn=self.redis)
+        legacy.create_many([TestDoc(id='a'), TestDoc(id='b'),
+                            RankedDoc(id='c', rank=1)])
+        queryset = RedisQueryset(db_conn=self.redis, namespace='new',
+                                 buckets=2)
+
+        self.assertEqual(2, migrate_hash(queryset, model=TestDoc, delete=True))
+        self.assertEqual(['a', 'b'],
+                         sorted(d['id'] for (s, d) in queryset.read_all()))
+        self.assertEqual(['c'], self.redis.hashes['id'].keys())
+        self.assertRaises(ValueError, migrate_hash, legacy)
+
+
+class TestRedisUpdateFields(unittest.TestCase):
+    """
+    a test class for partial updates in both redis querysets.
+    """
+
+    def setUp(self):
+        self.redis = FakeRedis()
+
+    def test_blob_update_fields(self):
+        queryset = RedisQueryset(db_conn=self.redis, time_field='rank')
+        queryset.create_one(RankedDoc(id='foo', data='a', rank=1))
+        (status, datum) = queryset.update_fields('foo', {'rank': 5})
+        self.assertEqual(RedisQueryset.MSG_UPDATED, status)
+        self.assertEqual(('a', 5), (datum['data'], datum['rank']))
+        self.assertEqual(5, queryset.read_one('foo')[1]['rank'])
+        self.assertEqual(5, self.redis.zsets['id:rank']['foo'])
+        self.assertEqual((RedisQueryset.MSG_FAILED, 'nope'),
+                         queryset.update_fields('nope', {'rank': 5}))
+
+    def test_hash_queryset(self):
+        queryset = RedisHashQueryset(db_conn=self.redis, namespace='ranked')
+        statuses = queryset.create_many([RankedDoc(id='foo', data='a', rank=1),
+                                         RankedDoc(id='bar', data='b', rank=2)])
+        self.assertEqual([RedisQueryset.MSG_CREATED] * 2,
+                         [status for (status, shield) in statuses])
+        self.assertEqual('1', self.redis.hashes['ranked:foo']['rank'])
+
+        (status, datum) = queryset.update_fields('foo', {'rank': 7})
+        self.assertEqual(('a', 7), (datum['data'], datum['rank']))
+        self.assertEqual('7', self.redis.hashes['ranked:foo']['rank'])
+        self.assertEqual((RedisQueryset.MSG_FAILED, 'nope'),
+                         queryset.update_fields('nope', {'rank': 7}))
+
+        self.assertEqual(['bar', 'foo'],
+                         sorted(d['id'] for (s, d) in queryset.read_all()))
+        self.assertEqual((RedisQueryset.MSG_FAILED, 'nope'),
+                         queryset.read_many(['foo', 'nope'])[1])
+        self.assertEqual((RedisQueryset.MSG_OK, {'id': 'foo', 'rank': 7}),
+                         queryset.read('foo', fields=['rank']))
+        self.assertEqual([(RedisQueryset.MSG_FAILED, 'nope')],
+                         queryset.read(['nope'], fields=['rank']))
+        self.assertEqual([{'id': 'bar', 'data': 'b'}, {'id': 'foo', 'data': 'a'}],
+                         sorted([d for (s, d) in queryset.read([], fields=['data'])],
+                                key=lambda d: d['id']))
+
+        queryset.destroy_one('foo')
+        self.assertEqual(RedisQueryset.MSG_FAILED, queryset.read_one('foo')[0])
+        self.assertEqual(set(['bar']), self.redis.sets['ranked'])
+
+
+class TestRedisRendered(unittest.TestCase):
+    """
+    a test class for redis querysets that store rendered documents.
+    """
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.queryset = RedisQueryset(db_conn=self.redis, rendered=True,
+                                      time_field='rank')
+        self.queryset.create_many([RankedDoc(id='foo', data='a', rank=1),
+                                   RankedDoc(id='bar', data='b', rank=2)])
+
+    def test_read_rendered(self):
+        from brubeck.encoding import RawJSON
+        (status, raw) = self.queryset.read_rendered('foo')
+        self.assertEqual(RedisQueryset.MSG_OK, status)
+        self.assertTrue(isinstance(raw, RawJSON))
+        self.assertEqual({'id': 'foo', 'data': 'a', 'rank': 1}, raw.decode())
+        statuses = self.queryset.read_rendered(['bar', 'nope'])
+        self.assertEqual('bar', statuses[0][1].decode()['id'])
+        self.assertEqual(RedisQueryset.MSG_FAILED, statuses[1][0])
+
+    def test_update_fields_drops_rendered(self):
+        self.queryset.update_fields('foo', {'rank': 5})
+        (status, datum) = self.queryset.read_rendered('foo')
+        self.assertEqual(5, datum['rank'])
+        self.queryset.update_one(RankedDoc(id='foo', data='c', rank=6))
+        self.assertEqual('c', self.queryset.read_rendered('foo')[1].decode()['data'])
+
+    def test_destroy(self):
+        self.assertEqual(RedisQueryset.MSG_UPDATED,
+                         self.queryset.destroy_many(['foo', 'nope'])[0][0])
+        self.assertEqual(['bar'], self.redis.hashes['id:rendered'].keys())
+
+    def test_custom_api_id(self):
+        queryset = RedisQueryset(db_conn=FakeRedis(), rendered=True,
+                                 api_id='data')
+        queryset.create_one(RankedDoc(id='foo', data='a', rank=1))
+        (status, raw) = queryset.read_rendered('a')
+        self.assertEqual(RedisQueryset.MSG_OK, status)
+        self.assertEqual('foo', raw.decode()['id'])
+
 
 class TestRedisQueryset(TestQuerySetPrimitives):
     """
@@ -238,6 +954,73 @@ class TestRedisQueryset(TestQuerySetPrimitives):
             self.assertEqual(name, 'hvals().__iter__')
             self.assertEqual(args, ())
 
+    def test_read_page(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            instance = patchedRedis.return_value
+            instance.hscan.return_value = (0, {'foo': '{"id": "foo"}'})
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            queryset = RedisQueryset(db_conn=redis_connection)
+
+            cursor, statuses = queryset.read_page(cursor=17, limit=10)
+            self.assertEqual(None, cursor)
+            self.assertEqual([(queryset.MSG_OK, {'id': 'foo'})], statuses)
+            self.assertEqual(('hscan', (queryset.api_id,),
+                              {'cursor': 17, 'count': 10}),
+                             redis_connection.mock_calls[0])
+
+    def test_time_index_writes(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            instance = patchedRedis.return_value
+            instance.pipeline.return_value.execute.return_value = [None, 1, 1]
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            queryset = RedisQueryset(db_conn=redis_connection, time_field='rank')
+            queryset.create_one(RankedDoc(id="foo", rank=5))
+            queryset.destroy_one("foo")
+
+            calls = [(name, args) for (name, args, kwargs)
+                     in redis_connection.mock_calls]
+            self.assertTrue(('pipeline().zadd', ('id:rank', {'foo': 5})) in calls)
+            self.assertTrue(('pipeline().zrem', ('id:rank', 'foo')) in calls)
+            self.assertFalse('hset' in [name for (name, args) in calls])
+
+    def test_read_since(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            instance = patchedRedis.return_value
+            instance.zrangebyscore.return_value = ['bar', 'foo']
+            instance.hmget.return_value = ['{"id": "bar"}', None]
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            queryset = RedisQueryset(db_conn=redis_connection, time_field='rank')
+
+            statuses = queryset.read_since(100, limit=2)
+            self.assertEqual([(queryset.MSG_OK, {'id': 'bar'})], statuses)
+            self.assertEqual(('zrangebyscore', ('id:rank', '(100', '+inf'),
+                              {'start': 0, 'num': 2}),
+                             redis_connection.mock_calls[0])
+            self.assertEqual(('hmget', ('id', ['bar', 'foo']), {}),
+                             redis_connection.mock_calls[1])
+
+    def test_codec(self):
+        from brubeck.encoding import TaggedCodec, LegacyJSONCodec, TAG_ZLIB_JSON
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            codec = TaggedCodec(TAG_ZLIB_JSON, legacy=LegacyJSONCodec())
+            queryset = RedisQueryset(db_conn=redis_connection, codec=codec)
+            queryset.create_one(TestDoc(id="foo", data="bar"))
+
+            name, args, kwargs = redis_connection.mock_calls[0]
+            self.assertEqual(TAG_ZLIB_JSON, args[2][0])
+            self.assertEqual('bar', queryset._readvalue(args[2])['data'])
+            self.assertEqual({'id': 'old'}, queryset._readvalue('{"id": "old"}'))
+            self.assertEqual(None, queryset._readvalue(None))
+
+    def test_compressed_values(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            queryset = RedisQueryset(db_conn=redis_connection, compress=True)
+            value = queryset._setvalue(TestDoc(id="foo"))
+            self.assertEqual('foo', queryset._readvalue(value)['id'])
+            self.assertRaises(Exception, queryset._readvalue, 'not zlib')
+
     def test__read_one(self):
         for _id in ['foo', 'bar', 'baz']:
             with mock.patch('redis.StrictRedis') as patchedRedis:
@@ -202,6 +202,52 @@ class TestRequestHandling(unittest.TestCase):
         response = http_response(result['body'], result['status_code'], result['status_msg'], result['headers'])
         self.assertEqual(response, FIXTURES.HTTP_RESPONSE_OBJECT_ROOT)
 
+    def test_get_header(self):
+        mongrel2 = Request('sender', 1, '/', {'accept': 'text/html'}, '', '/')
+        wsgi = Request('sender', 1, '/', {'HTTP_ACCEPT': 'text/html',
+                                          'CONTENT_TYPE': 'text/plain'},
+                       '', '/')
+        for request in [mongrel2, wsgi]:
+            self.assertEqual('text/html', request.get_header('Accept'))
+            self.assertEqual('x', request.get_header('X-Missing', 'x'))
+        self.assertEqual('text/plain', wsgi.get_header('Content-Type'))
+
+    def test_negotiate(self):
+        from brubeck.encoding import negotiate
+        offered = ['application/json', 'application/x-msgpack']
+        for (accept, expected) in [
+                (None, 'application/json'),
+                ('*/*', 'application/json'),
+                ('application/x-msgpack', 'application/x-msgpack'),
+                ('application/*;q=0.5, application/x-msgpack',
+                 'application/x-msgpack'),
+                ('application/x-msgpack;q=0.2, application/json;q=0.8',
+                 'application/json'),
+                ('*/*;q=0.1, application/json;q=0', 'application/x-msgpack'),
+                ('text/html', 'application/json')]:
+            self.assertEqual(expected, negotiate(accept, offered))
+
+    def test_negotiation_cached_per_class(self):
+        class MsgpackHandler(JSONMessageHandler):
+            media_types = ('application/x-msgpack', 'application/json')
+        MsgpackHandler.negotiate_media_type('*/*')
+        JSONMessageHandler.negotiate_media_type('*/*')
+        self.assertEqual('application/x-msgpack',
+                         MsgpackHandler._negotiated['*/*'][0])
+        self.assertEqual('application/json',
+                         JSONMessageHandler._negotiated['*/*'][0])
+
+    def test_vary_accept(self):
+        class JSONOnlyHandler(SimpleJSONHandlerObject):
+            media_types = ('application/json',)
+        for (handler, vary) in [(SimpleJSONHandlerObject, 'Accept'),
+                                (JSONOnlyHandler, None)]:
+            app = Brubeck(msg_conn=WSGIConnection())
+            app.add_route_rule(r'^/$', handler)
+            result = route_message(app,
+                                   Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT))
+            self.assertEqual(vary, result['headers'].get('Vary'))
+
     ##
     ## some simple helper functions to setup a route """
     ##